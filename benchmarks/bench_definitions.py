@@ -0,0 +1,113 @@
+"""
+compares memory footprint of a quest definition with 10k tasks
+built from slotted immutable definitions and from the former
+mutable definitions that kept a __dict__ and lists per object
+
+run from repository root:
+    PYTHONPATH=src python benchmarks/bench_definitions.py
+"""
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+
+from questbot.matchers import normalize_answer
+from questbot.definitions import (
+    QuestDefinition,
+    TeamDefinition,
+    TaskDefinition
+)
+
+
+TEAMS = 4
+TASKS = 10000
+
+
+class LegacyTaskDefinition():
+    """
+    layout of mutable task definition that was used before
+    """
+
+    def __init__(self, question, answer, hints):
+        self._question = question
+        self._answers = [answer]
+        self._accepted_answers = {normalize_answer(answer)}
+        self._fuzzy = 0
+        self._hints = list(hints)
+
+    def get_hints(self):
+        return self._hints[:]
+
+
+class LegacyTeamDefinition():
+    def __init__(self, name, description, communication, tasks):
+        self._name = name
+        self._description = description
+        self._communication = communication
+        self._tasks = list(tasks)
+
+    def get_tasks(self):
+        return self._tasks[:]
+
+
+def task_fields(idx):
+    return (f"Question #{idx}?", f"answer{idx}",
+            [f"hint #{idx}.1", f"hint #{idx}.2"])
+
+
+def build_quest(fields):
+    teams = []
+    per_team = len(fields) // TEAMS
+    for team_idx in range(TEAMS):
+        tasks = [TaskDefinition(*item) for item in
+                 fields[team_idx * per_team:(team_idx + 1) * per_team]]
+        teams.append(TeamDefinition(f"team{team_idx}", "", "", tasks))
+    return QuestDefinition("quest", "", datetime.now(),
+                           timedelta(hours=2), teams)
+
+
+def build_legacy_quest(fields):
+    teams = []
+    per_team = len(fields) // TEAMS
+    for team_idx in range(TEAMS):
+        tasks = [LegacyTaskDefinition(*item) for item in
+                 fields[team_idx * per_team:(team_idx + 1) * per_team]]
+        teams.append(LegacyTeamDefinition(f"team{team_idx}", "", "", tasks))
+    return teams
+
+
+def footprint(build, fields):
+    """
+    returns number of bytes allocated by build(fields) and kept alive,
+    field strings are allocated beforehand and aren't counted
+    """
+
+    tracemalloc.start()
+    try:
+        result = build(fields)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    fields = [task_fields(idx) for idx in range(TASKS)]
+    slotted = footprint(build_quest, fields)
+    legacy = footprint(build_legacy_quest, fields)
+    print(f"slotted definitions     {slotted / 1024:10.1f} KiB "
+          f"({slotted / TASKS:.0f} B/task)")
+    print(f"legacy definitions      {legacy / 1024:10.1f} KiB "
+          f"({legacy / TASKS:.0f} B/task)")
+
+    team = build_quest(fields).get_teams()[0]
+    legacy_team = build_legacy_quest(fields)[0]
+    rounds = 1000
+    for name, get_tasks in (("slotted", team.get_tasks),
+                            ("legacy", legacy_team.get_tasks)):
+        latency = timeit.timeit(get_tasks, number=rounds) / rounds * 1e6
+        print(f"get_tasks() {name:<11} {latency:10.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+measures per-answer latency of TaskDefinition.is_correct
+
+run from repository root:
+    PYTHONPATH=src python benchmarks/bench_matchers.py
+"""
+import timeit
+from difflib import SequenceMatcher
+
+from questbot.definitions import TaskDefinition
+
+
+ROUNDS = 20000
+
+
+def measure(stmt):
+    """
+    returns latency of a single stmt() call in microseconds (best of 5 runs)
+    """
+
+    return min(timeit.repeat(stmt, number=ROUNDS, repeat=5)) / ROUNDS * 1e6
+
+
+def main():
+    answers = ("Рубины", "Красные камни", "Драгоценные камни")
+
+    cases = {
+        "exact": "рубины",
+        "typo": "Рубиньі",
+        "miss": "Изумрудный город",
+    }
+
+    for fuzzy in (0, 1, 2, 3):
+        task = TaskDefinition("Какие камни приносят счастье?",
+                              answers, fuzzy=fuzzy)
+        for name, value in cases.items():
+            latency = measure(lambda: task.is_correct(value))
+            print(f"is_correct fuzzy={fuzzy} {name:<5} "
+                  f"{latency:8.2f} us/answer")
+
+    for name, value in cases.items():
+        latency = measure(lambda: max(SequenceMatcher(None, value, answer)
+                                      .ratio() for answer in answers))
+        print(f"SequenceMatcher   {name:<5} {latency:8.2f} us/answer")
+
+
+if __name__ == "__main__":
+    main()
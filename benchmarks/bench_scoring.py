@@ -0,0 +1,87 @@
+"""
+compares per-object EfficiencyController scoring with ScoringEngine
+
+run from repository root:
+    PYTHONPATH=src python benchmarks/bench_scoring.py
+"""
+import random
+import timeit
+from datetime import timedelta
+
+from questbot import scoring
+from questbot.results import EfficiencyController, EfficiencyItem
+from questbot.scoring import ScoringEngine
+
+
+TEAMS = (10, 100, 1000)
+TASKS_PER_TEAM = 20
+
+
+def make_controllers(teams):
+    controllers = []
+    for _ in range(teams):
+        eff_controller = EfficiencyController()
+        for _ in range(TASKS_PER_TEAM):
+            item = EfficiencyItem(
+                timedelta(seconds=random.uniform(0, 3600)),
+                random.randint(0, 10))
+            eff_controller._tasks.append(item)
+        controllers.append(eff_controller)
+    return controllers
+
+
+def score_objects(controllers):
+    """
+    recomputes totals the way appraise() does it, item by item
+    """
+
+    return {idx: sum(sum(item) for item in eff_controller.appraise())
+            for idx, eff_controller in enumerate(controllers)}
+
+
+def build_engine(controllers):
+    engine = ScoringEngine()
+    for idx, eff_controller in enumerate(controllers):
+        engine.add_controller(idx, eff_controller)
+    return engine
+
+
+def measure(stmt, number):
+    """
+    returns duration of a single stmt() call in milliseconds (best of 5 runs)
+    """
+
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1e3
+
+
+def main():
+    random.seed(1)
+    backends = [("loop", None)]
+    if scoring.numpy is not None:
+        backends.insert(0, ("numpy", scoring.numpy))
+
+    for teams in TEAMS:
+        controllers = make_controllers(teams)
+        expected = score_objects(controllers)
+        number = max(1, 1000 // teams)
+
+        latency = measure(lambda: score_objects(controllers), number)
+        print(f"teams={teams:<5} tasks={teams * TASKS_PER_TEAM:<6} "
+              f"objects  {latency:9.3f} ms")
+
+        latency = measure(lambda: build_engine(controllers), number)
+        print(f"teams={teams:<5} tasks={teams * TASKS_PER_TEAM:<6} "
+              f"export   {latency:9.3f} ms")
+
+        engine = build_engine(controllers)
+        for name, module in backends:
+            scoring.numpy = module
+            assert engine.score() == expected, f"{name} totals differ"
+            latency = measure(engine.score, number)
+            print(f"teams={teams:<5} tasks={teams * TASKS_PER_TEAM:<6} "
+                  f"{name:<8} {latency:9.3f} ms")
+        scoring.numpy = backends[0][1]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+fake Telegram transport for benchmarks, nothing leaves the process
+"""
+import time
+import warnings
+import threading
+from queue import Queue
+
+from telegram.ext import Dispatcher
+
+
+class FakeBot():
+    """
+    bot that records sendMessage calls instead of sending them,
+    every record is (monotonic time, chat_id, text)
+    """
+
+    def __init__(self, record=True):
+        self.id = 1
+        self.username = "fakebot"
+        self.first_name = "Fake Bot"
+        self.defaults = None
+        self.sent = []
+        self.count = 0
+        self._record = record
+        self._lock = threading.Lock()
+
+    def sendMessage(self, chat_id, text, parse_mode=None, **kwargs):
+        with self._lock:
+            self.count += 1
+            if self._record:
+                self.sent.append((time.monotonic(), chat_id, text))
+        return True
+
+    send_message = sendMessage
+
+    def reset(self):
+        with self._lock:
+            self.sent = []
+            self.count = 0
+
+
+def make_dispatcher(bot=None, workers=0):
+    """
+    returns telegram Dispatcher running on top of FakeBot
+    """
+
+    with warnings.catch_warnings():
+        # dispatcher warns that run_async handlers need worker threads
+        warnings.simplefilter("ignore")
+        return Dispatcher(bot or FakeBot(), Queue(), workers=workers)
@@ -0,0 +1,141 @@
+"""
+measures throughput of team commands with quest events running in the
+bot process (0 shards) and partitioned across N shard processes
+
+run from repository root:
+    PYTHONPATH=src python benchmarks/shards.py
+    PYTHONPATH=src python benchmarks/shards.py --shards 0,1,2,4 --quests 64
+
+every quest runs in its own quest event with --teams teams of --players
+players, commands are /answer (wrong answers) and /hint of random players
+sent without waiting for each other; throughput is the number of commands
+handled per second until the last one is done, messages go to FakeBot
+
+NOTE: shards scale only with free cores, compare runs on the same machine
+"""
+import sys
+import time
+import random
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+from fakes import FakeBot, make_dispatcher
+from suite import make_team
+
+from questbot.users import User
+from questbot.events import EventState
+from questbot.broadcast import BroadcastScheduler
+from questbot.controllers import QuestController
+from questbot.shards import ShardedQuestController
+from questbot.definitions import QuestDefinition
+
+
+START_DELAY = 5     # in seconds, shard processes must be started by then
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition is not met in time")
+        time.sleep(0.05)
+
+
+def measure(args, shards):
+    """
+    returns number of team commands handled per second
+    """
+
+    if shards:
+        controller = ShardedQuestController(shards)
+    else:
+        controller = QuestController()
+
+    # qevent identifiers are announced to subscribed users only
+    qevent_ids = {}
+    notify_template = controller.distributor.notify_template
+
+    def recorded_notify_template(template_name, **kwargs):
+        if template_name == "quest_scheduled":
+            qevent_ids[kwargs["quest_name"]] = kwargs["qevent_id"]
+        return notify_template(template_name, **kwargs)
+    controller.distributor.notify_template = recorded_notify_template
+
+    dispatcher = make_dispatcher(FakeBot(record=False))
+    players = args.quests * args.teams * args.players
+    users = {user_id: User(user_id, user_id, dispatcher)
+             for user_id in range(players)}
+    controller.relink_users(users)
+
+    start_date = datetime.now() + timedelta(seconds=START_DELAY)
+    names = [f"quest{idx}" for idx in range(args.quests)]
+    for name in names:
+        controller.register(QuestDefinition(
+            name, "", start_date, timedelta(hours=1),
+            [make_team(f"team{idx}", args.tasks)
+             for idx in range(args.teams)]))
+    wait_for(lambda: len(qevent_ids) == len(names), START_DELAY)
+    for user_id, user in users.items():
+        controller.join_quest(user, qevent_ids[names[user_id % len(names)]])
+    wait_for(lambda: all(controller.get_state(name) == EventState.RUNNING
+                         for name in names), 2 * START_DELAY)
+
+    commands = []
+    for idx in range(args.commands):
+        user = users[random.randrange(players)]
+        if random.random() < args.hint:
+            commands.append((user, None))
+        else:
+            commands.append((user, f"wrong{idx}"))
+
+    started_at = time.perf_counter()
+    futures = []
+    for user, value in commands:
+        team_controller = user.get_team_controller()
+        if value is None:
+            futures.append(team_controller.give_hint(user))
+        else:
+            futures.append(team_controller.check_answer(user, value))
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started_at
+
+    controller.shutdown()
+    return args.commands / elapsed
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    args.add_argument("--shards", default="0,1,2,4",
+                      help="comma separated numbers of shards, "
+                           "0 runs quest events in the bot process")
+    args.add_argument("--quests", type=int, default=32)
+    args.add_argument("--teams", type=int, default=4)
+    args.add_argument("--players", type=int, default=4,
+                      help="players of every team")
+    args.add_argument("--tasks", type=int, default=10)
+    args.add_argument("--commands", type=int, default=20000)
+    args.add_argument("--hint", type=float, default=0.1,
+                      help="share of /hint commands")
+    args.add_argument("--seed", type=int, default=1)
+    args = args.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    random.seed(args.seed)
+    # deliveries must not be the bottleneck
+    BroadcastScheduler.GLOBAL_RATE = 10 ** 9
+    BroadcastScheduler.CHAT_RATE = 10 ** 9
+    BroadcastScheduler.CHAT_BURST = 10 ** 9
+
+    baseline = None
+    for shards in [int(value) for value in args.shards.split(",")]:
+        throughput = measure(args, shards)
+        baseline = baseline or throughput
+        print(f"shards={shards:<3} {throughput:>10.0f} commands/s  "
+              f"{throughput / baseline:.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
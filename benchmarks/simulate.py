@@ -0,0 +1,419 @@
+"""
+end-to-end load simulator: runs the real UserController and QuestController
+on a telegram Dispatcher whose bot is replaced by FakeBot, and feeds it with
+synthetic /start, /register, /answer and /hint updates of virtual players
+
+run from repository root:
+    PYTHONPATH=src python benchmarks/simulate.py
+    PYTHONPATH=src python benchmarks/simulate.py --players 5000 --rate 500
+
+players join (/start, /register) with --join-rate updates per second, then
+send /answer and /hint with --rate updates per second for --duration seconds;
+arrivals are a Poisson process, nothing goes to the network
+
+latency of an update is measured from its arrival to the first message
+delivered to the player in response (answers and hints are broadcast to
+the team, so latency includes the team mailbox and rate limited delivery)
+
+Telegram limits are applied by BroadcastScheduler, use --global-rate and
+--chat-rate to see how the bot behaves with other limits
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import bisect
+import logging
+import argparse
+import tempfile
+import threading
+import itertools
+from datetime import datetime, timedelta
+
+from telegram import (
+    Chat,
+    Update,
+    Message,
+    MessageEntity,
+    User as TelegramUser
+)
+from telegram.ext import TypeHandler
+
+from fakes import FakeBot, make_dispatcher
+
+from questbot.events import EventState
+from questbot.storage import create_storage
+from questbot.broadcast import BroadcastScheduler
+from questbot.controllers import QuestController
+from questbot.definitions import (
+    QuestDefinition,
+    TeamDefinition,
+    TaskDefinition
+)
+from questbot.telegram.controllers import UserController
+
+
+SAMPLE_INTERVAL = 0.01   # in seconds, for queue sizes
+PERCENTILES = (50, 90, 99)
+
+# a message is a reply to an answer or a hint only if it doesn't
+# mention another answer, see Simulator.request()
+ANSWER_TOKEN = re.compile(r"\b[aw]\d{6}\b")
+
+
+def percentile(values, share):
+    """
+    returns percentile of sorted values (nearest rank)
+    """
+
+    if not values:
+        return None
+    index = max(0, int(round(share / 100 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class Simulator():
+    """
+    owns the bot under test and records every request sent to it
+    """
+
+    def __init__(self, args, storage_file):
+        self.args = args
+        self.bot = FakeBot()
+        self.dispatcher = make_dispatcher(self.bot)
+        self.storage = create_storage(args.storage, storage_file)
+        self.controller = QuestController(self.storage)
+        self.user_controller = UserController(self.dispatcher,
+                                              self.controller, self.storage)
+        # runs after command handlers of group 0
+        self.dispatcher.add_handler(TypeHandler(Update, self._handled),
+                                    group=1)
+
+        self._update_ids = itertools.count(1)
+        self._requests = {}     # update_id => request dict
+        self._handled_at = {}   # update_id => time.monotonic() of dispatch
+        self.peak_inbound = 0
+        self.peak_outbound = 0
+        self._sampling = False
+
+    def _handled(self, update, context):
+        self._handled_at[update.update_id] = time.monotonic()
+
+    def player_name(self, player):
+        return f"player{player:07d}"
+
+    def _make_update(self, player, command, args):
+        text = " ".join([f"/{command}", *args])
+        user = TelegramUser(player, self.player_name(player), False,
+                            language_code="ru", bot=self.bot)
+        message = Message(
+            next(self._update_ids), datetime.now(),
+            Chat(player, Chat.PRIVATE), from_user=user, text=text,
+            entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0,
+                                    len(command) + 1)],
+            bot=self.bot)
+        return Update(message.message_id, message=message)
+
+    def request(self, player, kind, command, *args, token=None,
+                named=True):
+        """
+        puts an update to dispatcher queue and records it,
+        reply is the first message to the player that contains token
+        and the player name (if named is True)
+        """
+
+        update = self._make_update(player, command, args)
+        self._requests[update.update_id] = {
+            "kind": kind,
+            "chat_id": player,
+            "token": token,
+            "name": self.player_name(player) if named else None,
+            "arrived_at": time.monotonic(),
+        }
+        self.dispatcher.update_queue.put(update)
+
+    def _sample(self):
+        scheduler = self.controller.scheduler
+        while self._sampling:
+            self.peak_inbound = max(self.peak_inbound,
+                                    self.dispatcher.update_queue.qsize())
+            self.peak_outbound = max(self.peak_outbound, scheduler.pending)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def _feed(self, rate, until, make_request):
+        """
+        makes requests with Poisson arrivals until time.monotonic() > until
+        """
+
+        next_at = time.monotonic()
+        while True:
+            next_at += random.expovariate(rate)
+            if next_at > until:
+                return
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            make_request()
+
+    def _make_quest(self):
+        args = self.args
+        join_time = 2 * args.players / args.join_rate + 2
+        teams = [TeamDefinition(
+            f"team{team}", "", "https://t.me/+team",
+            [TaskDefinition(f"question {task}", f"a{task:06d}",
+                            [f"hint {task}.{hint}" for hint in range(2)])
+             for task in range(args.tasks)])
+            for team in range(args.teams)]
+        return QuestDefinition("simulation", "",
+                               datetime.now() + timedelta(seconds=join_time),
+                               timedelta(days=1), teams)
+
+    def _wait_for_state(self, quest_name, state, timeout):
+        deadline = time.monotonic() + timeout
+        while self.controller.get_state(quest_name) != state:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Quest '{quest_name}' hasn't reached "
+                                   f"state={state.name} in {timeout}s")
+            time.sleep(0.05)
+
+    def _play(self, player):
+        """
+        sends /answer or /hint of a random player
+        """
+
+        user = self.user_controller._get_user(player)
+        team_controller = user.get_team_controller() if user else None
+        if team_controller is None:
+            return
+
+        if random.random() < self.args.hint:
+            self.request(player, "hint", "hint")
+            return
+
+        task = team_controller._current_task_definition
+        if task is not None and random.random() < self.args.correct:
+            value = task.answer
+        else:
+            value = f"w{random.randrange(10 ** 6):06d}"
+        self.request(player, "answer", "answer", value, token=value)
+
+    def run(self):
+        args = self.args
+        quest = self._make_quest()
+        dispatcher_thread = threading.Thread(target=self.dispatcher.start,
+                                             daemon=True)
+        dispatcher_thread.start()
+        self._sampling = True
+        sampler = threading.Thread(target=self._sample, daemon=True)
+        sampler.start()
+
+        self.controller.register(quest)
+        self._wait_for_state(quest.name, EventState.SCHEDULED, 10)
+        qevent = self.controller._quests[quest.name]
+        qevent_id = qevent.annotations["qevent_id"]
+
+        started_at = time.monotonic()
+        joins = iter([(player, "start") for player in range(args.players)]
+                     + [(player, "register")
+                        for player in range(args.players)])
+
+        def join(player, command):
+            if command == "start":
+                self.request(player, "start", "start")
+            else:
+                # reply has no player specific content
+                self.request(player, "register", "register", qevent_id,
+                             named=False)
+
+        def join_next():
+            item = next(joins, None)
+            if item is not None:
+                join(*item)
+
+        join_until = started_at + 2 * args.players / args.join_rate
+        self._feed(args.join_rate, join_until, join_next)
+        # arrivals are random, so some of them may be left
+        for player, command in joins:
+            join(player, command)
+
+        self._wait_for_state(quest.name, EventState.RUNNING,
+                             (quest.start_date - datetime.now())
+                             .total_seconds() + 10)
+        play_started_at = time.monotonic()
+        players = range(args.players)
+        self._feed(args.rate, play_started_at + args.duration,
+                   lambda: self._play(random.choice(players)))
+        feed_finished_at = time.monotonic()
+
+        # wait until all updates are handled and team mailboxes and
+        # broadcast scheduler have nothing more to send
+        deadline = feed_finished_at + args.drain
+        sent = -1
+        while time.monotonic() < deadline:
+            if (len(self._handled_at) == len(self._requests)
+                    and self.controller.scheduler.pending == 0
+                    and self.bot.count == sent):
+                break
+            sent = self.bot.count
+            time.sleep(0.2)
+
+        self._sampling = False
+        self.dispatcher.stop()
+        self.controller.shutdown()
+        self.storage.close()
+        return self.report(started_at, play_started_at, feed_finished_at)
+
+    def _replies(self):
+        """
+        returns dict of chat_id => (sorted timestamps, texts)
+        """
+
+        by_chat = {}
+        for sent_at, chat_id, text in sorted(self.bot.sent,
+                                             key=lambda item: item[0]):
+            times, texts = by_chat.setdefault(chat_id, ([], []))
+            times.append(sent_at)
+            texts.append(text)
+        return by_chat
+
+    def _reply_at(self, request, replies):
+        times, texts = replies.get(request["chat_id"], ((), ()))
+        token = request["token"]
+        start = bisect.bisect_left(times, request["arrived_at"])
+        for index in range(start, len(times)):
+            text = texts[index]
+            if request["name"] is not None and request["name"] not in text:
+                continue
+            if token is not None and token not in text:
+                continue
+            if token is None and request["kind"] == "hint" \
+                    and ANSWER_TOKEN.search(text):
+                continue
+            return times[index]
+        return None
+
+    def report(self, started_at, play_started_at, feed_finished_at):
+        replies = self._replies()
+        latencies = {}
+        unanswered = {}
+        for update_id, request in self._requests.items():
+            kind = request["kind"]
+            reply_at = self._reply_at(request, replies)
+            if reply_at is None:
+                unanswered[kind] = unanswered.get(kind, 0) + 1
+                continue
+            latencies.setdefault(kind, []).append(
+                reply_at - request["arrived_at"])
+
+        report = {"latency": {}, "unanswered": unanswered}
+        all_latencies = []
+        for kind, values in latencies.items():
+            values.sort()
+            all_latencies.extend(values)
+            report["latency"][kind] = self._summary(values)
+        all_latencies.sort()
+        report["latency"]["all"] = self._summary(all_latencies)
+
+        sent_times = sorted(sent_at for sent_at, _, _ in self.bot.sent)
+        play_sent = [sent_at for sent_at in sent_times
+                     if sent_at >= play_started_at]
+        per_second = {}
+        for sent_at in sent_times:
+            second = int(sent_at - started_at)
+            per_second[second] = per_second.get(second, 0) + 1
+        elapsed = (play_sent[-1] - play_started_at) if play_sent else 0
+
+        report.update({
+            "requests": len(self._requests),
+            "messages": len(sent_times),
+            "messages_per_second": (len(play_sent) / elapsed
+                                    if elapsed else 0),
+            "peak_messages_per_second": max(per_second.values(), default=0),
+            "peak_inbound_queue": self.peak_inbound,
+            "peak_outbound_queue": self.peak_outbound,
+            "drained_in": (sent_times[-1] - feed_finished_at
+                           if sent_times else 0),
+        })
+        return report
+
+    def _summary(self, values):
+        summary = {"count": len(values)}
+        for share in PERCENTILES:
+            summary[f"p{share}"] = percentile(values, share)
+        summary["max"] = values[-1] if values else None
+        return summary
+
+
+def print_report(report):
+    print(f"{'kind':<10} {'count':>7} "
+          + " ".join(f"{f'p{share}':>9}" for share in PERCENTILES)
+          + f" {'max':>9}  (latency, ms)")
+    for kind, summary in report["latency"].items():
+        print(f"{kind:<10} {summary['count']:>7} "
+              + " ".join(f"{(summary[f'p{share}'] or 0) * 1e3:9.1f}"
+                         for share in PERCENTILES)
+              + f" {(summary['max'] or 0) * 1e3:9.1f}")
+
+    unanswered = ", ".join(f"{count} {kind}" for kind, count
+                           in report["unanswered"].items()) or "none"
+    print(f"requests:             {report['requests']}")
+    print(f"unanswered:           {unanswered}")
+    print(f"messages sent:        {report['messages']}")
+    print(f"messages per second:  {report['messages_per_second']:.1f} "
+          f"(peak {report['peak_messages_per_second']})")
+    print(f"peak inbound queue:   {report['peak_inbound_queue']}")
+    print(f"peak outbound queue:  {report['peak_outbound_queue']}")
+    print(f"drained in:           {report['drained_in']:.2f}s")
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    args.add_argument("--players", type=int, default=1000)
+    args.add_argument("--teams", type=int, default=10)
+    args.add_argument("--tasks", type=int, default=100)
+    args.add_argument("--join-rate", type=float, default=500,
+                      help="/start and /register updates per second")
+    args.add_argument("--rate", type=float, default=100,
+                      help="/answer and /hint updates per second")
+    args.add_argument("--duration", type=float, default=10,
+                      help="seconds of answers and hints")
+    args.add_argument("--correct", type=float, default=0.2,
+                      help="share of correct answers")
+    args.add_argument("--hint", type=float, default=0.1,
+                      help="share of /hint updates")
+    args.add_argument("--drain", type=float, default=30,
+                      help="max seconds to wait for queued messages")
+    args.add_argument("--storage", default="sqlite",
+                      help="storage engine, see questbot.storage")
+    args.add_argument("--global-rate", type=float,
+                      default=BroadcastScheduler.GLOBAL_RATE)
+    args.add_argument("--chat-rate", type=float,
+                      default=BroadcastScheduler.CHAT_RATE)
+    args.add_argument("--chat-burst", type=float,
+                      default=BroadcastScheduler.CHAT_BURST)
+    args.add_argument("--seed", type=int, default=1)
+    args.add_argument("--output", help="write report to JSON file")
+    args = args.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    random.seed(args.seed)
+    BroadcastScheduler.GLOBAL_RATE = args.global_rate
+    BroadcastScheduler.CHAT_RATE = args.chat_rate
+    BroadcastScheduler.CHAT_BURST = args.chat_burst
+
+    with tempfile.TemporaryDirectory() as directory:
+        simulator = Simulator(args, os.path.join(directory, "users"))
+        report = simulator.run()
+
+    report["args"] = vars(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,373 @@
+"""
+measures hot paths of the bot in isolation with a fake bot and
+compares the results with a committed baseline
+
+run from repository root:
+    PYTHONPATH=src python benchmarks/suite.py
+    PYTHONPATH=src python benchmarks/suite.py --only storage
+    PYTHONPATH=src python benchmarks/suite.py --update-baseline
+
+every benchmark reports seconds per operation (best of several runs),
+results are written to benchmarks/results.json; the run fails with exit
+code 1 if some result is slower than baseline by more than the threshold
+
+baseline and results are both the best of the same number of runs,
+so they can be compared directly; never record baseline with other
+REPEAT values than the ones it's checked with
+
+NOTE: baseline is only meaningful for the machine it was recorded on,
+record it again with --update-baseline when the hardware changes
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import random
+import string
+import logging
+import argparse
+import platform
+import tempfile
+from datetime import datetime, timedelta
+
+from fakes import FakeBot, make_dispatcher
+
+from questbot.users import User
+from questbot.events import QuestEvent, EventDistributor
+from questbot.storage import DataStorage
+from questbot.gamelog import GameLog, GameReplay, GameEvent
+from questbot.parsers import QuestParser
+from questbot.controllers import QuestController, TeamController
+from questbot.definitions import (
+    QuestDefinition,
+    TeamDefinition,
+    TaskDefinition
+)
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+RESULTS_FILE = os.path.join(BENCH_DIR, "results.json")
+THRESHOLD = 0.5  # allowed slowdown against baseline, 0.5 = 50% slower
+REPEAT = 5          # runs of a benchmark, the best one is taken
+SLOW_REPEAT = 3     # runs of benchmarks that take seconds
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    """
+    registers fn() as a benchmark,
+    fn() returns dict of result name => seconds per operation
+    """
+
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def measure(stmt, number, repeat=REPEAT):
+    """
+    returns seconds of a single stmt() call (best of repeat runs)
+    """
+
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+def random_text(length):
+    return "".join(random.choices(string.ascii_lowercase + " ", k=length))
+
+
+def make_users(count, dispatcher, offset=0):
+    users = []
+    for user_id in range(offset, offset + count):
+        user = User(user_id, user_id, dispatcher)
+        user.name = f"player{user_id}"
+        user.lang_code = "ru"
+        users.append(user)
+    return users
+
+
+def make_team(name, tasks):
+    return TeamDefinition(
+        name, random_text(200), "https://t.me/+team",
+        [TaskDefinition(random_text(80), (f"answer{idx}", f"alt{idx}"),
+                        (random_text(60), random_text(60)))
+         for idx in range(tasks)])
+
+
+@benchmark
+def parser_process():
+    """
+    QuestParser.process() on generated quest files
+    """
+
+    results = {}
+    parser = QuestParser()
+    with tempfile.TemporaryDirectory() as directory:
+        for teams, tasks in ((10, 100), (20, 500)):
+            filepath = os.path.join(directory, f"quest_{teams}x{tasks}.yml")
+            with open(filepath, "w") as file:
+                file.write(f"name: quest\ndescription: {random_text(200)}\n"
+                           "start_date: 2030-01-01 12:00\nduration: 2h\n"
+                           "teams:\n")
+                for team in range(teams):
+                    file.write(f"  - name: team{team}\n"
+                               f"    description: {random_text(200)}\n"
+                               "    communication: https://t.me/+team\n"
+                               "    tasks:\n")
+                    for task in range(tasks):
+                        file.write(f"      - question: {random_text(80)}\n"
+                                   f"        answer: answer{task}\n"
+                                   "        hints:\n"
+                                   f"          - {random_text(60)}\n"
+                                   f"          - {random_text(60)}\n")
+
+            assert parser.process(filepath) is not None
+            results[f"parser.process[{teams}x{tasks}]"] = measure(
+                lambda: parser.process(filepath), number=1,
+                repeat=SLOW_REPEAT)
+    return results
+
+
+@benchmark
+def team_check_answer():
+    """
+    TeamController.check_answer() for a team of 5 players
+    """
+
+    dispatcher = make_dispatcher(FakeBot(record=False))
+    team = make_team("team", 10000)
+    qevent = QuestEvent(QuestDefinition("quest", "", datetime.now(),
+                                        teams=[team]))
+    tc = TeamController(team)
+    qevent.register_team_controller(tc)
+    users = make_users(5, dispatcher)
+    for user in users:
+        tc.distributor.subscribe(user)
+    tc.start().result()
+
+    results = {}
+    number = 2000
+    results["team.check_answer[wrong]"] = measure(
+        lambda: tc.check_answer(users[0], "wrong answer").result(), number)
+
+    answers = iter(f"answer{idx}" for idx in range(1, 10000))
+    results["team.check_answer[correct]"] = measure(
+        lambda: tc.check_answer(users[1], next(answers)).result(),
+        number, repeat=SLOW_REPEAT)
+    return results
+
+
+@benchmark
+def distributor_notify_template():
+    """
+    EventDistributor.notify_template() fan-out to N users
+    """
+
+    results = {}
+    dispatcher = make_dispatcher(FakeBot(record=False))
+    for count in (100, 1000, 10000):
+        distributor = EventDistributor()
+        distributor.subscribe_many(make_users(count, dispatcher))
+        results[f"distributor.notify_template[{count}]"] = measure(
+            lambda: distributor.notify_template("quest_wrong_answer",
+                                                username="player",
+                                                answer="wrong answer"),
+            number=max(1, 10000 // count))
+    return results
+
+
+@benchmark
+def storage_save_load():
+    """
+    DataStorage.save() and DataStorage.load() of N user records
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for count in (10000, 100000, 1000000):
+            data = {user_id: {"name": f"player{user_id}",
+                              "user_id": user_id,
+                              "chat_id": user_id,
+                              "lang_code": "ru"}
+                    for user_id in range(count)}
+            storage = DataStorage(os.path.join(directory, f"users{count}"))
+            repeat = SLOW_REPEAT if count < 1000000 else 1
+            results[f"storage.save[{count}]"] = measure(
+                lambda: storage.save(data), number=1, repeat=repeat)
+            results[f"storage.load[{count}]"] = measure(
+                storage.load, number=1, repeat=repeat)
+            assert len(storage.load()) == count
+    return results
+
+
+@benchmark
+def quest_controller_update():
+    """
+    a single updater tick of QuestController with N due quest events
+    """
+
+    results = {}
+    start_date = datetime.now() + timedelta(days=1)
+    for count in (100, 1000, 10000):
+        # ticks are driven from here, not by updater thread
+        controller = QuestController(updater=False)
+        for idx in range(count):
+            controller.register(QuestDefinition(
+                f"quest{idx}", "", start_date,
+                teams=[make_team("team", 1)]))
+        controller.tick()
+
+        # all quest events are due again, the same as after
+        # a long sleep of the updater
+        results[f"controller.update[{count}]"] = measure(
+            lambda: controller.tick(all_events=True), number=1)
+        controller.shutdown()
+    return results
+
+
+@benchmark
+def quest_controller_sessions():
+    """
+    QuestController.register() of a quest definition with N sessions
+    """
+
+    results = {}
+    start_date = datetime.now() + timedelta(days=1)
+    for count in (100, 1000):
+        quest = QuestDefinition("quest", "", start_date,
+                                teams=[make_team(f"team{idx}", 1)
+                                       for idx in range(4)],
+                                sessions=count)
+
+        def register():
+            controller = QuestController(updater=False)
+            started_at = time.perf_counter()
+            controller.register(quest)
+            elapsed = time.perf_counter() - started_at
+            controller.shutdown()
+            return elapsed
+
+        results[f"controller.register_sessions[{count}]"] = min(
+            register() for _ in range(REPEAT))
+    return results
+
+
+@benchmark
+def gamelog_append_replay():
+    """
+    GameLog.append() of a gameplay event and GameReplay.replay()
+    of a log with N events
+    """
+
+    results = {}
+    now = datetime.now()
+    with tempfile.TemporaryDirectory() as directory:
+        game_log = GameLog(directory)
+        players = iter(range(10 ** 9))
+        results["gamelog.append"] = measure(
+            lambda: game_log.append(GameEvent.ANSWER_WRONG, "quest",
+                                    "team", next(players), "wrong answer"),
+            number=10000)
+
+        count = 100000
+        for idx in range(count // 4):
+            team = f"team{idx % 100}"
+            game_log.append(GameEvent.TASK_STARTED, "quest", team, idx,
+                            at=now)
+            game_log.append(GameEvent.ANSWER_WRONG, "quest", team, idx,
+                            "wrong answer")
+            game_log.append(GameEvent.HINT_TAKEN, "quest", team, idx, 0)
+            game_log.append(GameEvent.ANSWER_RIGHT, "quest", team, idx,
+                            "answer", at=now)
+        game_log.close()
+        results[f"gamelog.replay[{count}]"] = measure(
+            lambda: GameReplay().replay(directory), number=1,
+            repeat=SLOW_REPEAT)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    prints results against baseline
+    returns list of names of regressed results
+    """
+
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<42} {value * 1e3:12.4f} ms   (new)")
+            continue
+
+        ratio = value / base if base else float("inf")
+        status = "ok"
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        print(f"{name:<42} {value * 1e3:12.4f} ms  "
+              f"{base * 1e3:12.4f} ms  {ratio:6.2f}x  {status}")
+    return regressions
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    args.add_argument("--only", default="",
+                      help="run benchmarks whose name contains this value")
+    args.add_argument("--threshold", type=float, default=THRESHOLD,
+                      help="allowed slowdown against baseline "
+                           "(0.5 = 50%% slower)")
+    args.add_argument("--baseline", default=BASELINE_FILE)
+    args.add_argument("--output", default=RESULTS_FILE)
+    args.add_argument("--update-baseline", action="store_true",
+                      help="store results as a new baseline")
+    args = args.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    random.seed(1)
+
+    results = {}
+    for fn in BENCHMARKS:
+        if args.only in fn.__name__:
+            print(f"running {fn.__name__}...", file=sys.stderr)
+            results.update(fn())
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)["results"]
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "unit": "seconds per operation",
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        baseline.update(results)
+        report["results"] = baseline
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+        print(f"baseline is stored in '{args.baseline}'")
+        return 0
+
+    if not baseline:
+        print(f"there's no baseline '{args.baseline}', "
+              "use --update-baseline to record it")
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} results are slower than baseline "
+              f"by more than {args.threshold:.0%}: "
+              + ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,15 +7,24 @@ import logging
 
 import yaml
 from urllib import request, error
-from difflib import SequenceMatcher
 
 from jinja2 import Environment, BaseLoader
 from telegram.ext import Updater
 
+from questbot.cache import QuestCache
 from questbot.parsers import QuestParser
+from questbot.watchers import QuestWatcher
+from questbot.events import EventIdMapper
 from questbot.controllers import QuestController
 from questbot.users import User
+from questbot.storage import create_storage
+from questbot.broadcast import BroadcastScheduler
+from questbot.snapshots import SnapshotStore, Snapshotter
+from questbot.gamelog import GameLog, GameReplay
+from questbot.shards import ShardedQuestController
+from questbot import metrics
 from questbot.telegram.controllers import UserController
+from questbot.telegram.webhook import WebhookServer
 
 
 logging.basicConfig(
@@ -24,25 +33,127 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# connections used by telegram.ext.Updater itself: its workers + 4
+UPDATER_CONNECTIONS = 8
+
 
 if __name__ == "__main__":
     bot_api_key = os.environ.get("BOT_API_KEY", None)
     storage_path = os.environ.get("STORAGE_PATH", "./data.pkl")
+    storage_engine = os.environ.get("STORAGE_ENGINE") or "pickle"
+    event_id_length = int(os.environ.get("QEVENT_ID_LENGTH") or
+                          EventIdMapper.ID_LENGTH)
+    deferred_assignment = os.environ.get("TEAM_ASSIGNMENT") == "deferred"
+    reload_interval = float(os.environ.get("QUESTS_RELOAD_INTERVAL") or
+                            QuestWatcher.INTERVAL)
+    metrics_port = int(os.environ.get("METRICS_PORT") or 0)
+    send_workers = int(os.environ.get("SEND_WORKERS") or
+                       BroadcastScheduler.WORKERS)
+    handler_workers = int(os.environ.get("HANDLER_WORKERS") or
+                          UserController.HANDLER_WORKERS)
+    snapshot_path = os.environ.get("SNAPSHOT_PATH") or "./snapshots"
+    snapshot_interval = float(os.environ.get("SNAPSHOT_INTERVAL") or
+                              Snapshotter.INTERVAL)
+    game_log_path = os.environ.get("GAMELOG_PATH") or None
+    shards = int(os.environ.get("SHARDS") or 0)
+    updates_mode = os.environ.get("UPDATES_MODE") or "polling"
+    webhook_url = os.environ.get("WEBHOOK_URL")
+    webhook_port = int(os.environ.get("WEBHOOK_PORT") or 8080)
+    webhook_path = os.environ.get("WEBHOOK_PATH") or "/webhook"
+    webhook_secret = os.environ.get("WEBHOOK_SECRET") or None
+    webhook_workers = int(os.environ.get("WEBHOOK_WORKERS") or
+                          WebhookServer.WORKERS)
     if bot_api_key is None:
         logger.error("specify BOT_API_KEY variable")
         sys.exit(1)
+    if updates_mode not in ("polling", "webhook"):
+        logger.error("UPDATES_MODE must be either 'polling' or 'webhook'")
+        sys.exit(1)
 
+    storage = create_storage(storage_engine, storage_path)
     parser = QuestParser()
-    quest_controller = QuestController()
-    quests = [parser.process(item) for item in parser.list('./quests')]
-    is_registered = all([quest_controller.register(quest) for quest in quests])
-    if not is_registered:
-        logger.warning("Duplicated quest names are found, be sure "
+    snapshot_store = None
+    game_log = None
+    if shards > 0:
+        # every shard restores its quest events and writes its own game log
+        quest_controller = ShardedQuestController(
+            shards, storage, event_id_length, deferred_assignment,
+            send_workers, snapshot_path, snapshot_interval, game_log_path)
+    else:
+        restored_state = None
+        if snapshot_interval > 0:
+            snapshot_store = SnapshotStore(snapshot_path)
+            restored_state = snapshot_store.load()
+        if game_log_path:
+            # game log is written more often than snapshots,
+            # so it has more recent state of quest events
+            if os.path.isdir(game_log_path):
+                replay = GameReplay()
+                started_at = time.perf_counter()
+                count = replay.replay(game_log_path)
+                logger.info(f"Replayed {count} game events in "
+                            f"{time.perf_counter() - started_at:.3f}s")
+                if count:
+                    restored_state = replay.snapshot(
+                        restored_state and restored_state["controller"])
+                # the next start replays only segments written after it
+                replay.checkpoint(game_log_path)
+            game_log = GameLog(game_log_path)
+        quest_controller = QuestController(
+            storage, event_id_length, deferred_assignment, send_workers,
+            restored_state, game_log)
+    cache = QuestCache(os.path.join('./quests', QuestCache.FILENAME))
+    watcher = QuestWatcher('./quests', parser, quest_controller, cache,
+                           reload_interval)
+    if watcher.reload()["skipped"]:
+        logger.warning("Some quests are not registered, be sure "
                        "quest configs have no errors and duplicates.")
+    if reload_interval > 0:
+        watcher.start()
+
+    if metrics_port:
+        metrics.ACTIVE_QUESTS.set_function(
+            lambda: quest_controller.get_stats()["quests"])
+        metrics.ACTIVE_TEAMS.set_function(
+            lambda: quest_controller.get_stats()["teams"])
+        metrics.ACTIVE_PLAYERS.set_function(
+            lambda: quest_controller.get_stats()["players"])
+        metrics.OUTBOX_PENDING.set_function(
+            lambda: quest_controller.scheduler.pending)
+        metrics.MetricsServer(metrics.REGISTRY, metrics_port).start()
 
-    updater = Updater(bot_api_key)
+    # every send worker keeps a request in flight
+    updater = Updater(bot_api_key, request_kwargs={
+        "con_pool_size": send_workers + UPDATER_CONNECTIONS})
     dispatcher = updater.dispatcher
-    
-    user_controller = UserController(dispatcher, quest_controller, storage_path)    
-    updater.start_polling()
-    updater.idle()
\ No newline at end of file
+
+    user_controller = UserController(dispatcher, quest_controller, storage,
+                                     handler_workers)
+    snapshotter = None
+    if snapshot_store is not None:
+        # users are linked to restored teams, state can be saved
+        snapshotter = Snapshotter(quest_controller, snapshot_store,
+                                  snapshot_interval)
+        snapshotter.start()
+
+    if updates_mode == "webhook":
+        webhook = WebhookServer(dispatcher, webhook_port,
+                                path=webhook_path,
+                                secret_token=webhook_secret,
+                                workers=webhook_workers)
+        webhook.start()
+        if webhook_url:
+            updater.bot.set_webhook(webhook_url,
+                                    max_connections=webhook_workers,
+                                    secret_token=webhook_secret)
+        webhook.idle()
+    else:
+        updater.start_polling()
+        updater.idle()
+    user_controller.shutdown()
+    if snapshotter is not None:
+        snapshotter.stop()
+    quest_controller.shutdown()
+    if game_log is not None:
+        game_log.close()
+    storage.close()
\ No newline at end of file
@@ -0,0 +1,145 @@
+import logging
+import functools
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+logger = logging.getLogger(__name__)
+
+
+class Mailbox():
+    """
+    runs submitted commands strictly one at a time in submission order
+
+    commands of different mailboxes run in parallel on a shared executor,
+    without an executor commands run in the thread that submitted them;
+    on_idle() is called every time the queue runs empty
+    """
+    THROUGHPUT = 16  # commands processed before yielding the worker
+
+    def __init__(self, executor=None, on_idle=None):
+        self._executor = executor
+        self._on_idle = on_idle
+        self._commands = deque()
+        self._lock = threading.Lock()
+        self._is_scheduled = False
+
+    @property
+    def is_idle(self):
+        with self._lock:
+            return not self._is_scheduled
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        queues fn(*args, **kwargs) for execution
+        returns concurrent.futures.Future with its result
+        raises RuntimeError if the executor is shut down
+        """
+
+        future = Future()
+        with self._lock:
+            self._commands.append((future, fn, args, kwargs))
+            if self._is_scheduled:
+                return future
+            self._is_scheduled = True
+
+        if self._executor is None:
+            while self._drain():
+                pass
+            return future
+        try:
+            self._executor.submit(self._run)
+        except RuntimeError as exc:
+            # the executor is shut down, queued commands never run
+            with self._lock:
+                commands, self._commands = self._commands, deque()
+                self._is_scheduled = False
+            for command in commands:
+                command[0].set_exception(exc)
+            raise
+        return future
+
+    def _run(self):
+        if not self._drain():
+            return
+        try:
+            # let other mailboxes use the worker
+            self._executor.submit(self._run)
+        except RuntimeError:
+            # the executor is shutting down, queued commands
+            # are processed by this worker
+            while self._drain():
+                pass
+
+    def _drain(self):
+        """
+        processes queued commands, only one thread drains at a time
+        returns True if some commands are left in the queue
+        returns False if the queue is empty
+        """
+
+        for _ in range(self.THROUGHPUT):
+            with self._lock:
+                if not self._commands:
+                    self._is_scheduled = False
+                    break
+                future, fn, args, kwargs = self._commands.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as exc:
+                logger.exception(f"Command {fn.__name__} has failed")
+                future.set_exception(exc)
+        else:
+            return True
+
+        if self._on_idle is not None:
+            self._on_idle()
+        return False
+
+
+class KeyedExecutor():
+    """
+    runs submitted commands of the same key one at a time in submission
+    order, commands of different keys run in parallel on a shared executor
+
+    every key has its own Mailbox while it has commands,
+    so keys can be short-lived (e.g. chat identifiers)
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._mailboxes = {}    # key => Mailbox, present if not idle
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._mailboxes)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        queues fn(*args, **kwargs) for execution after commands of key
+        returns concurrent.futures.Future with its result
+        raises RuntimeError if the executor is shut down
+        """
+
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                mailbox = Mailbox(self._executor,
+                                  functools.partial(self._release, key))
+            future = mailbox.submit(fn, *args, **kwargs)
+            self._mailboxes[key] = mailbox
+        return future
+
+    def _release(self, key):
+        """
+        forgets mailbox of key if it has no commands
+        """
+
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is not None and mailbox.is_idle:
+                del self._mailboxes[key]
@@ -0,0 +1,381 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+
+from questbot.metrics import OUTBOX_DROPPED
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket():
+    """
+    classic token bucket: holds up to <capacity> tokens
+    and refills them with <rate> tokens per second
+    """
+
+    def __init__(self, rate, capacity):
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._updated_at)
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+        self._updated_at = now
+
+    def wait_time(self, now=None):
+        """
+        returns number of seconds to wait until a token is available
+        returns 0 if a token can be taken right now
+        """
+
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def consume(self, now=None):
+        """
+        takes one token from the bucket
+        returns True if the token has been taken
+        returns False if the bucket is empty
+        """
+
+        if self.wait_time(now):
+            return False
+        self._tokens -= 1
+        return True
+
+    def is_idle(self, now=None):
+        """
+        returns True if the bucket is full, i.e. can be dropped
+        without changing the rate limiting behaviour
+        """
+
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return self._tokens >= self._capacity
+
+
+class Broadcast():
+    """
+    handle of a submitted broadcast, reports delivery progress
+    """
+
+    def __init__(self, total):
+        self._total = total
+        self._sent = 0
+        self._failed = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started_at = time.monotonic()
+        self._completed_at = None
+        if total == 0:
+            self._complete()
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def sent(self):
+        return self._sent
+
+    @property
+    def failed(self):
+        return self._failed
+
+    @property
+    def progress(self):
+        """
+        returns a share of processed deliveries in range [0, 1]
+        """
+
+        if self._total == 0:
+            return 1.0
+        return (self._sent + self._failed) / self._total
+
+    @property
+    def is_completed(self):
+        return self._done.is_set()
+
+    @property
+    def completed_at(self):
+        """
+        returns time.monotonic() timestamp of completion or None
+        """
+
+        return self._completed_at
+
+    @property
+    def duration(self):
+        """
+        returns seconds spent on the broadcast so far
+        """
+
+        finished_at = self._completed_at or time.monotonic()
+        return finished_at - self._started_at
+
+    def wait(self, timeout=None):
+        """
+        blocks until all deliveries are processed
+        returns True if the broadcast is completed
+        """
+
+        return self._done.wait(timeout)
+
+    def _complete(self):
+        self._completed_at = time.monotonic()
+        self._done.set()
+
+    def _record(self, is_success, count=1):
+        with self._lock:
+            if is_success:
+                self._sent += count
+            else:
+                self._failed += count
+            if self._sent + self._failed == self._total:
+                self._complete()
+
+
+class BroadcastScheduler():
+    """
+    queues message deliveries and drains them through global and per-chat
+    token buckets (Telegram limits) on a pool of worker threads
+
+    every chat has its own FIFO queue with at most one delivery in flight,
+    the next message of a chat is sent only after the previous send is
+    finished, so messages of a chat arrive in order of submission while
+    different chats are sent in parallel
+
+    the queue is bounded: submit() never blocks, deliveries that don't fit
+    (retries included) are dropped and counted as failed; the number of
+    workers is the number of requests in flight, so it must not exceed
+    the size of the bot HTTP connection pool
+
+    deliveries that are queued on shutdown() or submitted after it
+    are counted as failed, so their broadcasts are completed
+    """
+    GLOBAL_RATE = 30        # messages per second for the whole bot
+    CHAT_RATE = 1           # messages per second for a single chat
+    CHAT_BURST = 3          # messages sent to a chat without waiting
+    WORKERS = 8
+    MAX_RETRIES = 3
+    PRUNE_INTERVAL = 60     # in seconds
+    MAX_PENDING = 100000    # queued deliveries
+
+    def __init__(self, workers=None, max_pending=None):
+        self._workers = workers or self.WORKERS
+        self._max_pending = max_pending or self.MAX_PENDING
+        self._global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._chats = {}        # chat_id => deque of queued deliveries
+        self._in_flight = set()  # chat_id of deliveries handed to workers
+        self._pending = 0
+        # heap of (not_before, seq, chat_id) of chats that can send
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._pruned_at = time.monotonic()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._workers,
+            thread_name_prefix="broadcast")
+
+        self._is_active = True
+        self._scheduler = threading.Thread(target=self._run, daemon=True)
+        self._scheduler.start()
+
+    @property
+    def pending(self):
+        """
+        number of queued deliveries that are not handed to workers yet
+        """
+
+        return self._pending
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def submit(self, deliveries):
+        """
+        accepts args:
+            deliveries - iterable of (user, message) pairs
+        queues deliveries and returns Broadcast handle
+        """
+
+        deliveries = list(deliveries)
+        broadcast = Broadcast(len(deliveries))
+        with self._cond:
+            now = time.monotonic()
+            accepted = 0
+            if self._is_active:
+                accepted = max(0, min(len(deliveries),
+                                      self._max_pending - self._pending))
+            for user, message in deliveries[:accepted]:
+                self._append(now, (broadcast, user, message, 0))
+            self._pending += accepted
+            self._cond.notify()
+
+        dropped = len(deliveries) - accepted
+        if dropped:
+            logger.warning(f"Outbox is full or shut down, dropped {dropped} "
+                           f"of {broadcast.total} messages")
+            OUTBOX_DROPPED.inc(dropped)
+            broadcast._record(False, dropped)
+
+        logger.debug(f"Queued a broadcast of {broadcast.total} messages")
+        return broadcast
+
+    def shutdown(self):
+        """
+        stops scheduling new deliveries, queued deliveries are
+        counted as failed, deliveries in flight are finished
+        """
+
+        with self._cond:
+            self._is_active = False
+            chats, self._chats = self._chats, {}
+            self._queue = []
+            self._pending = 0
+            self._cond.notify()
+        self._executor.shutdown(wait=False)
+
+        dropped = 0
+        for deliveries in chats.values():
+            for broadcast, _, _, _ in deliveries:
+                broadcast._record(False)
+            dropped += len(deliveries)
+        if dropped:
+            logger.warning(f"Dropped {dropped} queued messages on shutdown")
+            OUTBOX_DROPPED.inc(dropped)
+
+    def _push(self, not_before, chat_id):
+        heapq.heappush(self._queue, (not_before, next(self._counter), chat_id))
+
+    def _append(self, now, delivery):
+        """
+        queues delivery to its chat, must be called holding self._cond
+        """
+
+        chat_id = delivery[1].chat_id
+        deliveries = self._chats.get(chat_id)
+        if deliveries is None:
+            deliveries = self._chats[chat_id] = deque()
+            if chat_id not in self._in_flight:
+                self._push(now, chat_id)
+        deliveries.append(delivery)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.CHAT_RATE, self.CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_chat_buckets(self, now):
+        if now - self._pruned_at < self.PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        self._chat_buckets = {chat_id: bucket
+                              for chat_id, bucket in self._chat_buckets.items()
+                              if not bucket.is_idle(now)}
+
+    def _run(self):
+        """
+        pops chats that are due and hands the first delivery of every
+        chat to the worker pool while respecting both rate limits
+        """
+
+        with self._cond:
+            while self._is_active:
+                now = time.monotonic()
+                self._prune_chat_buckets(now)
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+
+                not_before, _, chat_id = self._queue[0]
+                if not_before > now:
+                    self._cond.wait(not_before - now)
+                    continue
+
+                chat_bucket = self._chat_bucket(chat_id)
+                chat_delay = chat_bucket.wait_time(now)
+                if chat_delay:
+                    heapq.heappop(self._queue)
+                    self._push(now + chat_delay, chat_id)
+                    continue
+
+                global_delay = self._global_bucket.wait_time(now)
+                if global_delay:
+                    self._cond.wait(global_delay)
+                    continue
+
+                heapq.heappop(self._queue)
+                chat_bucket.consume(now)
+                self._global_bucket.consume(now)
+                deliveries = self._chats[chat_id]
+                delivery = deliveries.popleft()
+                if not deliveries:
+                    del self._chats[chat_id]
+                self._pending -= 1
+                self._in_flight.add(chat_id)
+                self._executor.submit(self._deliver, delivery)
+
+    def _finish(self, chat_id, retry=None, not_before=None):
+        """
+        lets the next delivery of the chat be sent, retry delivery
+        is sent before other deliveries of the chat not before
+        not_before; retry is dropped if the queue is full or
+        the scheduler is shut down
+        """
+
+        with self._cond:
+            self._in_flight.discard(chat_id)
+            if retry is not None and (self._is_active and self._pending
+                                      < self._max_pending):
+                self._chats.setdefault(chat_id, deque()).appendleft(retry)
+                self._pending += 1
+                retry = None
+            if chat_id in self._chats:
+                self._push(not_before or time.monotonic(), chat_id)
+            self._cond.notify()
+
+        if retry is not None:
+            logger.warning(f"Outbox is full or shut down, dropped a retry "
+                           f"of a message to chat_id={chat_id}")
+            OUTBOX_DROPPED.inc()
+            retry[0]._record(False)
+
+    def _deliver(self, delivery):
+        broadcast, user, message, attempt = delivery
+        try:
+            user.send_message(message=message)
+        except RetryAfter as exc:
+            if attempt < self.MAX_RETRIES:
+                logger.warning(f"Telegram asked to retry after "
+                               f"{exc.retry_after}s for chat_id={user.chat_id}")
+                self._finish(user.chat_id,
+                             (broadcast, user, message, attempt + 1),
+                             time.monotonic() + exc.retry_after)
+                return
+            logger.error(f"Cannot deliver a message to chat_id={user.chat_id} "
+                         f"after {attempt} retries")
+            broadcast._record(False)
+        except Exception:
+            logger.exception(f"Cannot deliver a message to "
+                             f"chat_id={user.chat_id}")
+            broadcast._record(False)
+        else:
+            broadcast._record(True)
+        self._finish(user.chat_id)
@@ -0,0 +1,117 @@
+import os
+import pickle
+import hashlib
+import logging
+
+from questbot.schemas import schemav1
+
+
+logger = logging.getLogger(__name__)
+
+
+class QuestCache():
+    """
+    keeps already validated quest definition objects in a pickle file,
+    entries are keyed by file path and checked by mtime, size and
+    content hash, so unchanged quests skip yaml parsing and validation
+    """
+    VERSION = 1
+    FILENAME = ".questcache"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = {}
+        self._is_dirty = False
+        self._signature = (self.VERSION, hashlib.sha256(
+            repr(schemav1).encode()).hexdigest())
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as file:
+                signature, entries = pickle.load(file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Cannot read quest cache '{self.filename}', "
+                           f"it will be rebuilt: {str(e)}")
+            return
+
+        if signature != self._signature:
+            logger.info(f"Quest cache '{self.filename}' is outdated, "
+                        "it will be rebuilt")
+            return
+        self._entries = entries
+
+    @staticmethod
+    def digest(content):
+        """
+        returns digest of file content (bytes)
+        """
+
+        return hashlib.sha256(content).hexdigest()
+
+    def _digest(self, filepath):
+        with open(filepath, 'rb') as file:
+            return self.digest(file.read())
+
+    def lookup(self, filepath):
+        """
+        returns cached quest definition object for filepath
+        returns None if file is not cached or has been changed
+        """
+
+        entry = self._entries.get(filepath)
+        if entry is None:
+            return None
+
+        try:
+            stat = os.stat(filepath)
+            if (stat.st_mtime_ns, stat.st_size) == entry["stat"]:
+                return entry["definition"]
+            # file is touched, but it can still have the same content
+            if self._digest(filepath) == entry["digest"]:
+                entry["stat"] = (stat.st_mtime_ns, stat.st_size)
+                self._is_dirty = True
+                return entry["definition"]
+        except OSError:
+            pass
+        return None
+
+    def store(self, filepath, definition, stat, digest):
+        """
+        stores validated quest definition object for filepath,
+        stat (mtime_ns, size) and digest are of the content the
+        definition has been parsed from, stat is taken before the
+        file is read, so a file changed later is parsed again
+        """
+
+        self._entries[filepath] = {
+            "stat": stat,
+            "digest": digest,
+            "definition": definition
+        }
+        self._is_dirty = True
+
+    def save(self):
+        """
+        writes cache file if it has been changed,
+        entries of removed files are dropped
+        """
+
+        stale = [filepath for filepath in self._entries
+                 if not os.path.exists(filepath)]
+        for filepath in stale:
+            self._entries.pop(filepath)
+        if not self._is_dirty and not stale:
+            return
+
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            with open(tmp_filename, 'wb') as file:
+                pickle.dump((self._signature, self._entries), file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, self.filename)
+            self._is_dirty = False
+        except OSError:
+            logger.warning(f"Cannot write quest cache '{self.filename}'")
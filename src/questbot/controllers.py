@@ -1,17 +1,26 @@
 import time
+import heapq
 import logging
+import itertools
 import tabulate
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 from questbot.events import (
     QuestEvent,
+    QuestSeries,
     EventState,
     EventDistributor,
     EventIdMapper
 )
+from questbot.users import UserState
 from questbot.definitions import QuestDefinition, TeamDefinition
+from questbot.actors import Mailbox
 from questbot.results import EfficiencyController
+from questbot.broadcast import BroadcastScheduler
+from questbot.gamelog import GameEvent
+from questbot.metrics import TEAM_COMMAND_LATENCY, UPDATE_TICK_TIME
 
 logger = logging.getLogger(__name__)
 
@@ -20,25 +29,107 @@ class QuestController():
     """
     responsible for registering all configured quests
     and maintaining their statuses in relevant state
+
+    quest events are kept in a heap ordered by the time of their next
+    state transition, so updater sleeps until the nearest one is due
+
+    a quest definition runs as a series of quest events that share it:
+    <sessions> quest events for every start, a repeated quest gets quest
+    events of its next start when the previous start is scheduled and
+    forgets quest events that are finished; sessions of a start share
+    a single qevent_id (players join the session with the fewest
+    players), announcement and results of the start are sent once
+
+    if restored_state (see snapshot()) is set, registered quest events
+    take their states from it, but they're not updated until
+    relink_users() links their players back to teams
+
+    if game_log is set, joins, leaves and state transitions of quest
+    events are appended to it (see GameLog)
+
+    scheduler, distributor of quest-wide notifications and event_mapper
+    are created by controller unless they're set (see shards)
+
+    if updater is False, there's no updater thread and quest events
+    are updated only by tick() calls (benchmarks, tests)
     """
-    UPDATER_INTERVAL = 5
+    MAX_UPDATER_SLEEP = 60      # in seconds, guards against clock changes
     REGISTRATION_DURATION = 30  # in minutes
-
-    def __init__(self):
-        self._quests = {}
-        self._distributor = EventDistributor()
-        self._event_mapper = EventIdMapper()
+    TEAM_WORKERS = 8
+
+    # quest events in these states have no players and can be replaced
+    INACTIVE_STATES = (EventState.UNKNOWN, EventState.WAITING,
+                       EventState.FINISHED)
+    # state of a quest series is the first state of its quest events
+    SERIES_STATES = (EventState.RUNNING, EventState.SCHEDULED,
+                     EventState.WAITING, EventState.UNKNOWN,
+                     EventState.FINISHED)
+
+    def __init__(self, storage=None, event_id_length=None,
+                 deferred_assignment=False, send_workers=None,
+                 restored_state=None, game_log=None, scheduler=None,
+                 distributor=None, event_mapper=None, updater=True):
+        self._quests = {}       # quest event name => QuestEvent
+        self._series = {}       # quest name => QuestSeries
+        self._storage = storage
+        self._game_log = game_log
+        self._deferred_assignment = deferred_assignment
+        self._pending_users = {}    # user_id => QuestEvent
+        # (quest name, start_date) => [(points, team name, players)]
+        # of finished sessions of the start
+        self._start_winners = {}
+        self._membership_lock = threading.Lock()
+        self._scheduler = scheduler or BroadcastScheduler(send_workers)
+        self._distributor = distributor or EventDistributor(self._scheduler)
+        self._team_executor = ThreadPoolExecutor(
+            max_workers=self.TEAM_WORKERS,
+            thread_name_prefix="team")
+        self._event_mapper = event_mapper or EventIdMapper(event_id_length)
         self._reg_delta = timedelta(minutes=self.REGISTRATION_DURATION)
 
+        # quest name => {quest event name => quest event state}
+        self._restored_quests = {}
+        self._restored_members = {}     # user_id => (qevent, tc or None)
+        self._restored_events = []
+        if restored_state is not None:
+            # replayed game log has no controller state
+            controller_state = restored_state["controller"]
+            if (controller_state is not None
+                    and not self._event_mapper.restore(
+                        controller_state["event_mapper"])):
+                logger.warning("Snapshot has another qevent_id length "
+                               "or partition, qevent identifiers "
+                               "are not restored")
+            for name, state in restored_state["quests"].items():
+                # snapshots of older versions have no quest name
+                self._restored_quests.setdefault(
+                    state.get("quest", name), {})[name] = state
+
+        # heap of (transition_time, seq, qevent)
+        self._schedule = []
+        self._schedule_seq = itertools.count()
+        self._schedule_cond = threading.Condition()
+        # held while quest events change their states
+        self._update_lock = threading.Lock()
+
         # separate thread for quest state updates
         self._updater_active = True
-        self._updater = threading.Thread(target=self.update)
-        self._updater.start()
+        if updater:
+            self._updater = threading.Thread(target=self.update)
+            self._updater.start()
 
     @property
     def distributor(self):
         return self._distributor
 
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def event_id_length(self):
+        return self._event_mapper.id_length
+
     def register(self, quest_definition):
         """
         registers QuestDefinition object for controller updates
@@ -50,20 +141,302 @@ class QuestController():
             raise ValueError("quest_definition must be an instance of "
                              "QuestDefinition class")
 
-        if quest_definition.name in self._quests:
+        series = QuestSeries(quest_definition)
+        with self._schedule_cond:
+            if quest_definition.name in self._series:
+                return False
+            self._series[quest_definition.name] = series
+            restored = self._restored_quests.pop(quest_definition.name, {})
+
+        # quest events of restored starts are created again
+        starts = sorted({datetime.fromtimestamp(state["start_date"])
+                         for state in restored.values()
+                         if state["state"] != EventState.FINISHED.name})
+        if not starts or not series.is_repeated:
+            starts = [series.next_start(datetime.now())]
+        for start_date in starts:
+            if start_date is not None:
+                self._add_start(series, start_date, restored)
+        return True
+
+    def _add_start(self, series, start_date, restored=None):
+        """
+        creates quest events of all sessions of a quest start,
+        their states are taken from restored dict if they're there
+        """
+
+        restored = restored or {}
+        for session in range(1, series.quest.sessions + 1):
+            qevent = QuestEvent(series.quest, start_date,
+                                series.qevent_name(start_date, session),
+                                session)
+            for team_definition in series.quest.get_teams():
+                qevent.register_team_controller(
+                    TeamController(team_definition, self._scheduler,
+                                   self._team_executor, self._game_log))
+            qevent.shuffle_team_controllers()
+            logger.debug(f"Created quest event ['{qevent.name}'] with "
+                         f"{len(qevent.get_team_controllers())} teams")
+
+            state = restored.get(qevent.name)
+            is_restored = (state is not None
+                           and self._restore_quest(qevent, state))
+            with self._schedule_cond:
+                if self._series.get(series.quest.name) is not series:
+                    # quest has been unregistered meanwhile
+                    return
+                series.add(qevent)
+                self._quests[qevent.name] = qevent
+                if is_restored:
+                    self._restored_events.append(qevent)
+                else:
+                    self._schedule_update(qevent, datetime.now())
+
+    def _restore_quest(self, qevent, state):
+        """
+        applies quest state from snapshot to a new quest event
+        and keeps its players to be linked by relink_users()
+        returns False if snapshot is made for another quest definition
+        returns True if restored
+        """
+
+        teams = {tc.team.name: tc for tc in qevent.get_team_controllers()}
+        if (state["start_date"] != qevent.start_date.timestamp()
+                or state["duration"] != qevent.quest.duration.total_seconds()
+                or not {item["name"] for item in state["teams"]} <= set(teams)):
+            logger.warning(f"Snapshot of quest event ['{qevent.name}'] "
+                           "doesn't match its definition, it's skipped")
             return False
 
-        qevent = QuestEvent(quest_definition)
-        for team_definition in quest_definition.get_teams():
-            qevent.register_team_controller(TeamController(team_definition))
-            logger.debug(f"Registered a new team controller with "
-                         f"team_definition.name='{team_definition.name}' "
-                         f"for qevent.quest.name='{qevent.quest.name}'")
+        for team_state in state["teams"]:
+            team_controller = teams[team_state["name"]]
+            team_controller.restore(team_state).result()
+            for user_id in team_state["members"]:
+                self._restored_members[user_id] = (qevent, team_controller)
+        for user_id in state["pending_users"]:
+            self._restored_members[user_id] = (qevent, None)
+
+        qevent.state = EventState[state["state"]]
+        qevent_id = state["qevent_id"]
+        if (qevent_id is not None and qevent.state == EventState.SCHEDULED
+                and self._event_mapper.restore_event(qevent_id, qevent)):
+            qevent.annotations["qevent_id"] = qevent_id
+
+        logger.info(f"Restored quest event ['{qevent.name}'] in "
+                    f"state={qevent.state.name} from snapshot")
+        return True
+
+    def relink_users(self, users):
+        """
+        accepts args:
+            users - dict of user_id => User
+        links users to teams and quest events they had in the snapshot
+        and starts updates of restored quest events
+        returns number of linked users
+        """
+
+        linked = 0
+        with self._membership_lock:
+            for user_id, (qevent, tc) in self._restored_members.items():
+                user = users.get(user_id)
+                if user is None or user.state != UserState.IDLE:
+                    continue
+                if tc is None:
+                    qevent.add_pending_user(user)
+                    self._pending_users[user_id] = qevent
+                    user.state = UserState.REGISTERED
+                else:
+                    tc.distributor.subscribe(user)
+                    qevent.acquire_team_controller(tc)
+                    user.set_team_controller(tc)
+                linked += 1
+            self._restored_members = {}
+
+        with self._schedule_cond:
+            if self._restored_quests:
+                logger.warning(f"{len(self._restored_quests)} quests "
+                               "from snapshot are not registered, "
+                               "they're skipped")
+            for qevent in self._restored_events:
+                if self._quests.get(qevent.name) is qevent:
+                    self._schedule_update(qevent, datetime.now())
+            self._restored_quests = {}
+            self._restored_events = []
+
+        logger.info(f"Linked {linked} users to restored quest events")
+        return linked
+
+    def snapshot(self):
+        """
+        returns state of quest events, teams and memberships
+        as plain python values, it can be passed to constructor
+        as restored_state after restart
+
+        team states are copied in team mailboxes, so team commands
+        wait only for a copy, not for the whole snapshot
+        """
 
-        qevent.shuffle_team_controllers()
-        self._quests[quest_definition.name] = qevent
+        with self._schedule_cond:
+            qevents = list(self._quests.values())
+
+        quests = {}
+        pending = []
+        for qevent in qevents:
+            # quest event doesn't change its state meanwhile, team states
+            # are queued for copying before any later team command
+            with self._update_lock:
+                with self._membership_lock:
+                    members = {tc: sorted(tc.distributor.users)
+                               for tc in qevent.get_team_controllers()}
+                    pending_users = sorted(user.user_id for user
+                                           in qevent.get_pending_users())
+                futures = [(tc, tc.snapshot()) for tc in members]
+                quests[qevent.name] = {
+                    "name": qevent.name,
+                    "quest": qevent.quest.name,
+                    "session": qevent.session,
+                    "state": qevent.state.name,
+                    "qevent_id": qevent.annotations.get("qevent_id"),
+                    "start_date": qevent.start_date.timestamp(),
+                    "duration": qevent.quest.duration.total_seconds(),
+                    "pending_users": pending_users,
+                    "teams": [],
+                }
+            pending.append((quests[qevent.name], members, futures))
+
+        # updater is not blocked while team mailboxes copy their states
+        for quest, members, futures in pending:
+            for tc, future in futures:
+                team_state = future.result()
+                team_state["members"] = members[tc]
+                quest["teams"].append(team_state)
+
+        return {
+            "controller": {"event_mapper": self._event_mapper.snapshot()},
+            "quests": quests,
+        }
+
+    def unregister(self, quest_name):
+        """
+        removes all quest events of the quest from controller updates
+        returns False if quest_name is not registered
+        returns True if removed
+        """
+
+        with self._schedule_cond:
+            series = self._series.pop(quest_name, None)
+            if series is None:
+                return False
+            # heap entries of removed quest events are skipped by updater
+            qevents = series.get_qevents()
+            for qevent in qevents:
+                self._quests.pop(qevent.name, None)
+            self._schedule_cond.notify()
+
+        # users cannot join removed quest events anymore
+        for qevent in qevents:
+            qevent_id = qevent.annotations.pop("qevent_id", None)
+            if (qevent_id is not None
+                    and self._event_mapper.remove_event(qevent_id)):
+                logger.info("QuestEvent instance is now removed from "
+                            f"EventIdMapper by qevent_id={qevent_id}")
         return True
 
+    def get_state(self, quest_name):
+        """
+        returns EventState of registered quest, it's the most active
+        state of its quest events (see SERIES_STATES)
+        returns None if quest_name is not registered
+        """
+
+        with self._schedule_cond:
+            series = self._series.get(quest_name)
+            if series is None:
+                return None
+            states = {qevent.state for qevent in series.get_qevents()}
+        for state in self.SERIES_STATES:
+            if state in states:
+                return state
+        # repeated quest has no starts left
+        return EventState.FINISHED
+
+    def get_qevents(self, quest_name):
+        """
+        returns a list of quest events of registered quest
+        returns empty list if quest_name is not registered
+        """
+
+        with self._schedule_cond:
+            series = self._series.get(quest_name)
+            return [] if series is None else series.get_qevents()
+
+    def get_stats(self):
+        """
+        returns dict with numbers of quest events that are scheduled
+        or running, their teams and players
+        """
+
+        with self._schedule_cond:
+            qevents = [qevent for qevent in self._quests.values()
+                       if qevent.state not in self.INACTIVE_STATES]
+
+        teams = [tc for qevent in qevents
+                 for tc in qevent.get_team_controllers()]
+        return {
+            "quests": len(qevents),
+            "teams": len(teams),
+            "players": (sum(len(tc.distributor.users) for tc in teams)
+                        + sum(qevent.count_pending_users()
+                              for qevent in qevents)),
+        }
+
+    def _is_inactive(self, quest_name):
+        """
+        returns True if quest event has no players and can be changed,
+        must be called holding self._update_lock
+        """
+
+        return self.get_state(quest_name) in self.INACTIVE_STATES
+
+    def retire(self, quest_name):
+        """
+        unregisters quest event unless it's scheduled or running
+        returns True if removed
+        returns False if quest_name is not registered or is active
+        """
+
+        with self._update_lock:
+            if not self._is_inactive(quest_name):
+                return False
+            return self.unregister(quest_name)
+
+    def replace(self, quest_definition):
+        """
+        replaces registered quest event with a new QuestDefinition object
+        unless it's scheduled or running
+        returns True if replaced
+        returns False if quest is not registered or is active
+        """
+
+        with self._update_lock:
+            if not self._is_inactive(quest_definition.name):
+                return False
+            self.unregister(quest_definition.name)
+            return self.register(quest_definition)
+
+    def _schedule_update(self, qevent, when):
+        """
+        must be called holding self._schedule_cond
+        """
+
+        heapq.heappush(self._schedule,
+                       (when, next(self._schedule_seq), qevent))
+        self._schedule_cond.notify()
+
+    def _log(self, kind, *fields):
+        if self._game_log is not None:
+            self._game_log.append(kind, *fields)
+
     def leave_quest(self, user):
         """
         removes user's team controller
@@ -71,12 +444,27 @@ class QuestController():
         returns False if user has no team controllers
         """
 
-        team_controller = user.get_team_controller()
-        if team_controller is None:
-            return False
-
-        team_controller.distributor.unsubscribe(user)
-        user.remove_team_controller()
+        with self._membership_lock:
+            qevent = self._pending_users.pop(user.user_id, None)
+            if qevent is not None:
+                qevent.remove_pending_user(user)
+                user.state = UserState.IDLE
+                self._log(GameEvent.LEFT, qevent.name, None,
+                          user.user_id)
+                return True
+
+            team_controller = user.get_team_controller()
+            if team_controller is None:
+                return False
+
+            team_controller.distributor.unsubscribe(user)
+            team_controller.qevent.release_team_controller(team_controller)
+            user.remove_team_controller()
+            self._log(GameEvent.LEFT, team_controller.qevent.name,
+                      team_controller.team.name, user.user_id)
+
+        if self._storage is not None:
+            self._storage.remove_membership(user.user_id)
         return True
 
     def join_quest(self, user, qevent_id):
@@ -91,18 +479,87 @@ class QuestController():
             logger.debug(f"Cannot find qevent_id={qevent_id} in EventIdMapper")
             return False
 
+        with self._membership_lock:
+            if user.state != UserState.IDLE:
+                return False
+            qevent = self._pick_session(qevent)
+            if not self._deferred_assignment:
+                return self._assign_team(user, qevent)
+
+            qevent.add_pending_user(user)
+            self._pending_users[user.user_id] = qevent
+            user.state = UserState.REGISTERED
+            self._log(GameEvent.JOINED, qevent.name, None, user.user_id)
+            logger.info(f"User user_id={user.user_id} is waiting for a team "
+                        f"in quest event ['{qevent.name}']")
+            return True
+
+    def _pick_session(self, qevent):
+        """
+        returns the session of quest event start with the fewest players,
+        must be called holding self._membership_lock
+        """
+
+        if qevent.quest.sessions == 1:
+            return qevent
+        with self._schedule_cond:
+            series = self._series.get(qevent.quest.name)
+            sessions = ([qevent] if series is None
+                        else series.get_sessions(qevent.start_date))
+        return min(sessions, key=lambda session: (
+            sum(len(tc.distributor.users)
+                for tc in session.get_team_controllers())
+            + session.count_pending_users()))
+
+    def _start_name(self, qevent):
+        """
+        returns name of the start of quest event, it's shared by sessions
+        """
+
+        return QuestSeries(qevent.quest).qevent_name(qevent.start_date)
+
+    def _assign_team(self, user, qevent):
+        """
+        assigns user to the smallest team of quest event,
+        must be called holding self._membership_lock
+        returns True if success
+        """
+
+        team_controller = qevent.next_team_controller()
         try:
-            team_controller = qevent.next_team_controller()
             team_controller.distributor.subscribe(user)
             user.set_team_controller(team_controller)
             logger.info(f"User user_id={user.user_id} has joined "
                         f"team team_name='{team_controller.team.name}'")
         except ValueError:
             logger.exception("Cannot subscribe user to TeamController.Distributor")
+            qevent.release_team_controller(team_controller)
             return False
 
+        self._log(GameEvent.JOINED, qevent.name,
+                  team_controller.team.name, user.user_id)
+        if self._storage is not None:
+            self._storage.add_membership(user.user_id, qevent.name,
+                                         team_controller.team.name)
         return True
 
+    def assign_pending_users(self, qevent):
+        """
+        assigns all pending users of quest event to teams in one pass
+        """
+
+        started_at = time.perf_counter()
+        with self._membership_lock:
+            users = qevent.pop_pending_users()
+            for user in users:
+                self._pending_users.pop(user.user_id, None)
+                self._assign_team(user, qevent)
+
+        if users:
+            logger.info(f"Assigned {len(users)} pending users to teams of "
+                        f"quest event ['{qevent.name}'] in "
+                        f"{time.perf_counter() - started_at:.3f}s")
+
     def run_quest(self, qevent):
         """
         runs a quest by calling start() in every
@@ -123,26 +580,43 @@ class QuestController():
 
     def clear_quest(self, qevent):
         """
-        runs a quest by calling start() in every
-        registered team controller in QuestEvent
+        returns all players of QuestEvent to idle state and
+        calls clear() in every registered team controller
         """
 
         for tc in qevent.get_team_controllers():
+            with self._membership_lock:
+                users = list(tc.distributor.users.values())
+                for user in users:
+                    if user.get_team_controller() is tc:
+                        user.remove_team_controller()
+                        tc.qevent.release_team_controller(tc)
+            if self._storage is not None:
+                for user in users:
+                    self._storage.remove_membership(user.user_id)
             tc.clear()
 
     def publish_results(self, qevent):
         """
-        publishes the results of each team and a final winner of the quest
+        publishes the results of each team and a final winner of the quest,
+        if the quest has sessions, results of a team are sent to the team
+        and the winner of the start is published after its last session
         """
 
+        # every subscriber would get results of every team of every session
+        is_session = qevent.quest.sessions > 1
         max_points, winner = -1000, None
         for tc in qevent.get_team_controllers():
-            total_points, point_per_task = tc.get_results()
+            total_points, point_per_task = tc.get_results().result()
+            if self._storage is not None:
+                self._storage.add_result(qevent.name, tc.team.name,
+                                         total_points)
             formatted_appraise = [
                 [f"#{idx + 1}", *item]
                 for idx, item in enumerate(point_per_task)]
 
-            self.distributor.notify_template(
+            distributor = tc.distributor if is_session else self.distributor
+            distributor.notify_template(
                     "quest_results_in_detail",
                     team_name=tc.team.name,
                     total_points=total_points,
@@ -160,28 +634,52 @@ class QuestController():
 
         winner_players = "\n".join([f"▫️{user.name}"
                           for user in winner.distributor.users.values()])
+        winner_name = winner.team.name
+        if is_session:
+            key = (qevent.quest.name, qevent.start_date)
+            with self._schedule_cond:
+                winners = self._start_winners.setdefault(key, [])
+                winners.append((max_points, winner_name, winner_players))
+                series = self._series.get(qevent.quest.name)
+                sessions = ([] if series is None
+                            else series.get_sessions(qevent.start_date))
+                if any(session is not qevent
+                       and session.state != EventState.FINISHED
+                       for session in sessions):
+                    # other sessions of the start are still running
+                    return
+                self._start_winners.pop(key)
+            max_points, winner_name, winner_players = max(
+                winners, key=lambda item: item[0])
+
         self.distributor.notify_template(
                 "quest_results",
-                quest_name=qevent.quest.name,
+                quest_name=self._start_name(qevent),
                 quest_description=qevent.quest.description,
-                winner_name=winner.team.name,
+                winner_name=winner_name,
                 winner_players=winner_players)
 
     def process_change(self, qevent, curstate, newstate):
-        if newstate == EventState.SCHEDULED:
+        if newstate == EventState.SCHEDULED and qevent.session > 1:
+            # players join other sessions through the first one
+            pass
+
+        elif newstate == EventState.SCHEDULED:
             qevent_id = self._event_mapper.register_event(qevent)
             qevent.annotations["qevent_id"] = qevent_id
             logger.info("QuestEvent instance is now registered in EventIdMapper "
                         f"with qevent_id={qevent_id}")
-            self.distributor.notify_template(
+            broadcast = self.distributor.notify_template(
                 "quest_scheduled",
                 qevent_id=qevent_id,
-                date=qevent.quest.start_date,
+                date=qevent.start_date,
                 duration=qevent.quest.duration,
-                quest_name=qevent.quest.name,
+                quest_name=self._start_name(qevent),
                 quest_description=qevent.quest.description,
                 teams="\n".join([ f"▫️{team.name}"
                                   for team in qevent.quest.get_teams() ]))
+            logger.info(f"Queued {broadcast.total} notifications about "
+                        f"qevent_id={qevent_id}")
 
         elif curstate == EventState.SCHEDULED and newstate == EventState.RUNNING:
             qevent_id = qevent.annotations.get("qevent_id", "")
@@ -190,18 +688,80 @@ class QuestController():
                 logger.info("QuestEvent instance is now removed from "
                             f"EventIdMapper by qevent_id={qevent_id}")
 
+            self.assign_pending_users(qevent)
             self.run_quest(qevent)
 
         elif curstate == EventState.RUNNING and newstate == EventState.FINISHED:
             qevent_id = qevent.annotations.get("qevent_id", "")
             if self._event_mapper.remove_event(qevent_id):
-                qevent.annotations.pop(qevent_id)
+                qevent.annotations.pop("qevent_id")
                 logger.info("QuestEvent instance is now removed from "
                             f"EventIdMapper by qevent_id={qevent_id}")
             self.stop_quest(qevent)
             self.publish_results(qevent)
             self.clear_quest(qevent)
 
+    def _compute_state(self, qevent, curtime):
+        """
+        returns EventState of quest event at specified time
+        """
+
+        if curtime < qevent.start_date - self._reg_delta:
+            return EventState.WAITING
+        elif curtime < qevent.start_date:
+            return EventState.SCHEDULED
+        elif curtime < qevent.finish_date:
+            return EventState.RUNNING
+        else:
+            return EventState.FINISHED
+
+    def _next_transition(self, qevent, curtime):
+        """
+        returns datetime of the next state transition after curtime
+        returns None if quest event has no transitions left
+        """
+
+        transitions = (qevent.start_date - self._reg_delta,
+                       qevent.start_date,
+                       qevent.finish_date)
+        for transition in transitions:
+            if transition > curtime:
+                return transition
+        return None
+
+    def _take_due_events(self, curtime):
+        """
+        must be called holding self._schedule_cond
+        returns list of quest events due for update at curtime
+        """
+
+        due_events = []
+        while self._schedule and self._schedule[0][0] <= curtime:
+            _, _, qevent = heapq.heappop(self._schedule)
+            if self._quests.get(qevent.name) is qevent:
+                due_events.append(qevent)
+        return due_events
+
+    def _pop_due_events(self):
+        """
+        waits until some quest events are due for update
+        returns list of them or empty list if updater is stopped
+        """
+
+        with self._schedule_cond:
+            while self._updater_active:
+                curtime = datetime.now()
+                due_events = self._take_due_events(curtime)
+                if due_events:
+                    return due_events
+
+                timeout = self.MAX_UPDATER_SLEEP
+                if self._schedule:
+                    timeout = min(timeout, (self._schedule[0][0]
+                                            - curtime).total_seconds())
+                self._schedule_cond.wait(timeout)
+        return []
+
     def update(self):
         """
         updates the QuestDefinition objects to
@@ -209,44 +769,140 @@ class QuestController():
         """
 
         while self._updater_active:
-            for qevent in self._quests.values():
-                curstate = qevent.state
-                curtime = datetime.now()
+            due_events = self._pop_due_events()
+            if due_events:
+                self._update_events(due_events)
 
-                if curtime < qevent.quest.start_date - self._reg_delta:
-                    newstate = EventState.WAITING
-                elif curtime < qevent.quest.start_date:
-                    newstate = EventState.SCHEDULED
-                elif curtime < qevent.quest.start_date + qevent.quest.duration:
-                    newstate = EventState.RUNNING
-                else:
-                    newstate = EventState.FINISHED
+    def tick(self, all_events=False):
+        """
+        updates quest events that are due now without waiting for them,
+        it's what the updater thread does when it wakes up; if all_events
+        is True, every registered quest event is updated and scheduled
+        again (e.g. after the system clock has been changed)
+        returns number of updated quest events
+        """
+
+        with self._schedule_cond:
+            if all_events:
+                # every quest event schedules its next update again
+                due_events = list(self._quests.values())
+                self._schedule = []
+            else:
+                due_events = self._take_due_events(datetime.now())
+        self._update_events(due_events)
+        return len(due_events)
+
+    def _update_events(self, due_events):
+        with UPDATE_TICK_TIME.time():
+            for qevent in due_events:
+                with self._update_lock:
+                    self._update_state(qevent)
+
+    def _update_state(self, qevent):
+        """
+        moves quest event to its current state and schedules
+        the next update, must be called holding self._update_lock
+        """
+
+        with self._schedule_cond:
+            if self._quests.get(qevent.name) is not qevent:
+                # quest event has been removed while waiting for the lock
+                return
+
+        curstate = qevent.state
+        curtime = datetime.now()
+        newstate = self._compute_state(qevent, curtime)
+
+        logger.debug(f"quest event ['{qevent.name}'] has "
+                     f"curstate={curstate.name} and newstate={newstate.name}")
+        if curstate != newstate:
+            logger.info(f"quest event ['{qevent.name}'] changed "
+                        f"its state: {curstate.name} => {newstate.name}")
+            try:
+                self.process_change(qevent, curstate, newstate)
+            except Exception:
+                logger.exception(f"Cannot process state change of "
+                                 f"quest event ['{qevent.name}']")
+            self._log(GameEvent.QUEST_SESSION_STATE, qevent.name,
+                      qevent.quest.name, qevent.session, newstate.value,
+                      qevent.annotations.get("qevent_id"),
+                      qevent.start_date.timestamp(),
+                      qevent.quest.duration.total_seconds())
+        qevent.state = newstate
+        self._advance_series(qevent)
+
+        next_transition = self._next_transition(qevent, curtime)
+        if next_transition is not None:
+            with self._schedule_cond:
+                self._schedule_update(qevent, next_transition)
+
+    def _advance_series(self, qevent):
+        """
+        adds quest events of the next start of a repeated quest once its
+        latest start is scheduled and forgets finished quest events,
+        must be called holding self._update_lock
+        """
 
-                logger.debug(f"quest event ['{qevent.quest.name}'] has "
-                             f"curstate={curstate.name} and newstate={newstate.name}")
-                if curstate != newstate:
-                    logger.info(f"quest event ['{qevent.quest.name}'] changed "
-                                f"its state: {curstate.name} => {newstate.name}")
-                    self.process_change(qevent, curstate, newstate)
-                qevent.state = newstate
+        if qevent.quest.schedule is None:
+            return
+        with self._schedule_cond:
+            series = self._series.get(qevent.quest.name)
+        if series is None or series.quest is not qevent.quest:
+            # quest has been unregistered or replaced
+            return
+
+        if qevent.state == EventState.FINISHED:
+            with self._schedule_cond:
+                series.remove(qevent)
+                self._quests.pop(qevent.name, None)
+            logger.debug(f"Removed finished quest event ['{qevent.name}']")
+        elif (qevent.state != EventState.WAITING
+                and qevent.start_date == series.last_start):
+            start_date = series.next_start(max(series.last_start,
+                                               datetime.now()))
+            if start_date is not None:
+                self._add_start(series, start_date)
+                logger.info(f"Added quest events of ['{series.quest.name}'] "
+                            f"starting at {start_date}")
+
+    def shutdown(self):
+        """
+        stops quest state updates and message delivery
+        """
 
-            time.sleep(self.UPDATER_INTERVAL)
+        with self._schedule_cond:
+            self._updater_active = False
+            self._schedule_cond.notify()
+        self._scheduler.shutdown()
+        self._team_executor.shutdown(wait=False)
 
     def __del__(self):
-        self._updater_active = False
+        self.shutdown()
 
 
 class TeamController():
     """
     responsible for interacting with a team
     in accordance to team definition
+
+    team commands are processed one by one in the team mailbox,
+    so concurrent answers and hints never interleave, while
+    mailboxes of different teams run in parallel on a shared executor
     """
 
-    def __init__(self, team_definition):
+    def __init__(self, team_definition, scheduler=None, executor=None,
+                 game_log=None):
         self.team = team_definition
         self._is_running = False
         self._eff_controller = EfficiencyController()
-        self._distributor = EventDistributor()
+        self._distributor = EventDistributor(scheduler)
+        self._mailbox = Mailbox(executor)
+        self._game_log = game_log
+        self._current_task_definition = None
+        self.current_task = -1
+        self.current_hint = 0
+        self._qevent = None
+        self._eff_controller.add_listener(self._update_leaderboard)
 
     @property
     def team(self):
@@ -259,6 +915,17 @@ class TeamController():
                              "TeamDefinition class")
         self._team = value
 
+    @property
+    def qevent(self):
+        return self._qevent
+
+    @qevent.setter
+    def qevent(self, value):
+        if not isinstance(value, QuestEvent):
+            raise ValueError("value must be an instance of "
+                             "QuestEvent class")
+        self._qevent = value
+
     @property
     def is_running(self):
         return self._is_running
@@ -267,7 +934,90 @@ class TeamController():
     def distributor(self):
         return self._distributor
 
+    def _log(self, kind, *fields, at=None):
+        if self._game_log is not None:
+            self._game_log.append(kind, self._qevent.name,
+                                  self.team.name, *fields, at=at)
+
+    def _update_leaderboard(self, total_points):
+        if self._qevent is not None:
+            self._qevent.leaderboard.update(self, total_points)
+
     def give_hint(self, user):
+        """
+        queues _give_hint() in the team mailbox
+        returns concurrent.futures.Future with its result
+        """
+
+        return self._mailbox.submit(self._give_hint, user)
+
+    def check_answer(self, user, value):
+        """
+        queues _check_answer() in the team mailbox
+        returns concurrent.futures.Future with its result
+        """
+
+        return self._mailbox.submit(self._check_answer, user, value)
+
+    def start(self):
+        """
+        queues _start() in the team mailbox
+        returns concurrent.futures.Future
+        """
+
+        return self._mailbox.submit(self._start)
+
+    def stop(self):
+        """
+        queues _stop() in the team mailbox
+        returns concurrent.futures.Future
+        """
+
+        return self._mailbox.submit(self._stop)
+
+    def clear(self):
+        """
+        queues _clear() in the team mailbox
+        returns concurrent.futures.Future
+        """
+
+        return self._mailbox.submit(self._clear)
+
+    def get_results(self):
+        """
+        queues _get_results() in the team mailbox
+        returns concurrent.futures.Future with its result
+        """
+
+        return self._mailbox.submit(self._get_results)
+
+    def get_leaderboard(self):
+        """
+        returns rendered leaderboard of quest event
+        and rank of the team in it
+        """
+
+        leaderboard = self._qevent.leaderboard
+        return leaderboard.render(), leaderboard.rank(self)
+
+    def snapshot(self):
+        """
+        queues _snapshot() in the team mailbox
+        returns concurrent.futures.Future with its result
+        """
+
+        return self._mailbox.submit(self._snapshot)
+
+    def restore(self, state):
+        """
+        queues _restore() in the team mailbox
+        returns concurrent.futures.Future
+        """
+
+        return self._mailbox.submit(self._restore, state)
+
+    @TEAM_COMMAND_LATENCY.timed(command="give_hint")
+    def _give_hint(self, user):
         """
         accepts args:
             user - user who requested the hint
@@ -283,17 +1033,23 @@ class TeamController():
                          f"because self.is_running={self.is_running}")
             return None
 
-        if len(self.current_hints):
-            hint_value = self.current_hints.pop(0)
+        hints = self._current_task_definition.get_hints()
+        if self.current_hint < len(hints):
+            hint_value = hints[self.current_hint]
+            self.current_hint += 1
             logger.info(f"User with user_id={user.user_id} and "
                         f"team_definition.name='{self.team.name}' "
-                        f"has requested a hint ({len(self.current_hints)} "
+                        f"has requested a hint "
+                        f"({len(hints) - self.current_hint} "
                         f"more available) for task={self.current_task + 1}")
 
             self.distributor.notify_template("get_hint_success",
                                              username=user.name,
                                              task_hint=hint_value)
-            self._eff_controller.add_penalty(2)
+            self._log(GameEvent.HINT_TAKEN, user.user_id,
+                      self.current_hint - 1)
+            self._eff_controller.add_penalty(
+                EfficiencyController.HINT_PENALTY)
             return True
         else:
             logger.info(f"User with user_id={user.user_id} and "
@@ -305,7 +1061,8 @@ class TeamController():
                                              username=user.name)
             return False
 
-    def check_answer(self, user, value):
+    @TEAM_COMMAND_LATENCY.timed(command="check_answer")
+    def _check_answer(self, user, value):
         """
         accepts args:
             user - user who sent the answer
@@ -321,8 +1078,7 @@ class TeamController():
                          f"self.is_running={self.is_running}")
             return None
 
-        correct_value = self.team.get_tasks()[self.current_task].answer
-        if value.lower() == correct_value.lower():
+        if self._current_task_definition.is_correct(value):
             logger.info(f"User with user_id={user.user_id} and "
                         f"team_definition.name='{self.team.name}' "
                         f"has given a correct answer='{value}' "
@@ -330,7 +1086,10 @@ class TeamController():
             self.distributor.notify_template("quest_correct_answer",
                                              username=user.name,
                                              answer=value)
-            self._eff_controller.finish_task()
+            finished_at = datetime.now()
+            self._log(GameEvent.ANSWER_RIGHT, user.user_id, value,
+                      at=finished_at)
+            self._eff_controller.finish_task(finished_at)
             self.next_task()
             return True
         else:
@@ -341,7 +1100,9 @@ class TeamController():
             self.distributor.notify_template("quest_wrong_answer",
                                              username=user.name,
                                              answer=value)
-            self._eff_controller.add_penalty(3)
+            self._log(GameEvent.ANSWER_WRONG, user.user_id, value)
+            self._eff_controller.add_penalty(
+                EfficiencyController.WRONG_ANSWER_PENALTY)
             return False
 
     def next_task(self):
@@ -357,19 +1118,24 @@ class TeamController():
                          "has completed all available tasks")
 
             self.distributor.notify_template("quest_no_tasks_left")
+            self._log(GameEvent.TEAM_FINISHED, self.current_task)
             self.finish()
             return False
         else:
             logger.info(f"Team team_definition.name='{self.team.name}' "
                         f"has started task={self.current_task + 1}")
             cur_task = self.team.get_tasks()[self.current_task]
+            self._current_task_definition = cur_task
             self.distributor.notify_template("quest_new_task",
                                              task_question=cur_task.question)
-            self.current_hints = cur_task.get_hints()
-            self._eff_controller.new_task()
+            self.current_hint = 0
+            started_at = datetime.now()
+            self._log(GameEvent.TASK_STARTED, self.current_task,
+                      at=started_at)
+            self._eff_controller.new_task(started_at)
             return True
 
-    def start(self):
+    def _start(self):
         """
         starts giving tasks for team
         """
@@ -377,11 +1143,12 @@ class TeamController():
         logger.info(f"Team team_definition.name='{self.team.name}' "
                     f"has started the quest")
         self._is_running = True
+        self._log(GameEvent.TEAM_STARTED)
         self.distributor.notify_template(
                                     "quest_started_info",
                                     team_description=self.team.description,
                                     team_communication=self.team.communication)
-        self.current_hints = []
+        self.current_hint = 0
         self.current_task = -1
         self.next_task()
 
@@ -395,7 +1162,7 @@ class TeamController():
                     f"has finished the quest")
         self._is_running = False
 
-    def stop(self):
+    def _stop(self):
         """
         stops getting answers & giving hints
         notifies all subscribed users about quest being stopped
@@ -405,16 +1172,50 @@ class TeamController():
         logger.info(f"Team team_definition.name='{self.team.name}' "
                     f"has stopped the quest")
         self._is_running = False
+        self._log(GameEvent.TEAM_STOPPED)
         self.distributor.notify_template("quest_stopped")
 
-    def clear(self):
+    def _clear(self):
         """
         clears all subscribed users
         """
 
+        self._log(GameEvent.TEAM_CLEARED)
         self.distributor.clear()
 
-    def get_results(self):
+    def _snapshot(self):
+        """
+        returns state of the team as plain python values
+        """
+
+        return {
+            "name": self.team.name,
+            "is_running": self._is_running,
+            "current_task": self.current_task,
+            "current_hint": self.current_hint,
+            "efficiency": self._eff_controller.snapshot(),
+        }
+
+    def _restore(self, state):
+        """
+        replaces state of the team with one returned by _snapshot()
+        """
+
+        tasks = self.team.get_tasks()
+        if not -1 <= state["current_task"] <= len(tasks):
+            raise ValueError(f"Team team_definition.name='{self.team.name}' "
+                             f"has no task={state['current_task'] + 1}")
+
+        self.current_task = state["current_task"]
+        self.current_hint = state["current_hint"]
+        self._current_task_definition = None
+        if 0 <= self.current_task < len(tasks):
+            self._current_task_definition = tasks[self.current_task]
+        self._eff_controller.restore(state["efficiency"])
+        self._is_running = (state["is_running"]
+                            and self._current_task_definition is not None)
+
+    def _get_results(self):
         """
         returns a tuple of appraise_total(), appraise() as a result
         """
@@ -1,24 +1,91 @@
+import abc
 import logging
 from datetime import datetime, timedelta
 
+from questbot.matchers import normalize_answer, within_distance
+from questbot.schedules import CronSchedule
+
 
 logger = logging.getLogger(__name__)
 
 
-class QuestDefinition():
+class Definition(abc.ABC):
+    """
+    base class for immutable definitions
+
+    definitions are frozen after construction, so one definition
+    can be shared between any number of quest events and threads
+    """
+    __slots__ = ()
+
+    def _init(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return (type(self), self._args())
+
+    @abc.abstractmethod
+    def _args(self):
+        """
+        returns tuple of constructor arguments, it's used by pickle
+        """
+
+
+class QuestDefinition(Definition):
     """
-    name         - str, quest name 
+    name         - str, quest name
     description  - str, quest description
     start_date   - datetime, quest start date & time
-    duration     - timedelta, quest duration 
+    duration     - timedelta, quest duration
+    teams        - iterable of TeamDefinition objects
+    sessions     - int, number of quest events running in parallel
+    schedule     - str, cron expression of repeated starts after
+                   start_date or None if quest runs once
     """
+    __slots__ = ("_name", "_description", "_start_date",
+                 "_duration", "_teams", "_sessions", "_schedule")
 
-    def __init__(self):
-        self._name = ""
-        self._description = ""
-        self._start_date = datetime.now()
-        self._duration = timedelta(minutes=30)
-        self._teams = []
+    def __init__(self, name, description, start_date,
+                 duration=timedelta(minutes=30), teams=(),
+                 sessions=1, schedule=None):
+        if not isinstance(name, str):
+            raise ValueError("name must be string")
+        if not isinstance(description, str):
+            raise ValueError("description must be string")
+        if not isinstance(start_date, datetime):
+            raise ValueError("start_date must be datetime.datetime")
+        if not isinstance(duration, timedelta):
+            raise ValueError("duration must be datetime.timedelta")
+        if not isinstance(sessions, int) or sessions < 1:
+            raise ValueError("sessions must be an integer value >= 1")
+        if schedule is not None:
+            schedule = CronSchedule(schedule)
+
+        teams = tuple(teams)
+        for team_definition in teams:
+            if not isinstance(team_definition, TeamDefinition):
+                raise ValueError("team_definition must be an instance of "
+                                 "TeamDefinition class")
+
+        self._init("_name", name)
+        self._init("_description", description)
+        self._init("_start_date", start_date)
+        self._init("_duration", duration)
+        self._init("_teams", teams)
+        self._init("_sessions", sessions)
+        self._init("_schedule", schedule)
+
+    def _args(self):
+        return (self._name, self._description, self._start_date,
+                self._duration, self._teams, self._sessions,
+                None if self._schedule is None
+                else self._schedule.expression)
 
     @property
     def name(self):
@@ -36,50 +103,54 @@ class QuestDefinition():
     def duration(self):
         return self._duration
 
-    @name.setter
-    def name(self, value):
-        if not isinstance(value, str):
-            raise ValueError("name must be string")
-        self._name = value
-
-    @description.setter
-    def description(self, value):
-        if not isinstance(value, str):
-            raise ValueError("description must be string")
-        self._description = value
-
-    @start_date.setter
-    def start_date(self, value):
-        if not isinstance(value, datetime):
-            raise ValueError("start_date must be datetime.datetime")
-        self._start_date = value
+    @property
+    def sessions(self):
+        return self._sessions
 
-    @duration.setter
-    def duration(self, value):
-        if not isinstance(value, timedelta):
-            raise ValueError("duration must be datetime.timedelta")
-        self._duration = value
+    @property
+    def schedule(self):
+        """
+        returns CronSchedule or None if quest runs once
+        """
 
-    def add_team(self, team_definition):
-        if not isinstance(team_definition, TeamDefinition):
-            raise ValueError("team_definition must be an instance of "
-                             "TeamDefinition class")
-        self._teams.append(team_definition)
+        return self._schedule
 
     def get_teams(self):
-        return self._teams[:]
+        """
+        returns read-only tuple of TeamDefinition objects
+        """
+
+        return self._teams
 
 
-class TeamDefinition():
+class TeamDefinition(Definition):
     """
     class to represent team definition
     """
+    __slots__ = ("_name", "_description", "_communication", "_tasks")
 
-    def __init__(self):
-        self._name = ""
-        self._description = ""
-        self._communication = ""
-        self._tasks = []
+    def __init__(self, name, description, communication, tasks=()):
+        if not isinstance(name, str):
+            raise ValueError("name must be string")
+        if not isinstance(description, str):
+            raise ValueError("description must be string")
+        if not isinstance(communication, str):
+            raise ValueError("communication must be string")
+
+        tasks = tuple(tasks)
+        for task_definition in tasks:
+            if not isinstance(task_definition, TaskDefinition):
+                raise ValueError("task_definition must be an instance"
+                                 "of TaskDefinition class")
+
+        self._init("_name", name)
+        self._init("_description", description)
+        self._init("_communication", communication)
+        self._init("_tasks", tasks)
+
+    def _args(self):
+        return (self._name, self._description,
+                self._communication, self._tasks)
 
     @property
     def name(self):
@@ -93,44 +164,49 @@ class TeamDefinition():
     def communication(self):
         return self._communication
 
-    @name.setter
-    def name(self, value):
-        if not isinstance(value, str):
-            raise ValueError("name must be string")
-        self._name = value
-
-    @description.setter
-    def description(self, value):
-        if not isinstance(value, str):
-            raise ValueError("description must be string")
-        self._description = value
-
-    @communication.setter
-    def communication(self, value):
-        if not isinstance(value, str):
-            raise ValueError("communication must be string")
-        self._communication = value
-
-    def add_task(self, task_definition):
-        if not isinstance(task_definition, TaskDefinition):
-            raise ValueError("task_definition must be an instance"
-                             "of TaskDefinition class")
-        self._tasks.append(task_definition)
-
     def get_tasks(self):
-        return self._tasks[:]
+        """
+        returns read-only tuple of TaskDefinition objects
+        """
+
+        return self._tasks
 
 
-class TaskDefinition():
+class TaskDefinition(Definition):
     """
     class to represent task definition
     that's used in team definition class
+
+    answers are normalized once here, so checking
+    an answer is a single set lookup
     """
+    __slots__ = ("_question", "_answers", "_accepted_answers",
+                 "_fuzzy", "_hints")
+
+    def __init__(self, question, answers, hints=(), fuzzy=0):
+        if not isinstance(question, str):
+            raise ValueError("question must be string")
+        if isinstance(answers, str):
+            answers = (answers,)
+        answers = tuple(answers)
+        if not answers or not all(isinstance(answer, str)
+                                  for answer in answers):
+            raise ValueError("answers must be a non-empty list of strings")
+        hints = tuple(hints)
+        if not all(isinstance(hint, str) for hint in hints):
+            raise ValueError("hint must be string")
+        if not isinstance(fuzzy, int) or fuzzy < 0:
+            raise ValueError("fuzzy must be an integer value >= 0")
 
-    def __init__(self):
-        self._question = ""
-        self._answer = ""
-        self._hints = []
+        self._init("_question", question)
+        self._init("_answers", answers)
+        self._init("_accepted_answers",
+                   frozenset(normalize_answer(answer) for answer in answers))
+        self._init("_fuzzy", fuzzy)
+        self._init("_hints", hints)
+
+    def _args(self):
+        return (self._question, self._answers, self._hints, self._fuzzy)
 
     @property
     def question(self):
@@ -138,24 +214,44 @@ class TaskDefinition():
 
     @property
     def answer(self):
-        return self._answer
+        """
+        returns the first accepted answer
+        """
 
-    @question.setter
-    def question(self, value):
-        if not isinstance(value, str):
-            raise ValueError("question must be string")
-        self._question = value
+        return self._answers[0]
+
+    @property
+    def fuzzy(self):
+        """
+        max edit distance for an answer with typos to be accepted,
+        0 means only exact (normalized) answers are accepted
+        """
 
-    @answer.setter
-    def answer(self, value):
-        if not isinstance(value, str):
-            raise ValueError("answer must be string")
-        self._answer = value
+        return self._fuzzy
 
-    def add_hint(self, hint):
-        if not isinstance(hint, str):
-            raise ValueError("hint must be string")
-        self._hints.append(hint)
+    def get_answers(self):
+        """
+        returns read-only tuple of accepted answers
+        """
+
+        return self._answers
 
     def get_hints(self):
-        return self._hints[:]
\ No newline at end of file
+        """
+        returns read-only tuple of hints
+        """
+
+        return self._hints
+
+    def is_correct(self, value):
+        """
+        returns True if value matches any of accepted answers
+        """
+
+        value = normalize_answer(value)
+        if value in self._accepted_answers:
+            return True
+        if self._fuzzy:
+            return any(within_distance(value, answer, self._fuzzy)
+                       for answer in self._accepted_answers)
+        return False
@@ -1,8 +1,16 @@
+import heapq
 import random
+import hashlib
 import logging
+import secrets
+import threading
 from enum import Enum
+from datetime import timedelta
+from collections import deque
 
 from questbot.users import User
+from questbot.broadcast import Broadcast
+from questbot.leaderboard import Leaderboard
 from questbot.telegram.answers import BotTemplates
 
 
@@ -17,18 +25,98 @@ class EventState(Enum):
     FINISHED = 5
 
 
+class TeamAllocator():
+    """
+    assigns players to the team with the smallest live size
+
+    teams are kept in a min-heap keyed on (size, order), outdated heap
+    entries are skipped lazily, so every join or leave costs O(log T)
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sizes = {}
+        self._orders = {}
+        self._lock = threading.Lock()
+
+    def add_team(self, team_controller):
+        """
+        adds a team, teams of equal size are chosen in order of adding
+        """
+
+        with self._lock:
+            self._orders[team_controller] = len(self._orders)
+            self._sizes[team_controller] = 0
+            self._push(team_controller)
+
+    def _push(self, team_controller):
+        heapq.heappush(self._heap, (self._sizes[team_controller],
+                                    self._orders[team_controller],
+                                    team_controller))
+        if len(self._heap) > 4 * len(self._sizes) + 16:
+            # drop outdated entries
+            self._heap = [(size, self._orders[tc], tc)
+                          for tc, size in self._sizes.items()]
+            heapq.heapify(self._heap)
+
+    def acquire(self, team_controller=None):
+        """
+        returns the smallest team (or team_controller if it's set)
+        and counts a new player in it
+        raises KeyError if there are no teams
+        """
+
+        with self._lock:
+            if team_controller is not None:
+                self._sizes[team_controller] += 1
+                self._push(team_controller)
+                return team_controller
+            while self._heap:
+                size, _, team_controller = heapq.heappop(self._heap)
+                if self._sizes.get(team_controller) == size:
+                    self._sizes[team_controller] += 1
+                    self._push(team_controller)
+                    return team_controller
+        raise KeyError("There are no teams to assign a player to")
+
+    def release(self, team_controller):
+        """
+        counts a player leaving the team
+        """
+
+        with self._lock:
+            if self._sizes.get(team_controller, 0) > 0:
+                self._sizes[team_controller] -= 1
+                self._push(team_controller)
+
+    def size(self, team_controller):
+        return self._sizes.get(team_controller, 0)
+
+
 class QuestEvent():
     """
     represents quest definition with a state property and team controllers dict
     team controllers should be present if state is EventState.SCHEDULED or EventState.RUNNING
+
+    players are either assigned to a team right away or kept pending until
+    quest starts when all of them are assigned in one pass
+
+    quest definition can be shared by many quest events (sessions and
+    repeated starts), every one has its own name, start date and teams
     """
 
-    def __init__(self, quest_definition):
+    def __init__(self, quest_definition, start_date=None, name=None,
+                 session=1):
         self._quest_definition = quest_definition
+        self._start_date = start_date or quest_definition.start_date
+        self._name = name or quest_definition.name
+        self._session = session
         self._team_controllers = []
+        self._allocator = TeamAllocator()
+        self._pending_users = {}
+        self._leaderboard = Leaderboard()
         self.annotations = {}
         self.state = EventState.UNKNOWN
-        self._tc_generator = self._endless_team_controller_list()
 
     @property
     def annotations(self):
@@ -42,6 +130,31 @@ class QuestEvent():
     def quest(self):
         return self._quest_definition
 
+    @property
+    def name(self):
+        """
+        unique name of quest event,
+        it's the quest name if quest runs once in a single session
+        """
+
+        return self._name
+
+    @property
+    def start_date(self):
+        return self._start_date
+
+    @property
+    def finish_date(self):
+        return self._start_date + self._quest_definition.duration
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def leaderboard(self):
+        return self._leaderboard
+
     @state.setter
     def state(self, value):
         if not isinstance(value, EventState):
@@ -56,10 +169,14 @@ class QuestEvent():
 
     def shuffle_team_controllers(self):
         """
-        shuffles registered team controllers
+        shuffles registered team controllers,
+        must be called before any player joins
         """
 
         random.shuffle(self._team_controllers)
+        self._allocator = TeamAllocator()
+        for team_controller in self._team_controllers:
+            self._allocator.add_team(team_controller)
 
     def register_team_controller(self, team_controller):
         """
@@ -67,22 +184,32 @@ class QuestEvent():
         """
 
         self._team_controllers.append(team_controller)
+        self._allocator.add_team(team_controller)
+        self._leaderboard.add_team(team_controller, team_controller.team.name)
+        team_controller.qevent = self
 
-    def _endless_team_controller_list(self):
+    def next_team_controller(self):
         """
-        generator for endlessly iterating over registered team controllers
+        returns registered team controller with the fewest players
+        and counts a new player in it
         """
 
-        while True:
-            for tc in self._team_controllers:
-                yield tc
+        return self._allocator.acquire()
 
-    def next_team_controller(self):
+    def acquire_team_controller(self, team_controller):
         """
-        returns next registered team controller
+        counts a new player in the team controller, it's used for
+        players that already have a team (e.g. restored from a snapshot)
         """
 
-        return next(self._tc_generator)
+        self._allocator.acquire(team_controller)
+
+    def release_team_controller(self, team_controller):
+        """
+        counts a player leaving the team controller
+        """
+
+        self._allocator.release(team_controller)
 
     def get_team_controllers(self):
         """
@@ -91,17 +218,127 @@ class QuestEvent():
 
         return self._team_controllers
 
+    def add_pending_user(self, user):
+        """
+        keeps user to be assigned to a team later
+        """
+
+        self._pending_users[user.user_id] = user
+
+    def remove_pending_user(self, user):
+        """
+        returns True if user was pending
+        returns False otherwise
+        """
+
+        return self._pending_users.pop(user.user_id, None) is not None
+
+    def get_pending_users(self):
+        """
+        returns a list of pending users
+        """
+
+        return list(self._pending_users.values())
+
+    def count_pending_users(self):
+        return len(self._pending_users)
+
+    def pop_pending_users(self):
+        """
+        returns list of pending users and forgets them
+        """
+
+        users = list(self._pending_users.values())
+        self._pending_users = {}
+        return users
+
+
+class QuestSeries():
+    """
+    quest events of a single quest definition
+
+    every start of the quest has <sessions> quest events,
+    repeated starts follow the schedule of the quest definition
+    """
+
+    def __init__(self, quest_definition):
+        self._quest_definition = quest_definition
+        self._qevents = {}      # name => QuestEvent
+        self.last_start = None
+
+    @property
+    def quest(self):
+        return self._quest_definition
+
+    @property
+    def is_repeated(self):
+        return self._quest_definition.schedule is not None
+
+    def qevent_name(self, start_date, session=None):
+        """
+        returns name of quest event for start date and session
+        returns name of the start (shared by its sessions) if session is None
+        """
+
+        name = self._quest_definition.name
+        if self.is_repeated:
+            name = f"{name} ({start_date:%Y-%m-%d %H:%M})"
+        if self._quest_definition.sessions > 1 and session is not None:
+            name = f"{name} #{session}"
+        return name
+
+    def next_start(self, after):
+        """
+        returns the first start of the quest after datetime after
+        (or at its start_date if it's not repeated)
+        returns None if there're no starts left
+        """
+
+        quest = self._quest_definition
+        if not self.is_repeated:
+            return quest.start_date if self.last_start is None else None
+        # start_date itself is the first start if it matches the schedule
+        return quest.schedule.next_after(
+            max(after, quest.start_date - timedelta(minutes=1)))
+
+    def add(self, qevent):
+        self._qevents[qevent.name] = qevent
+        if self.last_start is None or qevent.start_date > self.last_start:
+            self.last_start = qevent.start_date
+
+    def remove(self, qevent):
+        self._qevents.pop(qevent.name, None)
+
+    def get_qevents(self):
+        """
+        returns a list of quest events
+        """
+
+        return list(self._qevents.values())
+
+    def get_sessions(self, start_date):
+        """
+        returns a list of quest events of the start
+        """
+
+        return [qevent for qevent in self._qevents.values()
+                if qevent.start_date == start_date]
+
 
 class EventDistributor():
     """
     eventditributor is responsible for user notification
     user should subscribe to a eventditributor instance in order to
     receive events
+
+    if broadcast scheduler is set, messages are queued to it instead of
+    being sent one by one in the calling thread
     """
 
-    def __init__(self):
+    def __init__(self, scheduler=None):
         self._users = {}
         self._bot = BotTemplates()
+        self._scheduler = scheduler
 
     @property
     def users(self):
@@ -123,6 +360,24 @@ class EventDistributor():
         self._users[user.user_id] = user
         return True
 
+    def subscribe_many(self, users):
+        """
+        subscribes a batch of users to events
+        returns number of newly subscribed users
+        """
+
+        count = 0
+        for user in users:
+            if not isinstance(user, User):
+                raise ValueError("user must be an instance of "
+                                 "<questbot.users.User> class")
+            if user.user_id not in self._users:
+                self._users[user.user_id] = user
+                count += 1
+
+        logger.debug(f"{count} users have subscribed for events")
+        return count
+
     def unsubscribe(self, user):
         """
         unsubscribes user to events
@@ -139,24 +394,62 @@ class EventDistributor():
         self._users.pop(user.user_id)
         return True
 
+    def _deliver(self, deliveries):
+        """
+        sends (user, message) pairs using broadcast scheduler if it's set
+        returns Broadcast handle
+        """
+
+        if self._scheduler is not None:
+            return self._scheduler.submit(deliveries)
+
+        deliveries = list(deliveries)
+        broadcast = Broadcast(len(deliveries))
+        # nobody waits for the handle meanwhile, it's updated once
+        failed = 0
+        for user, message in deliveries:
+            try:
+                user.send_message(message=message)
+            except Exception:
+                logger.exception(f"Cannot send a message to "
+                                 f"user_id={user.user_id}")
+                failed += 1
+        if failed:
+            broadcast._record(False, failed)
+        if len(deliveries) > failed:
+            broadcast._record(True, len(deliveries) - failed)
+        return broadcast
+
     def notify(self, event):
         """
         sends to all subscribed users an arised event
+        returns Broadcast handle
         """
 
-        for _, user in self._users.items():
-            user.send_message(message=event)
+        return self._deliver([(user, event)
+                              for user in list(self._users.values())])
 
     def notify_template(self, template_name, **kwargs):
         """
         sends to all subscribed users an arised event
+        returns Broadcast handle
         """
 
-        for _, user in self._users.items():
-            answer_tmpl = self._bot.get_answer_template(template_name,
-                                                        user.lang_code)
-            answer = answer_tmpl.substitute(**kwargs)
-            user.send_message(message=answer)
+        users_by_lang = {}
+        for user in list(self._users.values()):
+            users_by_lang.setdefault(user.lang_code, []).append(user)
+
+        # message depends on lang_code & kwargs only, so render it once
+        deliveries = []
+        answers = {}
+        for lang_code, users in users_by_lang.items():
+            lang_code = self._bot.resolve_lang_code(template_name, lang_code)
+            answer = answers.get(lang_code)
+            if answer is None:
+                answer = answers[lang_code] = self._bot.render(
+                    template_name, lang_code, **kwargs)
+            deliveries.extend((user, answer) for user in users)
+        return self._deliver(deliveries)
 
     def clear(self):
         """
@@ -171,55 +464,178 @@ class EventIdMapper():
     class is responsible for registering & reading events by its id
 
     NOTE:
-    qevent identifier is <ID_LENGTH>-digit number,
+    qevent identifier is <id_length>-digit number,
     so total number of events to be registered is limited
+
+    identifiers are produced by a keyed permutation (swap-or-not
+    shuffle, it's a bijection of a range of any size) of a counter,
+    so they're unique and hard to guess, and every allocation costs
+    a fixed number of hash computations; released identifiers are
+    reused only when the counter is exhausted
+
+    if partition (index, count) is set, only identifiers whose number
+    modulo count is index are issued, so mappers of different
+    partitions never issue the same identifier; the counter is
+    permuted within the partition's own range, index + count * i
     """
-    MAX_RANDOM_CYCLES = 10
     ID_LENGTH = 4
-
-    def __init__(self):
+    SHUFFLE_ROUNDS = 24
+    # snapshots of another permutation continue another sequence
+    PERMUTATION = "swap-or-not"
+
+    def __init__(self, id_length=None, key=None, partition=None):
+        self._id_length = id_length or self.ID_LENGTH
+        if self._id_length < 1:
+            raise ValueError("id_length must be an integer value >= 1")
+        if partition is not None and not 0 <= partition[0] < partition[1]:
+            raise ValueError("partition must be (index, count) "
+                             "with 0 <= index < count")
+        self._partition = None if partition is None else tuple(partition)
+        self._offset, self._step = self._partition or (0, 1)
+        # number of identifiers of the partition
+        self._capacity = ((10 ** self._id_length - self._offset
+                           + self._step - 1) // self._step)
+        if not self._capacity:
+            raise ValueError("partition has no identifiers "
+                             "of this id_length")
+        self._set_key(key if key is not None else secrets.token_bytes(16))
+        self._counter = 0
+        self._free_ids = deque()
         self._qevents = {}
+        self._lock = threading.Lock()
+
+    @property
+    def id_length(self):
+        return self._id_length
+
+    @property
+    def partition(self):
+        return self._partition
+
+    def _is_own(self, qevent_id):
+        if self._partition is None:
+            return True
+        index, count = self._partition
+        return int(qevent_id) % count == index
+
+    def _hash(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=8,
+                                 key=self._key).digest()
+        return int.from_bytes(digest, "big")
+
+    def _set_key(self, key):
+        self._key = key
+        self._round_keys = [self._hash(f"key:{number}") % self._capacity
+                            for number in range(self.SHUFFLE_ROUNDS)]
+
+    def _permute(self, value):
+        """
+        returns a unique number in range [0, capacity)
+        for every value in the same range
+        """
+
+        for number, round_key in enumerate(self._round_keys):
+            # every round swaps pairs of values or leaves them,
+            # the pair is decided by the larger value of the two
+            partner = (round_key - value) % self._capacity
+            if self._hash(f"{number}:{max(value, partner)}") & 1:
+                value = partner
+        return value
+
+    def _allocate_id(self):
+        """
+        must be called holding self._lock
+        """
+
+        while True:
+            qevent_id = self._next_id()
+            # restored identifiers may be taken already
+            if qevent_id not in self._qevents:
+                return qevent_id
 
-    def _generate_random_id(self):
+    def _next_id(self):
         """
-        generates random string id and returns it
+        must be called holding self._lock
         """
 
-        short_id = str(random.randint(0, 10000))
-        full_id = "0" * (self.ID_LENGTH - len(short_id)) + short_id
-        return full_id
+        if self._counter < self._capacity:
+            value = self._permute(self._counter)
+            self._counter += 1
+            return str(self._offset + self._step * value).zfill(
+                self._id_length)
+        if self._free_ids:
+            return self._free_ids.popleft()
+        raise RuntimeError(f"All {self._capacity} identifiers for qevent "
+                           "are in use")
 
     def register_event(self, qevent):
         """
         registers qevent in local db and returns its identifier
         """
-        
-        is_success = False
-        for i in range(self.MAX_RANDOM_CYCLES):
-            free_id = self._generate_random_id()
-            if free_id not in self._qevents.keys():
-                is_success = True
-                break
-
-        assert is_success, "Cannot generate unique identifier for qevent"
-        assert isinstance(free_id, str), ("Generated identifier is not "
-                                          "a type of 'str'")
-        assert len(free_id) == self.ID_LENGTH, ("Generated identifier has "
-                                                "incorrect length "
-                                                f"{len(free_id)} != {self.ID_LENGTH}")
-        self._qevents[free_id] = qevent
+
+        with self._lock:
+            free_id = self._allocate_id()
+            self._qevents[free_id] = qevent
         return free_id
 
+    def restore_event(self, qevent_id, qevent):
+        """
+        registers qevent with identifier it had before
+        returns False if identifier is taken by another qevent
+        returns True if qevent is registered
+        """
+
+        with self._lock:
+            if self._qevents.get(qevent_id, qevent) is not qevent:
+                return False
+            self._qevents[qevent_id] = qevent
+            if qevent_id in self._free_ids:
+                self._free_ids.remove(qevent_id)
+            return True
+
+    def snapshot(self):
+        """
+        returns state of identifier allocation as plain python values,
+        registered qevents are not included
+        """
+
+        with self._lock:
+            return {"id_length": self._id_length, "key": self._key,
+                    "partition": self._partition,
+                    "permutation": self.PERMUTATION,
+                    "counter": self._counter,
+                    "free_ids": list(self._free_ids)}
+
+    def restore(self, state):
+        """
+        continues identifier allocation from state returned by snapshot(),
+        so identifiers issued before restart are not issued again
+        returns False if state is for another id_length, partition
+        or permutation
+        returns True if restored
+        """
+
+        if (state["id_length"] != self._id_length
+                or state.get("partition") != self._partition
+                or state.get("permutation") != self.PERMUTATION):
+            return False
+        with self._lock:
+            self._set_key(state["key"])
+            self._counter = state["counter"]
+            self._free_ids = deque(state["free_ids"])
+        return True
+
     def get_event(self, qevent_id):
         """
         returns qevent from local db by identifier
         raise exception KeyError if qevent_id not found
         """
 
-        if qevent_id not in self._qevents.keys():
+        qevent = self._qevents.get(qevent_id)
+        if qevent is None:
             raise KeyError(f"Cannot find qevent_id={qevent_id} in local database")
 
-        return self._qevents[qevent_id]
+        return qevent
 
     def remove_event(self, qevent_id):
         """
@@ -227,8 +643,11 @@ class EventIdMapper():
         returns False if it no qevent_id was found in local db
         """
 
-        if qevent_id not in self._qevents.keys():
-            return False
-        else:
+        with self._lock:
+            if qevent_id not in self._qevents:
+                return False
             self._qevents.pop(qevent_id)
-            return True
\ No newline at end of file
+            # restored identifiers of other partitions are not reused
+            if self._is_own(qevent_id):
+                self._free_ids.append(qevent_id)
+            return True
@@ -0,0 +1,502 @@
+import os
+import zlib
+import time
+import pickle
+import struct
+import logging
+import threading
+from enum import IntEnum
+from datetime import datetime
+
+from questbot.events import EventState
+from questbot.results import EfficiencyController
+
+
+logger = logging.getLogger(__name__)
+
+
+class GameEvent(IntEnum):
+    STRING = 0          # defines a string referenced by other records
+    QUEST_STATE = 1
+    JOINED = 2
+    LEFT = 3
+    TEAM_STARTED = 4
+    TASK_STARTED = 5
+    HINT_TAKEN = 6
+    ANSWER_RIGHT = 7
+    ANSWER_WRONG = 8
+    TEAM_FINISHED = 9
+    TEAM_STOPPED = 10
+    TEAM_CLEARED = 11
+    QUEST_SESSION_STATE = 12    # QUEST_STATE of a session of a quest
+
+
+# every record is <length><crc32> header and <kind><timestamp><fields>
+# payload, strings in fields are ids of STRING records (0 is None)
+_HEADER = struct.Struct(">II")
+_FIELDS = {
+    GameEvent.QUEST_STATE: "IBIdd",     # quest event, state, qevent_id,
+                                        # start_date, duration
+    GameEvent.JOINED: "IIq",            # quest, team (None if pending), user
+    GameEvent.LEFT: "IIq",              # quest, team (None if pending), user
+    GameEvent.TEAM_STARTED: "II",       # quest, team
+    GameEvent.TASK_STARTED: "IIi",      # quest, team, task
+    GameEvent.HINT_TAKEN: "IIqi",       # quest, team, user, hint
+    GameEvent.ANSWER_RIGHT: "IIqI",     # quest, team, user, answer
+    GameEvent.ANSWER_WRONG: "IIqI",     # quest, team, user, answer
+    GameEvent.TEAM_FINISHED: "IIi",     # quest, team, task
+    GameEvent.TEAM_STOPPED: "II",       # quest, team
+    GameEvent.TEAM_CLEARED: "II",       # quest, team
+    GameEvent.QUEST_SESSION_STATE: "IIHBIdd",   # quest event, quest, session,
+                                                # state, qevent_id,
+                                                # start_date, duration
+}
+_PAYLOADS = {kind: struct.Struct(">Bd" + fields)
+             for kind, fields in _FIELDS.items()}
+_STRING = struct.Struct(">BdI")     # followed by utf-8 bytes
+
+
+class GameLog():
+    """
+    appends gameplay events to an append-only binary log
+
+    events are encoded in the calling thread and kept in a buffer that
+    is written to disk every <flush_interval> seconds by a separate
+    thread, so callers never wait for disk; the writer syncs the file
+    every <fsync_interval> seconds, so a crash of the process loses
+    at most the last flush_interval of events and a crash of the host
+    at most the last fsync_interval
+
+    every start writes a new segment file in the log directory, strings
+    (quest, team names and answers) are written once per segment and
+    then referenced by their ids; segments replayed on start are folded
+    into a checkpoint (see GameReplay.checkpoint())
+    """
+    FLUSH_INTERVAL = 0.2    # in seconds
+    FSYNC_INTERVAL = 1      # in seconds
+    PREFIX = "gamelog-"
+    SUFFIX = ".bin"
+
+    def __init__(self, path, flush_interval=None, fsync_interval=None):
+        self.path = path
+        self._flush_interval = flush_interval or self.FLUSH_INTERVAL
+        self._fsync_interval = fsync_interval or self.FSYNC_INTERVAL
+        os.makedirs(path, exist_ok=True)
+        number = last_segment_number(path) + 1
+        self.filename = os.path.join(path,
+                                     f"{self.PREFIX}{number:06d}{self.SUFFIX}")
+
+        self._strings = {None: 0}
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._file = open(self.filename, 'ab')
+        self._is_active = True
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _record(self, payload):
+        return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _string_id(self, value, timestamp):
+        """
+        must be called holding self._cond
+        """
+
+        string_id = self._strings.get(value)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings[value] = string_id
+            self._buffer.append(self._record(
+                _STRING.pack(GameEvent.STRING, timestamp, string_id)
+                + value.encode()))
+        return string_id
+
+    def append(self, kind, *fields, at=None):
+        """
+        accepts args:
+            kind - GameEvent
+            fields - values of the event fields, see _FIELDS
+            at - datetime of the event, now if it's None
+        queues the event to be written
+        """
+
+        timestamp = time.time() if at is None else at.timestamp()
+        with self._cond:
+            if not self._is_active:
+                return
+            values = [self._string_id(value, timestamp)
+                      if value is None or isinstance(value, str) else value
+                      for value in fields]
+            self._buffer.append(self._record(
+                _PAYLOADS[kind].pack(kind, timestamp, *values)))
+
+    def _write_loop(self):
+        synced_at = time.monotonic()
+        is_synced = True
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._is_active,
+                                    self._flush_interval)
+                batch, self._buffer = self._buffer, []
+                is_active = self._is_active
+
+            try:
+                if batch:
+                    self._file.write(b"".join(batch))
+                    self._file.flush()
+                    is_synced = False
+                if not is_synced and (
+                        not is_active
+                        or time.monotonic() - synced_at
+                        >= self._fsync_interval):
+                    os.fsync(self._file.fileno())
+                    synced_at = time.monotonic()
+                    is_synced = True
+            except OSError:
+                logger.exception(f"Cannot write {len(batch)} records "
+                                 f"to '{self.filename}'")
+            if not is_active:
+                break
+        self._file.close()
+
+    def close(self):
+        """
+        writes buffered events and stops the writer
+        """
+
+        with self._cond:
+            self._is_active = False
+            self._cond.notify_all()
+        self._writer.join()
+
+
+def list_segments(path):
+    """
+    returns sorted list of log segment files in directory path
+    """
+
+    return sorted(os.path.join(path, filename)
+                  for filename in os.listdir(path)
+                  if filename.startswith(GameLog.PREFIX)
+                  and filename.endswith(GameLog.SUFFIX))
+
+
+def segment_number(filename):
+    """
+    returns number of a log segment file
+    """
+
+    return int(os.path.basename(filename)
+               [len(GameLog.PREFIX):-len(GameLog.SUFFIX)])
+
+
+def last_segment_number(path):
+    """
+    returns number of the last segment written to directory path,
+    including segments folded into the checkpoint
+    returns 0 if no segment has been written
+    """
+
+    numbers = [segment_number(filename)
+               for filename in list_segments(path)]
+    checkpoint = GameReplay.load_checkpoint(path)
+    if checkpoint is not None:
+        numbers.append(checkpoint["segment"])
+    return max(numbers, default=0)
+
+
+class _TeamReplay():
+    __slots__ = ("name", "is_running", "current_task", "current_hint",
+                 "efficiency", "members")
+
+    def __init__(self, name):
+        self.name = name
+        self.is_running = False
+        self.current_task = -1
+        self.current_hint = 0
+        self.efficiency = EfficiencyController()
+        self.members = set()
+
+
+class _QuestReplay():
+    __slots__ = ("name", "quest", "session", "state", "qevent_id",
+                 "start_date", "duration", "pending_users", "teams")
+
+    def __init__(self, name):
+        self.name = name
+        self.quest = name
+        self.session = 1
+        self.state = None
+        self.qevent_id = None
+        self.start_date = None
+        self.duration = None
+        self.pending_users = set()
+        self.teams = {}
+
+
+class GameReplay():
+    """
+    rebuilds team states and scores by replaying game log
+
+    penalties are the same as in EfficiencyController by default, they
+    can be changed (as well as EfficiencyItem constants) to recompute
+    scores of past games with other rules
+
+    replayed segments of a log directory can be folded into a checkpoint
+    of replayed state, the next replay starts from the checkpoint and
+    replays only later segments; the checkpoint keeps computed scores,
+    so it's replayed with the penalties it has been made with
+    """
+    CHECKPOINT = "checkpoint.pickle"
+
+    def __init__(self, hint_penalty=None, wrong_answer_penalty=None):
+        self._hint_penalty = (EfficiencyController.HINT_PENALTY
+                              if hint_penalty is None else hint_penalty)
+        self._wrong_answer_penalty = (
+            EfficiencyController.WRONG_ANSWER_PENALTY
+            if wrong_answer_penalty is None else wrong_answer_penalty)
+        self._quests = {}
+        # checkpointed segment number and number of its events
+        self._segment = 0
+        self._events = 0
+        self._handlers = {
+            GameEvent.QUEST_STATE: self._quest_state,
+            GameEvent.JOINED: self._joined,
+            GameEvent.LEFT: self._left,
+            GameEvent.TEAM_STARTED: self._team_started,
+            GameEvent.TASK_STARTED: self._task_started,
+            GameEvent.HINT_TAKEN: self._hint_taken,
+            GameEvent.ANSWER_RIGHT: self._answer_right,
+            GameEvent.ANSWER_WRONG: self._answer_wrong,
+            GameEvent.TEAM_FINISHED: self._team_finished,
+            GameEvent.TEAM_STOPPED: self._team_stopped,
+            GameEvent.TEAM_CLEARED: self._team_cleared,
+            GameEvent.QUEST_SESSION_STATE: self._quest_session_state,
+        }
+
+    def replay(self, path):
+        """
+        replays a log segment or all segments of a log directory,
+        starting from its checkpoint
+        returns number of replayed events, events of the checkpoint
+        are counted as well
+        """
+
+        if not os.path.isdir(path):
+            return self._replay_segment(path)
+
+        checkpoint = self.load_checkpoint(path)
+        if checkpoint is not None:
+            self._quests = checkpoint["quests"]
+            self._segment = checkpoint["segment"]
+            self._events = checkpoint["events"]
+        for filename in list_segments(path):
+            number = segment_number(filename)
+            if number <= self._segment:
+                # removal of checkpointed segments has been interrupted
+                continue
+            self._events += self._replay_segment(filename)
+            self._segment = number
+        return self._events
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """
+        returns checkpoint of log directory path
+        returns None if there is no checkpoint
+        """
+
+        try:
+            with open(os.path.join(path, cls.CHECKPOINT), 'rb') as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            return None
+
+    def checkpoint(self, path):
+        """
+        saves replayed state of log directory path as its checkpoint and
+        removes replayed segments, it must be called before the next
+        segment is written (e.g. before GameLog is created)
+        returns number of removed segments
+        """
+
+        filename = os.path.join(path, self.CHECKPOINT)
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, 'wb') as file:
+            pickle.dump({"segment": self._segment, "events": self._events,
+                         "quests": self._quests}, file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, filename)
+
+        removed = 0
+        for segment in list_segments(path):
+            if segment_number(segment) <= self._segment:
+                os.remove(segment)
+                removed += 1
+        return removed
+
+    def _replay_segment(self, filename):
+        with open(filename, 'rb') as file:
+            data = file.read()
+
+        strings = [None]
+        handlers = self._handlers
+        payloads = _PAYLOADS
+        header_size = _HEADER.size
+        unpack_header = _HEADER.unpack_from
+        count = 0
+        offset = 0
+        while offset + header_size <= len(data):
+            length, checksum = unpack_header(data, offset)
+            start = offset + header_size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                # the tail has not been written completely
+                logger.warning(f"Game log '{filename}' has a torn record "
+                               f"at offset={offset}, it's ignored")
+                break
+            offset = start + length
+
+            kind = payload[0]
+            if kind == GameEvent.STRING:
+                strings.append(payload[_STRING.size:].decode())
+                continue
+            try:
+                _, timestamp, *fields = payloads[kind].unpack(payload)
+            except (KeyError, struct.error):
+                logger.warning(f"Game log '{filename}' has a record of "
+                               f"unknown format at offset={offset}, "
+                               "it's ignored")
+                continue
+            handlers[kind](strings, timestamp, *fields)
+            count += 1
+        return count
+
+    def _quest(self, name):
+        quest = self._quests.get(name)
+        if quest is None:
+            quest = self._quests[name] = _QuestReplay(name)
+        return quest
+
+    def _team(self, strings, quest_id, team_id):
+        quest = self._quest(strings[quest_id])
+        team_name = strings[team_id]
+        team = quest.teams.get(team_name)
+        if team is None:
+            team = quest.teams[team_name] = _TeamReplay(team_name)
+        return team
+
+    def _quest_state(self, strings, timestamp, quest_id, state, qevent_id,
+                     start_date, duration):
+        # quest events logged before sessions are single sessions of quests
+        self._quest_session_state(strings, timestamp, quest_id, quest_id, 1,
+                                  state, qevent_id, start_date, duration)
+
+    def _quest_session_state(self, strings, timestamp, quest_id,
+                             definition_id, session, state, qevent_id,
+                             start_date, duration):
+        quest = self._quest(strings[quest_id])
+        if (quest.start_date, quest.duration) != (start_date, duration):
+            # quest has been replaced by another definition
+            quest = self._quests[quest.name] = _QuestReplay(quest.name)
+            quest.start_date, quest.duration = start_date, duration
+        quest.quest = strings[definition_id]
+        quest.session = session
+        quest.state = state
+        quest.qevent_id = strings[qevent_id]
+
+    def _joined(self, strings, timestamp, quest_id, team_id, user_id):
+        quest = self._quest(strings[quest_id])
+        if team_id:
+            quest.pending_users.discard(user_id)
+            self._team(strings, quest_id, team_id).members.add(user_id)
+        else:
+            quest.pending_users.add(user_id)
+
+    def _left(self, strings, timestamp, quest_id, team_id, user_id):
+        if team_id:
+            self._team(strings, quest_id, team_id).members.discard(user_id)
+        else:
+            self._quest(strings[quest_id]).pending_users.discard(user_id)
+
+    def _team_started(self, strings, timestamp, quest_id, team_id):
+        team = self._team(strings, quest_id, team_id)
+        team.is_running = True
+        team.current_task = -1
+        team.current_hint = 0
+
+    def _task_started(self, strings, timestamp, quest_id, team_id, task):
+        team = self._team(strings, quest_id, team_id)
+        team.current_task = task
+        team.current_hint = 0
+        team.efficiency.new_task(datetime.fromtimestamp(timestamp))
+
+    def _hint_taken(self, strings, timestamp, quest_id, team_id, user_id,
+                    hint):
+        team = self._team(strings, quest_id, team_id)
+        team.current_hint = hint + 1
+        team.efficiency.add_penalty(self._hint_penalty)
+
+    def _answer_right(self, strings, timestamp, quest_id, team_id, user_id,
+                      answer):
+        team = self._team(strings, quest_id, team_id)
+        team.efficiency.finish_task(datetime.fromtimestamp(timestamp))
+
+    def _answer_wrong(self, strings, timestamp, quest_id, team_id, user_id,
+                      answer):
+        team = self._team(strings, quest_id, team_id)
+        team.efficiency.add_penalty(self._wrong_answer_penalty)
+
+    def _team_finished(self, strings, timestamp, quest_id, team_id, task):
+        team = self._team(strings, quest_id, team_id)
+        team.is_running = False
+        team.current_task = task
+
+    def _team_stopped(self, strings, timestamp, quest_id, team_id):
+        self._team(strings, quest_id, team_id).is_running = False
+
+    def _team_cleared(self, strings, timestamp, quest_id, team_id):
+        self._team(strings, quest_id, team_id).members.clear()
+
+    def scores(self):
+        """
+        returns dict of quest event name => dict of team name => total points
+        """
+
+        return {quest.name: {team.name: team.efficiency.appraise_total()
+                             for team in quest.teams.values()}
+                for quest in self._quests.values()}
+
+    def snapshot(self, controller_state=None):
+        """
+        returns replayed state in the format of QuestController.snapshot(),
+        controller_state (identifier allocation) is not in the log,
+        it's taken from a snapshot if it's set
+        """
+
+        quests = {}
+        for quest in self._quests.values():
+            if quest.state is None:
+                # quest events that have no state in the log are unknown
+                continue
+            quests[quest.name] = {
+                "name": quest.name,
+                "quest": quest.quest,
+                "session": quest.session,
+                "state": EventState(quest.state).name,
+                "qevent_id": quest.qevent_id,
+                "start_date": quest.start_date,
+                "duration": quest.duration,
+                "pending_users": sorted(quest.pending_users),
+                "teams": [{
+                    "name": team.name,
+                    "is_running": team.is_running,
+                    "current_task": team.current_task,
+                    "current_hint": team.current_hint,
+                    "efficiency": team.efficiency.snapshot(),
+                    "members": sorted(team.members),
+                } for team in quest.teams.values()],
+            }
+        return {"controller": controller_state, "quests": quests}
@@ -0,0 +1,99 @@
+import bisect
+import logging
+import threading
+
+import tabulate
+
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard():
+    """
+    keeps teams ordered by their running score
+
+    entries are kept in a sorted list, so "top N" is a slice and
+    "rank of a team" is a binary search; a score update finds its
+    entries in O(log T), but removing and inserting them shifts
+    the list, so it costs O(T) for T teams (a memmove, it's cheap
+    for teams of a quest); the rendered table is cached and
+    rendered again only when the ranking changes
+    """
+    TOP_SIZE = 10
+
+    def __init__(self):
+        self._entries = []  # sorted (-score, order, name)
+        self._keys = {}     # team key => its entry
+        self._lock = threading.Lock()
+        self._version = 0
+        self._rendered = (-1, "")
+
+    def add_team(self, key, name):
+        """
+        adds a team with zero score, teams with equal score
+        are ranked in order of adding
+        """
+
+        with self._lock:
+            entry = (0, len(self._keys), name)
+            self._keys[key] = entry
+            bisect.insort(self._entries, entry)
+            self._version += 1
+
+    def update(self, key, score):
+        """
+        sets a new score for the team
+        returns True if the ranking has changed
+        """
+
+        with self._lock:
+            entry = self._keys[key]
+            if entry[0] == -score:
+                return False
+
+            del self._entries[bisect.bisect_left(self._entries, entry)]
+            entry = (-score, entry[1], entry[2])
+            bisect.insort(self._entries, entry)
+            self._keys[key] = entry
+            self._version += 1
+            return True
+
+    def top(self, count):
+        """
+        returns list of (name, score) for count best teams
+        """
+
+        with self._lock:
+            return [(name, -score)
+                    for score, _, name in self._entries[:count]]
+
+    def rank(self, key):
+        """
+        returns 1-based rank of the team
+        returns None if the team is unknown
+        """
+
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                return None
+            return bisect.bisect_left(self._entries, entry) + 1
+
+    def render(self):
+        """
+        returns table of TOP_SIZE best teams
+        """
+
+        with self._lock:
+            version, table = self._rendered
+            if version == self._version:
+                return table
+            version = self._version
+            rows = [[f"#{idx + 1}", name, -score] for idx, (score, _, name)
+                    in enumerate(self._entries[:self.TOP_SIZE])]
+
+        table = tabulate.tabulate(rows, tablefmt="orgtbl")
+        with self._lock:
+            if version > self._rendered[0]:
+                self._rendered = (version, table)
+        return table
@@ -0,0 +1,69 @@
+import unicodedata
+
+
+def normalize_answer(value):
+    """
+    returns answer in a canonical form to compare answers with:
+    NFKC normalized, casefolded, 'ё' replaced with 'е',
+    whitespaces collapsed into a single space
+    """
+
+    value = unicodedata.normalize("NFKC", value).casefold()
+    return " ".join(value.replace("ё", "е").split())
+
+
+def within_distance(source, target, max_distance):
+    """
+    returns True if Damerau-Levenshtein (optimal string alignment)
+    distance between strings is not greater than max_distance
+
+    only a diagonal band of width 2 * max_distance + 1 is computed
+    and it stops as soon as the whole band row exceeds max_distance,
+    so it costs O(max_distance * len(source))
+    """
+
+    len_source, len_target = len(source), len(target)
+    if abs(len_source - len_target) > max_distance:
+        return False
+    if source == target:
+        return True
+
+    # band offset o of row i corresponds to column j = i - max_distance + o
+    limit = max_distance + 1
+    width = 2 * max_distance + 1
+    prev2 = [limit] * width
+    prev = [o - max_distance if 0 <= o - max_distance <= len_target else limit
+            for o in range(width)]
+    cur = [limit] * width
+
+    for i in range(1, len_source + 1):
+        char = source[i - 1]
+        row_min = limit
+        for o in range(width):
+            j = i - max_distance + o
+            if j < 0 or j > len_target:
+                cur[o] = limit
+                continue
+            if j == 0:
+                value = i
+            else:
+                value = prev[o] + (char != target[j - 1])
+                if o + 1 < width and prev[o + 1] + 1 < value:
+                    value = prev[o + 1] + 1
+                if o > 0 and cur[o - 1] + 1 < value:
+                    value = cur[o - 1] + 1
+                if (i > 1 and j > 1 and char == target[j - 2]
+                        and source[i - 2] == target[j - 1]
+                        and prev2[o] + 1 < value):
+                    value = prev2[o] + 1
+            if value > limit:
+                value = limit
+            cur[o] = value
+            if value < row_min:
+                row_min = value
+
+        if row_min > max_distance:
+            return False
+        prev2, prev, cur = prev, cur, prev2
+
+    return prev[len_target - len_source + max_distance] <= max_distance
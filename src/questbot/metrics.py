@@ -0,0 +1,474 @@
+import abc
+import time
+import bisect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"'
+                          for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    """
+    base class for metrics, every combination of label values
+    has its own child, so updates of different label values never
+    wait for each other; the child of a metric without labels is
+    cached, so its updates don't look it up
+    """
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._children = {}
+        self._default = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._name
+
+    def _child(self, labels):
+        """
+        returns child for label values, it's created on the first use
+        """
+
+        if not labels and self._default is not None:
+            return self._default
+        try:
+            if len(labels) != len(self._labelnames):
+                raise KeyError
+            key = tuple([str(labels[name]) for name in self._labelnames])
+        except KeyError:
+            raise ValueError(f"metric '{self._name}' expects labels "
+                             f"{list(self._labelnames)}") from None
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new_child()
+                    if not key:
+                        self._default = child
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """
+        returns a new child for a combination of label values
+        """
+
+    @abc.abstractmethod
+    def _samples(self):
+        """
+        yields (suffix, labels, value) for exposition
+        """
+
+    def render(self):
+        lines = [f"# HELP {self._name} {self._documentation}",
+                 f"# TYPE {self._name} {self.TYPE}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self._name}{suffix}{_format_labels(labels)} "
+                         f"{_format_value(value)}")
+        return "\n".join(lines)
+
+    def _labels(self, key):
+        return list(zip(self._labelnames, key))
+
+
+class _Value():
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+
+class _Cells():
+    """
+    value split into cells of threads, every thread adds only
+    to its own cell, so additions need no lock
+    """
+    __slots__ = ("cells",)
+
+    def __init__(self):
+        self.cells = {}
+
+    def add(self, amount):
+        ident = threading.get_ident()
+        cells = self.cells
+        cells[ident] = cells.get(ident, 0) + amount
+
+    @property
+    def value(self):
+        return sum(list(self.cells.values()))
+
+
+class Counter(Metric):
+    """
+    monotonically increasing value
+    """
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _Cells()
+
+    def inc(self, amount=1, **labels):
+        # the same as self._child(labels).add(amount), it's inlined
+        # as every sent message is counted
+        child = self._default if not labels else None
+        if child is None:
+            child = self._child(labels)
+        cells = child.cells
+        ident = threading.get_ident()
+        cells[ident] = cells.get(ident, 0) + amount
+
+    def get(self, **labels):
+        return self._child(labels).value
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            yield "", self._labels(key), child.value
+
+
+class Gauge(Metric):
+    """
+    value that goes up and down, or a function computed on exposition
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value, **labels):
+        # the last value wins, assignment needs no lock
+        self._child(labels).value = value
+
+    def get(self, **labels):
+        return self._child(labels).value
+
+    def set_function(self, function):
+        """
+        function() is called on exposition, it returns a value of the gauge
+        or a dict of label values tuple => value for labelled gauges
+        """
+
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                logger.exception(f"Cannot compute metric '{self._name}'")
+                return
+            if not isinstance(value, dict):
+                value = {(): value}
+            for key, item in value.items():
+                yield "", self._labels(key), item
+            return
+
+        for key, child in list(self._children.items()):
+            yield "", self._labels(key), child.value
+
+
+class _Buckets():
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+
+class Histogram(Metric):
+    """
+    counts observed values in buckets, quantiles are estimated from
+    buckets on exposition (the same way as histogram_quantile() does)
+    and exposed as <name>_quantile gauges
+    """
+    TYPE = "histogram"
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    QUANTILES = (0.5, 0.99)
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=None, quantiles=None):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets or self.BUCKETS))
+        self._quantiles = tuple(self.QUANTILES if quantiles is None
+                                else quantiles)
+
+    def _new_child(self):
+        # the last bucket is +Inf
+        return _Buckets(len(self._buckets) + 1)
+
+    def observe(self, value, **labels):
+        self._observe(self._child(labels), value)
+
+    def _observe(self, child, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with child.lock:
+            child.counts[index] += 1
+            child.sum += value
+            child.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        observes duration of the with block in seconds
+        """
+
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def timed(self, **labels):
+        """
+        returns decorator that observes duration of every call
+        """
+
+        # the child is looked up once, the decorated function
+        # can be on the hot path (e.g. answers of teams)
+        child = self._child(labels)
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self._observe(child, time.perf_counter() - started_at)
+            return wrapper
+        return decorator
+
+    def quantile(self, share, **labels):
+        """
+        returns estimated quantile of observed values
+        returns None if nothing was observed
+        """
+
+        child = self._child(labels)
+        with child.lock:
+            counts = list(child.counts)
+        return self._estimate(counts, share)
+
+    def _estimate(self, counts, share):
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = share * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if index == len(self._buckets):
+                    # values above the largest bucket are unknown
+                    return self._buckets[-1]
+                lower = self._buckets[index - 1] if index else 0.0
+                upper = self._buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self._buckets[-1]
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (float("inf"),),
+                                           counts):
+                cumulative += bucket_count
+                yield "_bucket", labels + [("le", _format_value(bound))], \
+                    cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+    def render(self):
+        text = super().render()
+        if not self._quantiles or not self._children:
+            return text
+
+        name = f"{self._name}_quantile"
+        lines = [text, f"# HELP {name} {self._documentation} "
+                       "(estimated quantiles)",
+                 f"# TYPE {name} gauge"]
+        for key, child in list(self._children.items()):
+            with child.lock:
+                counts = list(child.counts)
+            for share in self._quantiles:
+                value = self._estimate(counts, share)
+                if value is None:
+                    continue
+                labels = self._labels(key) + [("quantile", share)]
+                lines.append(f"{name}{_format_labels(labels)} "
+                             f"{_format_value(value)}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry():
+    """
+    keeps metrics by name and renders them in Prometheus text format
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                if not metric._labelnames:
+                    # metric without labels is exposed from the start
+                    metric._child({})
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric '{name}' is already registered "
+                                 f"as {type(metric).__name__}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        return self._register(Histogram, name, documentation,
+                              labelnames, **kwargs)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        returns all metrics in Prometheus text format
+        """
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+class MetricsServer():
+    """
+    serves registry on http://<host>:<port>/metrics in a separate thread
+    """
+    PATH = "/metrics"
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, registry, port, host="0.0.0.0"):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != server.PATH:
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", server.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} - {format % args}")
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on port {self.port}")
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+REGISTRY = MetricsRegistry()
+
+COMMAND_LATENCY = REGISTRY.histogram(
+    "questbot_command_latency_seconds",
+    "Time spent in bot command handlers", ("command",))
+COMMAND_ERRORS = REGISTRY.counter(
+    "questbot_command_errors_total",
+    "Bot command handlers that raised an exception", ("command",))
+TEAM_COMMAND_LATENCY = REGISTRY.histogram(
+    "questbot_team_command_latency_seconds",
+    "Time spent in team commands", ("command",))
+MESSAGES_SENT = REGISTRY.counter(
+    "questbot_messages_sent_total",
+    "Messages sent with sendMessage")
+MESSAGE_ERRORS = REGISTRY.counter(
+    "questbot_message_errors_total",
+    "sendMessage calls that failed")
+OUTBOX_PENDING = REGISTRY.gauge(
+    "questbot_outbox_pending",
+    "Messages queued for delivery")
+OUTBOX_DROPPED = REGISTRY.counter(
+    "questbot_outbox_dropped_total",
+    "Messages dropped because outbox is full")
+STORAGE_WRITE_TIME = REGISTRY.histogram(
+    "questbot_storage_write_seconds",
+    "Time spent in storage writes", ("engine", "operation"))
+UPDATE_TICK_TIME = REGISTRY.histogram(
+    "questbot_update_tick_seconds",
+    "Time spent by quest updater on due quest events")
+SNAPSHOT_TIME = REGISTRY.histogram(
+    "questbot_snapshot_seconds",
+    "Time spent on snapshots of quest controller state")
+ACTIVE_QUESTS = REGISTRY.gauge(
+    "questbot_active_quests",
+    "Quest events that are scheduled or running")
+ACTIVE_TEAMS = REGISTRY.gauge(
+    "questbot_active_teams",
+    "Teams of quest events that are scheduled or running")
+ACTIVE_PLAYERS = REGISTRY.gauge(
+    "questbot_active_players",
+    "Players of quest events that are scheduled or running")
+WEBHOOK_UPDATES = REGISTRY.counter(
+    "questbot_webhook_updates_total",
+    "Updates received by webhook", ("status",))
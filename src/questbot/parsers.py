@@ -1,18 +1,32 @@
 import os
+import time
 import logging
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
 
 import yaml
 from pytimeparse.timeparse import timeparse
 from jsonschema import validate
 from jsonschema.exceptions import ValidationError
 
+from questbot.cache import QuestCache
 from questbot.schemas import schemav1
 from questbot.definitions import QuestDefinition, TeamDefinition, TaskDefinition
 
 
 logger = logging.getLogger(__name__)
 
+# libyaml based loader is much faster, but it's not always available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _load_source(filepath):
+    """
+    module-level entry point for worker processes
+    """
+
+    return QuestParser().load_source(filepath)
+
 
 class QuestParser():
     """
@@ -23,21 +37,32 @@ class QuestParser():
     def __init__(self):
         pass
 
-    def _parse_yaml_file(self, filepath):
+    def _read_file(self, filepath):
+        """
+        returns ((mtime_ns, size), content) of file,
+        stat is taken before the file is read
+        returns (None, None) if file cannot be read
+        """
+
+        try:
+            stat = os.stat(filepath)
+            with open(filepath, "rb") as file:
+                return (stat.st_mtime_ns, stat.st_size), file.read()
+        except OSError:
+            print("Cannot read configuration file, "
+                  "check path and permissions")
+            return None, None
+
+    def _parse_yaml(self, content):
         """
-        parses yaml file and returns object
+        parses yaml content and returns object
         """
 
         try:
-            with open(filepath, "r") as file:
-                return yaml.safe_load(file)
-        except (yaml.YAMLError, OSError) as exc:
-            if isinstance(exc, OSError):
-                print("Cannot read configuration file, "
-                      "check path and permissions")
-            if isinstance(exc, yaml.YAMLError):
-                print("Config file has incorrect format, "
-                      "cannot parse config options")
+            return yaml.load(content, Loader=YAML_LOADER)
+        except yaml.YAMLError:
+            print("Config file has incorrect format, "
+                  "cannot parse config options")
             return None
 
     def _validate_definition(self, definition):
@@ -47,37 +72,121 @@ class QuestParser():
         except ValidationError:
             return False
 
+    def load_definition(self, filepath):
+        """
+        returns validated quest definition object (plain dict)
+        returns None if parsing or validation failed
+        """
+
+        return self.load_source(filepath)[0]
+
+    def load_source(self, filepath):
+        """
+        returns (definition, stat, digest) of file, where definition
+        is validated quest definition object (None if parsing or
+        validation failed), stat and digest are of the parsed content
+        (see QuestCache.store())
+        """
+
+        stat, content = self._read_file(filepath)
+        if content is None:
+            return None, None, None
+        obj = self._parse_yaml(content)
+        if not self._validate_definition(obj):
+            logger.error("ValidationError: validation failed "
+                         f"for quest definition '{filepath}'")
+            obj = None
+        return obj, stat, QuestCache.digest(content)
+
     def process(self, filepath):
         """
         returns QuestDefinition object if processing is successfull
         and None if processing failed
         """
 
-        obj = self._parse_yaml_file(filepath)
-        if not self._validate_definition(obj):
-            logger.error("ValidationError: validation failed "
-                         "for quest definition")
+        obj = self.load_definition(filepath)
+        if obj is None:
             return None
+        return self._try_build(obj, filepath)
 
-        quest = QuestDefinition()
-        quest.name, quest.description = obj["name"], obj["description"]
-        quest.duration = timedelta(seconds=timeparse(obj["duration"]))
-        quest.start_date = datetime.fromisoformat(obj["start_date"])
+    def process_many(self, filepaths, cache=None):
+        """
+        returns list of QuestDefinition objects (None if processing
+        of a file failed) in the same order as filepaths
 
-        for team_obj in obj["teams"]:
-            team = TeamDefinition()
-            team.name = team_obj["name"]
-            team.description = team_obj["description"]
-            team.communication = team_obj["communication"]
-            for task_obj in team_obj["tasks"]:
-                task = TaskDefinition()
-                task.question = task_obj["question"]
-                task.answer = task_obj["answer"]
-                for hint in task_obj["hints"]:
-                    task.add_hint(hint)
-                team.add_task(task)
-            quest.add_team(team)
+        unchanged files are taken from QuestCache if it's specified,
+        changed files are parsed in parallel by worker processes
+        """
 
+        started_at = time.perf_counter()
+        objs = {}
+        changed = []
+        for filepath in filepaths:
+            obj = cache.lookup(filepath) if cache is not None else None
+            if obj is None:
+                changed.append(filepath)
+            else:
+                objs[filepath] = obj
+
+        if len(changed) > 1:
+            workers = min(len(changed), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                sources = list(executor.map(_load_source, changed))
+        else:
+            sources = [self.load_source(filepath) for filepath in changed]
+
+        for filepath, (obj, stat, digest) in zip(changed, sources):
+            objs[filepath] = obj
+            if cache is not None and obj is not None:
+                # the digest is of the parsed content, the file may
+                # have been changed after it's parsed
+                cache.store(filepath, obj, stat, digest)
+        if cache is not None:
+            cache.save()
+
+        logger.info(f"Processed {len(filepaths)} quest files "
+                    f"({len(changed)} parsed, "
+                    f"{len(filepaths) - len(changed)} cached) in "
+                    f"{time.perf_counter() - started_at:.3f}s")
+        return [None if objs[filepath] is None
+                else self._try_build(objs[filepath], filepath)
+                for filepath in filepaths]
+
+    def _try_build(self, obj, filepath):
+        """
+        returns QuestDefinition object or None if values are invalid
+        """
+
+        try:
+            return self.build(obj)
+        except ValueError as exc:
+            logger.error(f"ValueError: {exc} in quest definition "
+                         f"'{filepath}'")
+            return None
+
+    def build(self, obj):
+        """
+        returns QuestDefinition object built from
+        validated quest definition object
+        """
+
+        teams = []
+        for team_obj in obj["teams"]:
+            tasks = [TaskDefinition(task_obj["question"],
+                                    task_obj["answer"],
+                                    task_obj["hints"],
+                                    task_obj.get("fuzzy", 0))
+                     for task_obj in team_obj["tasks"]]
+            teams.append(TeamDefinition(team_obj["name"],
+                                        team_obj["description"],
+                                        team_obj["communication"],
+                                        tasks))
+
+        quest = QuestDefinition(
+            obj["name"], obj["description"],
+            datetime.fromisoformat(obj["start_date"]),
+            timedelta(seconds=timeparse(obj["duration"])),
+            teams, obj.get("sessions", 1), obj.get("schedule"))
         return quest
 
     def list(self, directory):
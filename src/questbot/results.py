@@ -9,30 +9,60 @@ class EfficiencyController:
     """
     controls the result for a team to rate its efficiency
     """
+    HINT_PENALTY = 2
+    WRONG_ANSWER_PENALTY = 3
 
     def __init__(self):
         self._tasks = []
+        self._total = 0
+        self._listeners = []
+        self._penalty_counter = 0
+        self._start_date = None
 
-    def new_task(self):
+    @property
+    def total(self):
         """
-        registers a new task as a current task
+        running total of appraise numbers for finished tasks
         """
-        self._penalty_counter = 0
-        self._start_date = datetime.now()
 
-        pass
+        return self._total
 
-    def finish_task(self):
+    def add_listener(self, callback):
         """
-        finishes a current task
+        registers callback(total) called on every score change
         """
 
-        self._tasks.append(EfficiencyItem(datetime.now() - self._start_date,
-                                          self._penalty_counter))
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback(self._total)
+
+    def new_task(self, started_at=None):
+        """
+        registers a new task as a current task,
+        started_at is datetime.now() if it's not set
+        """
+        self._penalty_counter = 0
+        self._start_date = started_at or datetime.now()
+
+    def finish_task(self, finished_at=None):
+        """
+        finishes a current task,
+        finished_at is datetime.now() if it's not set
+        """
+
+        item = EfficiencyItem((finished_at or datetime.now())
+                              - self._start_date,
+                              self._penalty_counter)
+        self._tasks.append(item)
+        self._total += sum(item.appraise())
+        self._notify()
 
     def add_penalty(self, value):
         """
-        adds penalty for a current task
+        adds penalty for a current task,
+        total changes only when the task is finished
         """
 
         self._penalty_counter += value
@@ -47,11 +77,48 @@ class EfficiencyController:
 
     def appraise_total(self):
         """
-        appraise each element in self._tasks
-        returns int - total sum of appraise numbers
+        returns int - total sum of appraise numbers,
+        it's maintained by finish_task()
+        """
+
+        return self._total
+
+    def export(self):
+        """
+        returns a tuple of durations (in seconds) and penalties lists
+        of finished tasks, it can be passed to ScoringEngine
+        """
+
+        return ([item.duration.total_seconds() for item in self._tasks],
+                [item.penalty for item in self._tasks])
+
+    def snapshot(self):
+        """
+        returns state of the controller as plain python values
+        """
+
+        durations, penalties = self.export()
+        return {
+            "durations": durations,
+            "penalties": penalties,
+            "penalty": self._penalty_counter,
+            "started_at": (None if self._start_date is None
+                           else self._start_date.timestamp()),
+        }
+
+    def restore(self, state):
+        """
+        replaces state of the controller with one returned by snapshot()
         """
 
-        return sum([sum(item.appraise()) for item in self._tasks])
+        self._tasks = [EfficiencyItem(timedelta(seconds=duration), penalty)
+                       for duration, penalty in zip(state["durations"],
+                                                    state["penalties"])]
+        self._total = sum(sum(item.appraise()) for item in self._tasks)
+        self._penalty_counter = state["penalty"]
+        self._start_date = (None if state["started_at"] is None
+                            else datetime.fromtimestamp(state["started_at"]))
+        self._notify()
 
 
 class EfficiencyItem():
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+
+class CronSchedule():
+    """
+    cron-like schedule of quest starts, expression has 5 fields:
+        minute (0-59) hour (0-23) day of month (1-31) month (1-12)
+        day of week (0-6, 0 is Sunday)
+    every field is '*' or a comma separated list of values, ranges
+    (a-b) and steps (*/n, a-b/n); if both day fields are restricted,
+    a day matches either of them (the same as in cron, a field that
+    starts with '*', e.g. '*/2', is not restricted)
+    """
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+    MAX_DAYS = 5 * 366  # search horizon for the next start
+
+    def __init__(self, expression):
+        if not isinstance(expression, str):
+            raise ValueError("expression must be string")
+        fields = expression.split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError(f"expression '{expression}' must have "
+                             f"{len(self.FIELDS)} fields")
+
+        self._expression = expression
+        (self._minutes, self._hours, self._days,
+         self._months, self._weekdays) = [
+            self._parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self.FIELDS)]
+        self._any_day = fields[2].startswith("*")
+        self._any_weekday = fields[4].startswith("*")
+        self._sorted_hours = sorted(self._hours)
+        self._sorted_minutes = sorted(self._minutes)
+
+    @property
+    def expression(self):
+        return self._expression
+
+    def _parse_field(self, field, low, high):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = self._parse_number(step, 1, high - low + 1)
+            if part == "*":
+                first, last = low, high
+            elif "-" in part:
+                first, last = (self._parse_number(value, low, high)
+                               for value in part.split("-", 1))
+                if first > last:
+                    raise ValueError(f"range '{part}' is empty")
+            else:
+                first = last = self._parse_number(part, low, high)
+                if step > 1:
+                    last = high
+            values.update(range(first, last + 1, step))
+        return frozenset(values)
+
+    def _parse_number(self, value, low, high):
+        if not value.isdigit() or not low <= int(value) <= high:
+            raise ValueError(f"value '{value}' must be an integer "
+                             f"in range [{low}, {high}]")
+        return int(value)
+
+    def _is_day(self, date):
+        if date.month not in self._months:
+            return False
+        is_day = date.day in self._days
+        # Monday is 0 in python, Sunday is 0 in cron
+        is_weekday = (date.weekday() + 1) % 7 in self._weekdays
+        if self._any_day or self._any_weekday:
+            return is_day and is_weekday
+        return is_day or is_weekday
+
+    def next_after(self, moment):
+        """
+        returns datetime of the first start strictly after moment
+        returns None if there're no starts in MAX_DAYS
+        """
+
+        moment = moment.replace(second=0, microsecond=0)
+        date = moment.date()
+        for _ in range(self.MAX_DAYS):
+            if self._is_day(date):
+                for hour in self._sorted_hours:
+                    for minute in self._sorted_minutes:
+                        start = datetime(date.year, date.month, date.day,
+                                         hour, minute)
+                        if start > moment:
+                            return start
+            date += timedelta(days=1)
+        return None
@@ -6,6 +6,8 @@ schemav1 = {
         "description": {"type": "string"},
         "start_date": {"type": "string"},
         "duration": {"type": "string"},
+        "sessions": {"type": "integer", "minimum": 1},
+        "schedule": {"type": "string"},
         "teams": {
             "type": "array",
             "items": {
@@ -22,7 +24,22 @@ schemav1 = {
                             "required": ["question","answer","hints"],
                             "properties": {
                                 "question": {"type": "string"},
-                                "answer": {"type": "string"},
+                                "answer": {
+                                    "oneOf": [
+                                        {"type": "string"},
+                                        {
+                                            "type": "array",
+                                            "minItems": 1,
+                                            "items": {
+                                                "type": "string"
+                                            }
+                                        }
+                                    ]
+                                },
+                                "fuzzy": {
+                                    "type": "integer",
+                                    "minimum": 0
+                                },
                                 "hints": {
                                     "type": "array",
                                     "items": {
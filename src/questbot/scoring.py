@@ -0,0 +1,137 @@
+import logging
+from array import array
+
+from questbot.results import EfficiencyItem
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScoringEngine():
+    """
+    scores finished tasks of many teams in one pass
+
+    tasks are kept in compact parallel arrays (duration in seconds and
+    penalty of every task), tasks of a team take a contiguous slice of
+    them; scoring rules are the same as EfficiencyItem.appraise()
+
+    numpy is used to score all tasks at once when it's installed,
+    otherwise tasks are scored by a plain loop over the arrays
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._offsets = array("q", [0])
+        self._durations = array("d")
+        self._penalties = array("q")
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def keys(self):
+        return self._keys
+
+    def add_team(self, key, durations, penalties):
+        """
+        adds finished tasks of a team,
+        durations are in seconds, penalties are hint penalty counters
+        """
+
+        durations = array("d", durations)
+        penalties = array("q", penalties)
+        if len(durations) != len(penalties):
+            raise ValueError("durations and penalties must be "
+                             "of the same length")
+        if any(penalty < 0 for penalty in penalties):
+            raise ValueError("penalty must be an integer value >= 0")
+
+        self._keys.append(key)
+        self._durations.extend(durations)
+        self._penalties.extend(penalties)
+        self._offsets.append(len(self._durations))
+
+    def add_controller(self, key, eff_controller):
+        """
+        adds finished tasks of EfficiencyController
+        """
+
+        self.add_team(key, *eff_controller.export())
+
+    def appraise(self):
+        """
+        returns a tuple of (completed, no_penalty, time) points
+        sequences, one value per task in order of adding
+        """
+
+        if numpy is not None:
+            return self._appraise_vectorized()
+        return self._appraise_loop()
+
+    def _appraise_vectorized(self):
+        durations = numpy.frombuffer(self._durations, dtype=numpy.float64)
+        penalties = numpy.frombuffer(self._penalties, dtype=numpy.int64)
+
+        completed = numpy.full(len(durations), EfficiencyItem.COMPLETED_BONUS,
+                               dtype=numpy.int64)
+        no_penalty = numpy.maximum(
+            0, EfficiencyItem.NO_PENALTY_BONUS
+            - penalties * EfficiencyItem.PENALTY_VALUE)
+        # same operation order as in EfficiencyItem to get equal rounding,
+        # astype() truncates towards zero like int()
+        time = numpy.maximum(
+            0, EfficiencyItem.TIME_BONUS
+            - (EfficiencyItem.TIME_BONUS * durations
+               / EfficiencyItem.DURATION_MAX_VALUE.total_seconds()
+               ).astype(numpy.int64))
+        return completed, no_penalty, time
+
+    def _appraise_loop(self):
+        completed_bonus = EfficiencyItem.COMPLETED_BONUS
+        no_penalty_bonus = EfficiencyItem.NO_PENALTY_BONUS
+        penalty_value = EfficiencyItem.PENALTY_VALUE
+        time_bonus = EfficiencyItem.TIME_BONUS
+        max_duration = EfficiencyItem.DURATION_MAX_VALUE.total_seconds()
+
+        completed = array("q", [completed_bonus]) * len(self._durations)
+        no_penalty = array("q", [
+            max(0, no_penalty_bonus - penalty * penalty_value)
+            for penalty in self._penalties])
+        time = array("q", [
+            max(0, time_bonus - int(time_bonus * duration / max_duration))
+            for duration in self._durations])
+        return completed, no_penalty, time
+
+    def score(self):
+        """
+        returns dict of team key => total points
+        """
+
+        completed, no_penalty, time = self.appraise()
+        offsets = self._offsets
+
+        if numpy is not None:
+            points = completed + no_penalty + time
+            # running sum makes a team total a difference of two values
+            cumsum = numpy.concatenate(([0], numpy.cumsum(points)))
+            bounds = numpy.frombuffer(offsets, dtype=numpy.int64)
+            totals = (cumsum[bounds[1:]] - cumsum[bounds[:-1]]).tolist()
+        else:
+            points = [sum(item) for item in zip(completed, no_penalty, time)]
+            totals = [sum(points[offsets[idx]:offsets[idx + 1]])
+                      for idx in range(len(self._keys))]
+
+        return dict(zip(self._keys, totals))
+
+    def ranking(self):
+        """
+        returns list of (key, total points) sorted by points,
+        teams with equal points are kept in order of adding
+        """
+
+        return sorted(self.score().items(), key=lambda item: -item[1])
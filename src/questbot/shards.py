@@ -0,0 +1,680 @@
+import os
+import zlib
+import logging
+import functools
+import itertools
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import Future
+
+from questbot.users import User, UserState
+from questbot.events import EventIdMapper, EventDistributor
+from questbot.broadcast import Broadcast, BroadcastScheduler
+from questbot.controllers import QuestController
+from questbot.snapshots import SnapshotStore, Snapshotter
+from questbot.gamelog import GameLog, GameReplay
+
+
+logger = logging.getLogger(__name__)
+
+
+class Channel():
+    """
+    message channel between two processes over a duplex connection
+    of multiprocessing, both ends of it are the same
+
+    a message is (call_id, method, args): queued messages are sent in
+    batches by a writer thread, received messages are handled one by one
+    in order of arrival by a reader thread, so handlers must not wait
+    for the other end; call() returns Future resolved with the result
+    of the handler on the other end (it may return Future as well)
+    """
+    RESULT = "result"
+
+    def __init__(self, connection, handlers, name, on_close=None):
+        self._connection = connection
+        self._handlers = handlers
+        self._name = name
+        self._on_close = on_close
+        self._calls = {}    # call_id => Future
+        self._call_ids = itertools.count(1)
+        self._outbox = []
+        self._cond = threading.Condition()
+        self._is_active = True
+        self._writer = threading.Thread(target=self._write_loop, daemon=True,
+                                        name=f"{name}-writer")
+        self._reader = threading.Thread(target=self._read_loop, daemon=True,
+                                        name=f"{name}-reader")
+
+    def start(self):
+        self._writer.start()
+        self._reader.start()
+
+    def send(self, method, *args):
+        """
+        queues a message that has no reply
+        """
+
+        with self._cond:
+            if self._is_active:
+                self._outbox.append((None, method, args))
+                self._cond.notify()
+
+    def call(self, method, *args):
+        """
+        queues a message to the other end
+        returns concurrent.futures.Future with its result
+        """
+
+        future = Future()
+        with self._cond:
+            if not self._is_active:
+                future.set_exception(
+                    ConnectionError(f"Channel '{self._name}' is closed"))
+                return future
+            call_id = next(self._call_ids)
+            self._calls[call_id] = future
+            self._outbox.append((call_id, method, args))
+            self._cond.notify()
+        return future
+
+    def _reply(self, call_id, result, error):
+        with self._cond:
+            if self._is_active:
+                self._outbox.append((call_id, self.RESULT, (result, error)))
+                self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._outbox or not self._is_active)
+                batch, self._outbox = self._outbox, []
+                is_active = self._is_active
+
+            if batch:
+                try:
+                    self._connection.send(batch)
+                except (OSError, ValueError):
+                    logger.error(f"Cannot send {len(batch)} messages to "
+                                 f"channel '{self._name}', it's closed")
+                    break
+            if not is_active:
+                break
+
+    def _read_loop(self):
+        while True:
+            try:
+                batch = self._connection.recv()
+            except (EOFError, OSError):
+                break
+            for call_id, method, args in batch:
+                if method == self.RESULT:
+                    self._resolve(call_id, *args)
+                else:
+                    self._handle(call_id, method, args)
+
+        with self._cond:
+            self._is_active = False
+            calls, self._calls = self._calls, {}
+            self._cond.notify()
+        for future in calls.values():
+            future.set_exception(
+                ConnectionError(f"Channel '{self._name}' is closed"))
+        if self._on_close is not None:
+            self._on_close()
+
+    def _resolve(self, call_id, result, error):
+        with self._cond:
+            future = self._calls.pop(call_id, None)
+        if future is None:
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(RuntimeError(error))
+
+    def _handle(self, call_id, method, args):
+        try:
+            result = self._handlers[method](*args)
+        except Exception as e:
+            logger.exception(f"Cannot handle method='{method}' "
+                             f"of channel '{self._name}'")
+            if call_id is not None:
+                self._reply(call_id, None, f"{type(e).__name__}: {str(e)}")
+            return
+
+        if call_id is None:
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(
+                functools.partial(self._reply_future, call_id))
+        else:
+            self._reply(call_id, result, None)
+
+    def _reply_future(self, call_id, future):
+        error = future.exception()
+        if error is None:
+            self._reply(call_id, future.result(), None)
+        else:
+            self._reply(call_id, None, f"{type(error).__name__}: {str(error)}")
+
+    def close(self):
+        """
+        sends queued messages and closes the connection
+        """
+
+        with self._cond:
+            self._is_active = False
+            self._cond.notify()
+        if self._writer.is_alive():
+            self._writer.join()
+        self._connection.close()
+
+
+# front process knows only names of remote teams
+RemoteTeam = namedtuple("RemoteTeam", ["name"])
+
+
+class RemoteTeamController():
+    """
+    team controller of a user in a shard as it's seen by front process,
+    team commands are forwarded to the shard
+    """
+
+    def __init__(self, channel, user_id, team_name):
+        self._channel = channel
+        self._user_id = user_id
+        self._team = RemoteTeam(team_name)
+
+    @property
+    def team(self):
+        return self._team
+
+    def give_hint(self, user):
+        """
+        returns concurrent.futures.Future with result of give_hint()
+        """
+
+        return self._channel.call("give_hint", user.user_id)
+
+    def check_answer(self, user, value):
+        """
+        returns concurrent.futures.Future with result of check_answer()
+        """
+
+        return self._channel.call("check_answer", user.user_id, value)
+
+    def get_leaderboard(self):
+        return self._channel.call("get_leaderboard", self._user_id).result()
+
+
+class RemoteUser(User):
+    """
+    user of front process in a shard, changes of its state are
+    reported to front process
+    """
+
+    def __init__(self, user_id, chat_id, channel):
+        self._channel = None    # initial state is not reported
+        super().__init__(user_id, chat_id, None)
+        self._channel = channel
+
+    @User.state.setter
+    def state(self, value):
+        User.state.fset(self, value)
+        if self._channel is not None:
+            team_controller = self.get_team_controller()
+            self._channel.send(
+                "user_state", self.user_id, value,
+                None if team_controller is None
+                else team_controller.team.name)
+
+
+class RemoteScheduler():
+    """
+    broadcast scheduler of a shard, deliveries are handed to
+    the broadcast scheduler of front process, so rate limits
+    are shared by all shards
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def submit(self, deliveries):
+        """
+        returns Broadcast handle, messages are counted as sent
+        once they're handed to front process
+        """
+
+        deliveries = [(user.user_id, message) for user, message in deliveries]
+        self._channel.send("deliver", deliveries)
+        broadcast = Broadcast(len(deliveries))
+        for _ in deliveries:
+            broadcast._record(True)
+        return broadcast
+
+    def shutdown(self):
+        pass
+
+
+class RemoteDistributor():
+    """
+    distributor of quest-wide notifications of a shard,
+    they're sent to users subscribed in front process
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def notify_template(self, template_name, **kwargs):
+        """
+        returns empty Broadcast handle, messages are rendered for
+        subscribed users in front process, so the shard doesn't wait
+        for them holding locks of quest controller
+        """
+
+        self._channel.send("notify_template", template_name, kwargs)
+        return Broadcast(0)
+
+
+class RemoteStorage():
+    """
+    storage of a shard, memberships and results are
+    written to the storage of front process
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def add_membership(self, user_id, quest_name, team_name):
+        self._channel.send("add_membership", user_id, quest_name, team_name)
+
+    def remove_membership(self, user_id):
+        self._channel.send("remove_membership", user_id)
+
+    def add_result(self, quest_name, team_name, total_points):
+        self._channel.send("add_result", quest_name, team_name, total_points)
+
+
+class ShardWorker():
+    """
+    runs QuestController of a shard in a worker process and handles
+    commands of front process received through the channel
+
+    snapshots and game log of a shard are kept in "shard-<index>"
+    subdirectories of their paths
+    """
+
+    def __init__(self, index, count, connection, options):
+        self._index = index
+        self._users = {}    # user_id => RemoteUser
+        self._stopped = threading.Event()
+        self._is_linked = False
+        self._is_shutdown = False
+        self._channel = Channel(connection, {
+            "register": self._register,
+            "replace": self._replace,
+            "retire": self._retire,
+            "get_state": self._get_state,
+            "get_stats": self._get_stats,
+            "join_quest": self._join_quest,
+            "leave_quest": self._leave_quest,
+            "relink_users": self._relink_users,
+            "give_hint": self._give_hint,
+            "check_answer": self._check_answer,
+            "get_leaderboard": self._get_leaderboard,
+            "shutdown": self._shutdown,
+        }, f"shard-{index}", on_close=self._stopped.set)
+
+        restored_state = None
+        self._snapshot_store = None
+        if options["snapshot_interval"] > 0:
+            self._snapshot_store = SnapshotStore(
+                self._shard_path(options["snapshot_path"]))
+            restored_state = self._snapshot_store.load()
+        self._game_log = None
+        if options["game_log_path"]:
+            game_log_path = self._shard_path(options["game_log_path"])
+            if os.path.isdir(game_log_path):
+                replay = GameReplay()
+                if replay.replay(game_log_path):
+                    restored_state = replay.snapshot(
+                        restored_state and restored_state["controller"])
+                replay.checkpoint(game_log_path)
+            self._game_log = GameLog(game_log_path)
+
+        self._controller = QuestController(
+            RemoteStorage(self._channel),
+            deferred_assignment=options["deferred_assignment"],
+            restored_state=restored_state,
+            game_log=self._game_log,
+            scheduler=RemoteScheduler(self._channel),
+            distributor=RemoteDistributor(self._channel),
+            event_mapper=EventIdMapper(options["event_id_length"],
+                                       partition=(index, count)))
+        self._snapshotter = None
+        if self._snapshot_store is not None:
+            self._snapshotter = Snapshotter(self._controller,
+                                            self._snapshot_store,
+                                            options["snapshot_interval"])
+
+    def _shard_path(self, path):
+        return os.path.join(path, f"shard-{self._index}")
+
+    def _user(self, user_info):
+        """
+        returns RemoteUser for (user_id, chat_id, name, lang_code)
+        """
+
+        user_id, chat_id, name, lang_code = user_info
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = RemoteUser(user_id, chat_id,
+                                                     self._channel)
+        user.name = name
+        user.lang_code = lang_code
+        return user
+
+    def _team_controller(self, user_id):
+        user = self._users.get(user_id)
+        return None if user is None else user.get_team_controller()
+
+    def _register(self, quest_definition):
+        return self._controller.register(quest_definition)
+
+    def _replace(self, quest_definition):
+        return self._controller.replace(quest_definition)
+
+    def _retire(self, quest_name):
+        return self._controller.retire(quest_name)
+
+    def _get_state(self, quest_name):
+        return self._controller.get_state(quest_name)
+
+    def _get_stats(self):
+        return self._controller.get_stats()
+
+    def _join_quest(self, user_info, qevent_id):
+        return self._controller.join_quest(self._user(user_info), qevent_id)
+
+    def _leave_quest(self, user_id):
+        user = self._users.get(user_id)
+        return user is not None and self._controller.leave_quest(user)
+
+    def _relink_users(self, user_infos):
+        for user_info in user_infos:
+            self._user(user_info)
+        linked = self._controller.relink_users(self._users)
+        if self._snapshotter is not None and not self._is_linked:
+            # users are linked to restored teams, state can be saved
+            self._snapshotter.start()
+        self._is_linked = True
+        return linked
+
+    def _give_hint(self, user_id):
+        team_controller = self._team_controller(user_id)
+        if team_controller is None:
+            return None
+        return team_controller.give_hint(self._users[user_id])
+
+    def _check_answer(self, user_id, value):
+        team_controller = self._team_controller(user_id)
+        if team_controller is None:
+            return None
+        return team_controller.check_answer(self._users[user_id], value)
+
+    def _get_leaderboard(self, user_id):
+        team_controller = self._team_controller(user_id)
+        if team_controller is None:
+            return "", None
+        return team_controller.get_leaderboard()
+
+    def _shutdown(self):
+        if not self._is_shutdown:
+            self._is_shutdown = True
+            if self._snapshotter is not None:
+                self._snapshotter.stop()
+            self._controller.shutdown()
+            if self._game_log is not None:
+                self._game_log.close()
+        self._stopped.set()
+        return True
+
+    def run(self):
+        """
+        handles commands until front process shuts the shard down
+        or closes the channel
+        """
+
+        self._channel.start()
+        self._stopped.wait()
+        self._shutdown()
+        self._channel.close()
+        logger.info(f"Shard #{self._index} has stopped")
+
+
+def run_shard(index, count, connection, options):
+    """
+    entry point of a shard process
+    """
+
+    ShardWorker(index, count, connection, options).run()
+
+
+class ShardedQuestController():
+    """
+    partitions quest events across <shards> worker processes, every
+    shard runs its own QuestController with team controllers of its
+    quests, so team commands of different shards don't share the GIL
+
+    front process owns users and Telegram transport: quest commands
+    are forwarded to the shard that owns the quest (by hash of quest
+    name) or the quest event (by qevent_id, see EventIdMapper partition),
+    team commands to the shard of the user's team; messages, quest-wide
+    notifications, memberships and results come back through the same
+    channel and are delivered by the broadcast scheduler of front process
+
+    NOTE:
+    snapshots and game log of a shard are kept per shard, changing the
+    number of shards moves quests to other shards without their state
+    """
+    START_METHOD = "spawn"
+
+    def __init__(self, shards, storage=None, event_id_length=None,
+                 deferred_assignment=False, send_workers=None,
+                 snapshot_path=None, snapshot_interval=0,
+                 game_log_path=None):
+        if shards < 1:
+            raise ValueError("shards must be an integer value >= 1")
+        self._storage = storage
+        self._event_id_length = event_id_length or EventIdMapper.ID_LENGTH
+        self._scheduler = BroadcastScheduler(send_workers)
+        self._distributor = EventDistributor(self._scheduler)
+        self._users = {}        # user_id => User, set by relink_users()
+        self._user_shards = {}  # user_id => index of the shard
+        self._user_lock = threading.Lock()
+        self._is_active = True
+
+        options = {
+            "event_id_length": self._event_id_length,
+            "deferred_assignment": deferred_assignment,
+            "snapshot_path": snapshot_path,
+            "snapshot_interval": snapshot_interval,
+            "game_log_path": game_log_path,
+        }
+        context = multiprocessing.get_context(self.START_METHOD)
+        self._channels = []
+        self._processes = []
+        for index in range(shards):
+            connection, shard_connection = context.Pipe()
+            process = context.Process(
+                target=run_shard, name=f"shard-{index}", daemon=True,
+                args=(index, shards, shard_connection, options))
+            process.start()
+            shard_connection.close()
+
+            channel = Channel(connection, {
+                "deliver": self._deliver,
+                "notify_template": self._notify_template,
+                "user_state": functools.partial(self._update_user, index),
+                "add_membership": self._add_membership,
+                "remove_membership": self._remove_membership,
+                "add_result": self._add_result,
+            }, f"front-{index}",
+                on_close=functools.partial(self._on_shard_closed, index))
+            channel.start()
+            self._channels.append(channel)
+            self._processes.append(process)
+        logger.info(f"Started {shards} quest shards")
+
+    @property
+    def distributor(self):
+        return self._distributor
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def event_id_length(self):
+        return self._event_id_length
+
+    @property
+    def shards(self):
+        return len(self._channels)
+
+    def _quest_channel(self, quest_name):
+        return self._channels[zlib.crc32(quest_name.encode())
+                              % len(self._channels)]
+
+    def _user_info(self, user):
+        return (user.user_id, user.chat_id, user.name, user.lang_code)
+
+    def register(self, quest_definition):
+        return self._quest_channel(quest_definition.name).call(
+            "register", quest_definition).result()
+
+    def replace(self, quest_definition):
+        return self._quest_channel(quest_definition.name).call(
+            "replace", quest_definition).result()
+
+    def retire(self, quest_name):
+        return self._quest_channel(quest_name).call(
+            "retire", quest_name).result()
+
+    def get_state(self, quest_name):
+        return self._quest_channel(quest_name).call(
+            "get_state", quest_name).result()
+
+    def get_stats(self):
+        """
+        returns sums of get_stats() of all shards
+        """
+
+        stats = {"quests": 0, "teams": 0, "players": 0}
+        futures = [channel.call("get_stats") for channel in self._channels]
+        for future in futures:
+            for key, value in future.result().items():
+                stats[key] += value
+        return stats
+
+    def join_quest(self, user, qevent_id):
+        """
+        returns True if user has been registered for a quest event
+        returns False if user failed to be registered for a quest event
+        """
+
+        channel = self._channels[int(qevent_id) % len(self._channels)]
+        return channel.call("join_quest", self._user_info(user),
+                            qevent_id).result()
+
+    def leave_quest(self, user):
+        """
+        returns True if success
+        returns False if user has no team controllers
+        """
+
+        with self._user_lock:
+            index = self._user_shards.get(user.user_id)
+        if index is None:
+            return False
+        return self._channels[index].call("leave_quest",
+                                          user.user_id).result()
+
+    def relink_users(self, users):
+        """
+        keeps users dict to deliver messages of shards to them
+        and links users to teams restored by shards
+        returns number of linked users
+        """
+
+        self._users = users
+        user_infos = [self._user_info(user) for user in list(users.values())]
+        futures = [channel.call("relink_users", user_infos)
+                   for channel in self._channels]
+        return sum(future.result() for future in futures)
+
+    def _deliver(self, deliveries):
+        users = self._users
+        self._scheduler.submit([(users[user_id], message)
+                                for user_id, message in deliveries
+                                if user_id in users])
+
+    def _notify_template(self, template_name, kwargs):
+        broadcast = self._distributor.notify_template(template_name, **kwargs)
+        logger.debug(f"Queued {broadcast.total} notifications "
+                     f"template_name='{template_name}' of a shard")
+
+    def _update_user(self, index, user_id, state, team_name):
+        user = self._users.get(user_id)
+        if user is None or user.state == UserState.DELETED:
+            return
+
+        with self._user_lock:
+            if state == UserState.IDLE:
+                self._user_shards.pop(user_id, None)
+            else:
+                self._user_shards[user_id] = index
+        if state == UserState.PLAYING:
+            user.set_team_controller(RemoteTeamController(
+                self._channels[index], user_id, team_name))
+        elif state == UserState.IDLE:
+            user.remove_team_controller()
+        else:
+            user.state = state
+
+    def _add_membership(self, user_id, quest_name, team_name):
+        if self._storage is not None:
+            self._storage.add_membership(user_id, quest_name, team_name)
+
+    def _remove_membership(self, user_id):
+        if self._storage is not None:
+            self._storage.remove_membership(user_id)
+
+    def _add_result(self, quest_name, team_name, total_points):
+        if self._storage is not None:
+            self._storage.add_result(quest_name, team_name, total_points)
+
+    def _on_shard_closed(self, index):
+        if self._is_active:
+            logger.error(f"Shard #{index} has closed its channel, "
+                         "its quests are not available")
+
+    def shutdown(self):
+        """
+        stops shards and message delivery
+        """
+
+        self._is_active = False
+        futures = [channel.call("shutdown") for channel in self._channels]
+        for index, future in enumerate(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f"Cannot shut down shard #{index}")
+        for channel, process in zip(self._channels, self._processes):
+            channel.close()
+            process.join()
+        self._scheduler.shutdown()
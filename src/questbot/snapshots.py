@@ -0,0 +1,198 @@
+import os
+import zlib
+import time
+import pickle
+import struct
+import hashlib
+import logging
+import threading
+
+from questbot.metrics import SNAPSHOT_TIME
+
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotStore():
+    """
+    keeps snapshots of QuestController state in a directory
+
+    every quest event has its own file, a snapshot rewrites only files
+    whose content has changed since the previous one; a file is a header
+    (magic, format version, length, crc32) followed by zlib-compressed
+    pickle of plain python values, it's replaced atomically, so a crash
+    leaves either the previous or the new version of it
+    """
+    MAGIC = b"QBSN"
+    VERSION = 1
+    SUFFIX = ".snap"
+    CONTROLLER_FILENAME = f"controller{SUFFIX}"
+
+    _HEADER = struct.Struct(">4sHII")   # magic, version, length, crc32
+
+    def __init__(self, path):
+        self.path = path
+        self._checksums = {}    # filename => crc32 of written payload
+        os.makedirs(path, exist_ok=True)
+
+    def _quest_filename(self, quest_name):
+        digest = hashlib.sha1(quest_name.encode()).hexdigest()[:16]
+        return f"quest-{digest}{self.SUFFIX}"
+
+    def _write(self, filename, payload):
+        filepath = os.path.join(self.path, filename)
+        tmp_filepath = f"{filepath}.tmp"
+        with open(tmp_filepath, 'wb') as file:
+            file.write(self._HEADER.pack(self.MAGIC, self.VERSION,
+                                         len(payload), zlib.crc32(payload)))
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filepath, filepath)
+
+    def _read(self, filename):
+        """
+        returns value stored in the file
+        returns None if the file is damaged or has another version
+        """
+
+        filepath = os.path.join(self.path, filename)
+        with open(filepath, 'rb') as file:
+            header = file.read(self._HEADER.size)
+            if len(header) < self._HEADER.size:
+                logger.warning(f"Snapshot '{filepath}' is truncated")
+                return None
+            magic, version, length, checksum = self._HEADER.unpack(header)
+            if magic != self.MAGIC or version != self.VERSION:
+                logger.warning(f"Snapshot '{filepath}' has unknown format "
+                               f"version={version}")
+                return None
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                logger.warning(f"Snapshot '{filepath}' is damaged")
+                return None
+        return pickle.loads(zlib.decompress(payload))
+
+    def _sync_directory(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def save(self, state):
+        """
+        writes state returned by QuestController.snapshot()
+        returns number of written files
+        """
+
+        values = {self.CONTROLLER_FILENAME: state["controller"]}
+        for quest_name, quest_state in state["quests"].items():
+            values[self._quest_filename(quest_name)] = quest_state
+
+        written = 0
+        for filename, value in values.items():
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            checksum = zlib.crc32(data)
+            if self._checksums.get(filename) == checksum:
+                continue
+            self._write(filename, zlib.compress(data))
+            self._checksums[filename] = checksum
+            written += 1
+
+        for filename in set(self._checksums) - set(values):
+            # quest event is unregistered
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except FileNotFoundError:
+                pass
+            self._checksums.pop(filename)
+            written += 1
+
+        if written:
+            self._sync_directory()
+        return written
+
+    def load(self):
+        """
+        returns state in the format of QuestController.snapshot()
+        returns None if there's no snapshot
+        """
+
+        filenames = [filename for filename in sorted(os.listdir(self.path))
+                     if filename.endswith(self.SUFFIX)]
+        if self.CONTROLLER_FILENAME not in filenames:
+            return None
+
+        state = {"controller": None, "quests": {}}
+        for filename in filenames:
+            try:
+                value = self._read(filename)
+            except Exception as e:
+                logger.error(f"Cannot read snapshot '{filename}': {str(e)}")
+                continue
+            if value is None:
+                continue
+            # unchanged files are not rewritten by the next save()
+            self._checksums[filename] = zlib.crc32(
+                pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            if filename == self.CONTROLLER_FILENAME:
+                state["controller"] = value
+            else:
+                state["quests"][value["name"]] = value
+
+        if state["controller"] is None:
+            return None
+        logger.info(f"Loaded snapshot of {len(state['quests'])} quest "
+                    f"events from '{self.path}'")
+        return state
+
+
+class Snapshotter():
+    """
+    saves snapshots of QuestController to SnapshotStore every
+    <interval> seconds in a separate thread, the last one is saved
+    on stop()
+    """
+    INTERVAL = 10   # in seconds
+
+    def __init__(self, quest_controller, store, interval=None):
+        self._controller = quest_controller
+        self._store = store
+        self._interval = interval or self.INTERVAL
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def snapshot(self):
+        """
+        saves a snapshot of quest controller
+        returns number of written files
+        """
+
+        started_at = time.perf_counter()
+        with SNAPSHOT_TIME.time():
+            written = self._store.save(self._controller.snapshot())
+        logger.debug(f"Saved snapshot with {written} changed files in "
+                     f"{time.perf_counter() - started_at:.3f}s")
+        return written
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception("Cannot save snapshot of quest controller")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        stops periodic snapshots and saves the last one
+        """
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.snapshot()
@@ -1,22 +1,105 @@
+import os
+import abc
+import zlib
+import time
 import pickle
+import struct
+import sqlite3
 import logging
+import weakref
+import threading
+from datetime import datetime
+
+from questbot.metrics import STORAGE_WRITE_TIME
 
 
 logger = logging.getLogger(__name__)
 
+# value of a journal record that didn't exist
+_MISSING = object()
+
+
+class StorageEngine(abc.ABC):
+    """
+    base class for storage engines
+
+    engine keeps user records (dicts) by user_id, engines that
+    have no indexes for memberships and results just ignore them
+    """
+
+    @abc.abstractmethod
+    def save(self, data):
+        """
+        replaces all stored user records with data dict
+        """
+
+    @abc.abstractmethod
+    def load(self):
+        """
+        returns dict of all stored user records
+        returns None if records cannot be loaded
+        """
+
+    @abc.abstractmethod
+    def put(self, key, value):
+        """
+        stores a single user record by key
+        """
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """
+        removes a single user record by key
+        """
+
+    def add_membership(self, user_id, quest_name, team_name):
+        pass
+
+    def remove_membership(self, user_id):
+        pass
+
+    def load_memberships(self):
+        """
+        returns dict of user_id => (quest_name, team_name)
+        of stored team memberships
+        """
+
+        return {}
+
+    def add_result(self, quest_name, team_name, total_points):
+        pass
+
+    def close(self):
+        pass
+
+
+class DataStorage(StorageEngine):
+    """
+    stores a dict of records as a single pickle file,
+    every change rewrites the whole file
+    """
 
-class DataStorage:
     def __init__(self, filename):
         self.filename = filename
+        self._data = {}
+        # handlers of different chats write in parallel
+        self._write_lock = threading.Lock()
 
-    def save(self, data):
+    def _dump(self, data):
         with open(self.filename, 'wb') as file:
             pickle.dump(data, file)
 
+    @STORAGE_WRITE_TIME.timed(engine="pickle", operation="save")
+    def save(self, data):
+        with self._write_lock:
+            self._dump(data)
+            self._data = dict(data)
+
     def load(self):
         try:
             with open(self.filename, 'rb') as file:
                 data = pickle.load(file)
+                self._data = dict(data)
                 return data
         except FileNotFoundError:
             logger.error(f"File '{self.filename}' not found.")
@@ -24,3 +107,566 @@ class DataStorage:
         except Exception as e:
             logger.error(f"An error occurred while loading the data: {str(e)}")
             return None
+
+    @STORAGE_WRITE_TIME.timed(engine="pickle", operation="put")
+    def put(self, key, value):
+        """
+        stores a single record by key
+        """
+
+        with self._write_lock:
+            self._data[key] = value
+            self._dump(self._data)
+
+    @STORAGE_WRITE_TIME.timed(engine="pickle", operation="delete")
+    def delete(self, key):
+        """
+        removes a single record by key
+        """
+
+        with self._write_lock:
+            self._data.pop(key, None)
+            self._dump(self._data)
+
+
+class JournalStorage(DataStorage):
+    """
+    stores a pickle snapshot (same format as DataStorage) and
+    an append-only journal of changes made after the snapshot
+
+    journal records are group-committed by a writer thread with
+    one fsync per batch, a compactor thread folds the journal into
+    a new snapshot when it grows over COMPACT_RECORDS
+
+    if a batch cannot be written, it's dropped: its records are
+    rolled back in memory and its waiters get the OSError, records
+    appended without waiting are only logged as lost
+    """
+    COMMIT_DELAY = 0.005    # in seconds, time to gather a batch
+    RETRY_DELAY = 1         # in seconds, pause after a failed write
+    COMPACT_RECORDS = 10000
+
+    _HEADER = struct.Struct("<II")  # payload length, payload crc32
+    _OP_PUT = 1
+    _OP_DELETE = 2
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.journal_filename = f"{filename}.journal"
+        self._rotated_filename = f"{filename}.journal.1"
+        self._journal = None
+        self._batch = _JournalBatch()
+        self._journal_records = 0
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._is_active = True
+
+        self._compact_event = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._compactor = threading.Thread(target=self._compact_loop,
+                                           daemon=True)
+        self._writer.start()
+        self._compactor.start()
+
+    def _encode(self, op, key, value):
+        payload = pickle.dumps((op, key, value),
+                               protocol=pickle.HIGHEST_PROTOCOL)
+        return self._HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _replay(self, filename, data):
+        """
+        applies journal records to data dict
+        returns number of applied records
+        """
+
+        count = 0
+        valid_offset = 0
+        try:
+            with open(filename, 'rb') as file:
+                while True:
+                    header = file.read(self._HEADER.size)
+                    if len(header) < self._HEADER.size:
+                        break
+                    length, checksum = self._HEADER.unpack(header)
+                    payload = file.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != checksum:
+                        break
+                    op, key, value = pickle.loads(payload)
+                    if op == self._OP_PUT:
+                        data[key] = value
+                    elif op == self._OP_DELETE:
+                        data.pop(key, None)
+                    count += 1
+                    valid_offset = file.tell()
+
+                is_torn = file.seek(0, os.SEEK_END) != valid_offset
+        except FileNotFoundError:
+            return 0
+
+        if is_torn:
+            # crash in the middle of a write, drop the incomplete tail
+            logger.warning(f"Journal '{filename}' has a torn record, "
+                           f"truncating it at offset={valid_offset}")
+            with open(filename, 'r+b') as file:
+                file.truncate(valid_offset)
+        return count
+
+    def load(self):
+        data = {}
+        if os.path.exists(self.filename):
+            data = super().load()
+            if data is None:
+                return None
+
+        with self._cond:
+            # rotated journal exists if compaction has been interrupted
+            replayed = self._replay(self._rotated_filename, data)
+            replayed += self._replay(self.journal_filename, data)
+            self._data = data
+            self._journal_records = replayed
+
+        logger.info(f"Restored {len(data)} records from '{self.filename}' "
+                    f"and {replayed} journal records")
+        if replayed > self.COMPACT_RECORDS:
+            self._compact_event.set()
+        return dict(data)
+
+    @STORAGE_WRITE_TIME.timed(engine="journal", operation="save")
+    def save(self, data):
+        """
+        replaces all stored records with data
+        """
+
+        with self._cond:
+            for key in set(self._data) - set(data):
+                self._append(self._OP_DELETE, key, None)
+            for key, value in data.items():
+                self._append(self._OP_PUT, key, value)
+            batch = self._batch
+        self._wait_commit(batch)
+
+    @STORAGE_WRITE_TIME.timed(engine="journal", operation="put")
+    def put(self, key, value, wait=True):
+        """
+        appends a single record to the journal
+        blocks until the record is on disk if wait is True
+        """
+
+        with self._cond:
+            batch = self._append(self._OP_PUT, key, value)
+        if wait:
+            self._wait_commit(batch)
+
+    @STORAGE_WRITE_TIME.timed(engine="journal", operation="delete")
+    def delete(self, key, wait=True):
+        """
+        appends a record removal to the journal
+        blocks until the record is on disk if wait is True
+        """
+
+        with self._cond:
+            batch = self._append(self._OP_DELETE, key, None)
+        if wait:
+            self._wait_commit(batch)
+
+    def close(self):
+        """
+        commits pending records and stops background threads
+        """
+
+        with self._cond:
+            self._is_active = False
+            self._cond.notify_all()
+        self._writer.join()
+        self._compact_event.set()
+        self._compactor.join()
+
+    def _append(self, op, key, value):
+        """
+        must be called holding self._cond
+        returns batch the record is added to
+        """
+
+        batch = self._batch
+        if key not in batch.undo:
+            batch.undo[key] = self._data.get(key, _MISSING)
+        if op == self._OP_PUT:
+            self._data[key] = value
+        else:
+            self._data.pop(key, None)
+        batch.records.append(self._encode(op, key, value))
+        self._cond.notify_all()
+        return batch
+
+    def _wait_commit(self, batch):
+        """
+        blocks until the batch is on disk
+        raises OSError if the batch cannot be written
+        """
+
+        with self._cond:
+            while not batch.is_done and self._writer.is_alive():
+                self._cond.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def _rollback(self, batch):
+        """
+        must be called holding self._cond
+        restores records changed by a dropped batch, the next batch
+        (already applied on top of it) is left as it is
+        """
+
+        for key, value in batch.undo.items():
+            if key in self._batch.undo:
+                # the next batch rolls back to the state before both
+                self._batch.undo[key] = value
+            elif value is _MISSING:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = value
+
+    def _committed_data(self):
+        """
+        must be called holding self._cond
+        returns copy of records without ones of the pending batch
+        """
+
+        data = dict(self._data)
+        for key, value in self._batch.undo.items():
+            if value is _MISSING:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        return data
+
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_filename, 'ab')
+        return self._journal
+
+    def _discard_tail(self, offset):
+        """
+        must be called holding self._io_lock
+        drops a partially written batch, so it can be written again
+        """
+
+        if self._journal is None:
+            return
+        journal, self._journal = self._journal, None
+        try:
+            journal.close()
+        except OSError:
+            pass
+        try:
+            os.truncate(self.journal_filename, offset)
+        except OSError:
+            logger.exception(f"Cannot truncate '{self.journal_filename}' "
+                             f"at offset={offset}")
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while self._is_active and not self._batch.records:
+                    self._cond.wait()
+                if not self._batch.records:
+                    break
+                is_active = self._is_active
+
+            if is_active:
+                # let concurrent writers join the batch
+                time.sleep(self.COMMIT_DELAY)
+
+            with self._cond:
+                batch, self._batch = self._batch, _JournalBatch()
+
+            error = None
+            offset = None
+            with self._io_lock:
+                try:
+                    journal = self._open_journal()
+                    offset = journal.tell()
+                    journal.write(b"".join(batch.records))
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                except OSError as e:
+                    logger.exception(f"Cannot write {len(batch.records)} "
+                                     f"records to '{self.journal_filename}', "
+                                     f"they are dropped")
+                    error = e
+                    self._discard_tail(offset)
+
+            with self._cond:
+                if error is None:
+                    self._journal_records += len(batch.records)
+                    if self._journal_records > self.COMPACT_RECORDS:
+                        self._compact_event.set()
+                else:
+                    self._rollback(batch)
+                    batch.error = error
+                batch.is_done = True
+                self._cond.notify_all()
+
+            if error is not None and is_active:
+                time.sleep(self.RETRY_DELAY)
+
+        with self._io_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _compact_loop(self):
+        while True:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            if not self._is_active:
+                return
+            try:
+                self._compact()
+            except OSError:
+                logger.exception(f"Cannot compact journal "
+                                 f"'{self.journal_filename}'")
+
+    def _compact(self):
+        """
+        folds the journal into a new snapshot
+
+        the snapshot may already contain some records of the new journal,
+        replaying them again on restore gives the same state
+        """
+
+        started_at = time.perf_counter()
+        with self._io_lock:
+            if os.path.exists(self._rotated_filename):
+                logger.warning(f"Previous compaction of '{self.filename}' "
+                               "was interrupted, it will be repeated")
+            else:
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                if os.path.exists(self.journal_filename):
+                    os.replace(self.journal_filename, self._rotated_filename)
+            with self._cond:
+                # records of the pending batch go to the new journal
+                data = self._committed_data()
+                records = self._journal_records
+                self._journal_records = 0
+
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'wb') as file:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self.filename)
+        if os.path.exists(self._rotated_filename):
+            os.remove(self._rotated_filename)
+
+        logger.info(f"Compacted {records} journal records into "
+                    f"'{self.filename}' in "
+                    f"{time.perf_counter() - started_at:.3f}s")
+
+
+class _JournalBatch():
+    """
+    records written to the journal by a single fsync
+    """
+    __slots__ = ("records", "undo", "is_done", "error")
+
+    def __init__(self):
+        self.records = []
+        # key => value before the batch, _MISSING if there was none
+        self.undo = {}
+        self.is_done = False
+        self.error = None
+
+
+class _ThreadConnection():
+    """
+    keeps a connection of a single thread, it's closed as soon as
+    the thread exits and drops the thread-local reference
+    (the connection itself is in reference cycles of its statements)
+    """
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __del__(self):
+        self.conn.close()
+
+
+class SQLiteStorage(StorageEngine):
+    """
+    stores users, team memberships and quest results in indexed
+    tables of a local SQLite database, every change touches single rows
+
+    each thread gets its own connection, WAL mode lets readers
+    proceed while another thread writes and writers wait for
+    each other no longer than BUSY_TIMEOUT
+    """
+    BUSY_TIMEOUT = 5  # in seconds
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            lang_code TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS users_lang_code ON users (lang_code);
+
+        CREATE TABLE IF NOT EXISTS memberships (
+            user_id INTEGER PRIMARY KEY
+                REFERENCES users (user_id) ON DELETE CASCADE,
+            quest_name TEXT NOT NULL,
+            team_name TEXT NOT NULL,
+            joined_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS memberships_team
+            ON memberships (quest_name, team_name);
+
+        CREATE TABLE IF NOT EXISTS results (
+            result_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            quest_name TEXT NOT NULL,
+            team_name TEXT NOT NULL,
+            total_points INTEGER NOT NULL,
+            finished_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_quest ON results (quest_name);
+    """
+    _UPSERT_USER = ("INSERT INTO users VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET "
+                    "chat_id = excluded.chat_id, name = excluded.name, "
+                    "lang_code = excluded.lang_code")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._lock = threading.Lock()
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connection(self):
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # connection is used by a single thread, but closed by any
+            conn = sqlite3.connect(self.filename, timeout=self.BUSY_TIMEOUT,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            holder = self._local.holder = _ThreadConnection(conn)
+            with self._lock:
+                self._connections.add(holder)
+        return holder.conn
+
+    def _user_row(self, value):
+        return (value["user_id"], value["chat_id"],
+                value["name"], value.get("lang_code", ""))
+
+    @STORAGE_WRITE_TIME.timed(engine="sqlite", operation="save")
+    def save(self, data):
+        # rows are updated in place, so memberships of kept users
+        # are not removed by ON DELETE CASCADE
+        with self._connection() as conn:
+            stored = [user_id for user_id, in
+                      conn.execute("SELECT user_id FROM users")]
+            conn.executemany("DELETE FROM users WHERE user_id = ?",
+                             [(user_id,) for user_id in stored
+                              if user_id not in data])
+            conn.executemany(self._UPSERT_USER,
+                             [self._user_row(value)
+                              for value in data.values()])
+
+    def load(self):
+        try:
+            rows = self._connection().execute(
+                "SELECT user_id, chat_id, name, lang_code FROM users")
+            return {
+                user_id: {
+                    "name": name,
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "lang_code": lang_code
+                }
+                for user_id, chat_id, name, lang_code in rows
+            }
+        except sqlite3.Error as e:
+            logger.error(f"An error occurred while loading the data: {str(e)}")
+            return None
+
+    def get(self, key):
+        """
+        returns a single user record by key
+        returns None if no record is found
+        """
+
+        row = self._connection().execute(
+            "SELECT user_id, chat_id, name, lang_code FROM users "
+            "WHERE user_id = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        user_id, chat_id, name, lang_code = row
+        return {"name": name, "user_id": user_id,
+                "chat_id": chat_id, "lang_code": lang_code}
+
+    @STORAGE_WRITE_TIME.timed(engine="sqlite", operation="put")
+    def put(self, key, value):
+        with self._connection() as conn:
+            conn.execute(self._UPSERT_USER, self._user_row(value))
+
+    @STORAGE_WRITE_TIME.timed(engine="sqlite", operation="delete")
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM users WHERE user_id = ?", (key,))
+
+    def add_membership(self, user_id, quest_name, team_name):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO memberships "
+                         "VALUES (?, ?, ?, ?)",
+                         (user_id, quest_name, team_name,
+                          datetime.now().isoformat()))
+
+    def remove_membership(self, user_id):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM memberships WHERE user_id = ?",
+                         (user_id,))
+
+    def load_memberships(self):
+        rows = self._connection().execute(
+            "SELECT user_id, quest_name, team_name FROM memberships")
+        return {user_id: (quest_name, team_name)
+                for user_id, quest_name, team_name in rows}
+
+    def add_result(self, quest_name, team_name, total_points):
+        with self._connection() as conn:
+            conn.execute("INSERT INTO results (quest_name, team_name, "
+                         "total_points, finished_at) VALUES (?, ?, ?, ?)",
+                         (quest_name, team_name, total_points,
+                          datetime.now().isoformat()))
+
+    def close(self):
+        with self._lock:
+            for holder in list(self._connections):
+                holder.conn.close()
+            self._connections = weakref.WeakSet()
+        self._local = threading.local()
+
+
+STORAGE_ENGINES = {
+    "pickle": DataStorage,
+    "journal": JournalStorage,
+    "sqlite": SQLiteStorage,
+}
+
+
+def create_storage(engine, filename):
+    """
+    returns storage instance for specified engine name
+    """
+
+    if engine not in STORAGE_ENGINES:
+        raise ValueError(f"Unknown storage engine '{engine}', available "
+                         f"engines are {list(STORAGE_ENGINES)}")
+    return STORAGE_ENGINES[engine](filename)
@@ -1,4 +1,6 @@
+import threading
 from string import Template
+from collections import OrderedDict
 
 
 class BotTemplates():
@@ -57,6 +59,7 @@ class BotTemplates():
                            "▫️<code>/unregister</code> — отказаться от участия в квесте\n"
                            "▫️<code>/answer ОТВЕТ</code> — дать ответ в текущем квесте\n"
                            "▫️<code>/hint</code> — запросить подсказку в текущем квесте\n"
+                           "▫️<code>/leaderboard</code> — таблица лидеров текущего квеста\n"
                            "▫️<code>/deleteme</code> — полное удаление профиля в боте\n")
         },
         "quest_scheduled": {
@@ -152,23 +155,75 @@ class BotTemplates():
                            "ℹ️ <i>Каждый ряд отражает номер задачи, бонус за выполнение, за отсутствие штрафов и за время соответственно</i>"
                            "")
         },
+        "leaderboard": {
+            "ru": Template("🏆 <b>Таблица лидеров</b>\n\n"
+                           "<code>$table</code>\n\n"
+                           "<b>Ваша команда</b>: $team_name (#$team_rank)")
+        },
+        "leaderboard_fail": {
+            "ru": Template("❌ <b>Ошибка</b>!\n\nВы не участвуете в квесте, чтобы посмотреть таблицу лидеров.")
+        },
         "delete_profile": {
             "ru": Template("☠️ Вы покидаете данный сервер, но вы можете вернуться, выполнив /start.\n\n"
                            "")
         },
     }
 
-    def get_answer_template(self, template_name, prefer_lang_code):
+    RENDER_CACHE_SIZE = 256
+
+    # rendered answers are shared by all instances
+    _render_cache = OrderedDict()
+    _render_lock = threading.Lock()
+
+    def resolve_lang_code(self, template_name, prefer_lang_code):
         """
-        returns answer template for specified name and preferred lang code
+        returns lang code of the template that will be used
+        for specified name and preferred lang code
         """
 
         if template_name not in self.ANSWER_TEMPLATES:
             raise KeyError(f"Cannot find an answer template with "
                            f"template_name={template_name}")
         if prefer_lang_code not in self.ANSWER_TEMPLATES[template_name]:
-            lang_code = self.DEFAULT_LANG_CODE
-        else:
-            lang_code = prefer_lang_code
+            return self.DEFAULT_LANG_CODE
+        return prefer_lang_code
+
+    def get_answer_template(self, template_name, prefer_lang_code):
+        """
+        returns answer template for specified name and preferred lang code
+        """
+
+        lang_code = self.resolve_lang_code(template_name, prefer_lang_code)
+        return self.ANSWER_TEMPLATES[template_name][lang_code]
+
+    def render(self, template_name, prefer_lang_code, **kwargs):
+        """
+        returns answer for specified name and preferred lang code
+        substituted with kwargs
+
+        recently rendered answers are reused from LRU cache
+        """
+
+        lang_code = self.resolve_lang_code(template_name, prefer_lang_code)
+        try:
+            key = (template_name, lang_code, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            # unhashable arguments cannot be cached
+            key = None
+
+        if key is not None:
+            with self._render_lock:
+                if key in self._render_cache:
+                    self._render_cache.move_to_end(key)
+                    return self._render_cache[key]
+
+        answer_tmpl = self.ANSWER_TEMPLATES[template_name][lang_code]
+        answer = answer_tmpl.substitute(**kwargs)
 
-        return self.ANSWER_TEMPLATES[template_name][lang_code]
\ No newline at end of file
+        if key is not None:
+            with self._render_lock:
+                self._render_cache[key] = answer
+                if len(self._render_cache) > self.RENDER_CACHE_SIZE:
+                    self._render_cache.popitem(last=False)
+        return answer
\ No newline at end of file
@@ -1,6 +1,9 @@
 import os
 import re
+import time
 import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import namesgenerator
 from telegram.ext import (
@@ -22,49 +25,131 @@ from telegram import (
 
 from questbot.users import User, UserState
 from questbot.controllers import QuestController, TeamController
+from questbot.shards import ShardedQuestController, RemoteTeamController
 from questbot.telegram.answers import BotTemplates
-from questbot.storage import DataStorage
+from questbot.actors import KeyedExecutor
+from questbot.storage import StorageEngine
+from questbot.metrics import (
+    COMMAND_LATENCY,
+    COMMAND_ERRORS,
+    MESSAGES_SENT,
+    MESSAGE_ERRORS
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+class ChatReply():
+    """
+    recipient of a reply to the message,
+    it's queued to BroadcastScheduler the same way as User
+    """
+
+    def __init__(self, message):
+        self._message = message
+
+    @property
+    def chat_id(self):
+        return self._message.chat_id
+
+    def send_message(self, message):
+        try:
+            self._message.reply_text(message, parse_mode=ParseMode.HTML)
+        except Exception:
+            MESSAGE_ERRORS.inc()
+            raise
+        MESSAGES_SENT.inc()
+
+
 class UserController():
     """
     responsible for actions asked by user
     using some bot commands
+
+    dispatcher only queues commands, they're handled by a pool of workers
+    in order of arrival for every chat and in parallel for different chats;
+    replies are queued to the broadcast scheduler of quest controller
     """
+    HANDLER_WORKERS = 8
 
-    def __init__(self, dispatcher, quest_controller, storage_path):
+    def __init__(self, dispatcher, quest_controller, storage, workers=None):
         self.controller = quest_controller
         self.dispatcher = dispatcher
+        self.storage = storage
         self._bot = BotTemplates()
         self._users = {}
-        self._storage = DataStorage(storage_path)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or self.HANDLER_WORKERS,
+            thread_name_prefix="handler")
+        self._handlers = KeyedExecutor(self._executor)
         self._configure_routing()
         self.restore_users()
 
+    def _serialize_user(self, user):
+        return {
+            "name": user.name,
+            "user_id": user.user_id,
+            "chat_id": user.chat_id,
+            "lang_code": user.lang_code
+        }
+
     def save_users(self):
         serialized_users = {}
         for key, value in self._users.items():
-            serialized_users[key] = {
-                "name": value.name,
-                "user_id": value.user_id,
-                "chat_id": value.chat_id,
-                "lang_code": value.lang_code
-            }
-        self._storage.save(serialized_users)
+            serialized_users[key] = self._serialize_user(value)
+        self.storage.save(serialized_users)
+
+    def save_user(self, user):
+        """
+        stores a single user profile
+        """
+
+        self.storage.put(user.user_id, self._serialize_user(user))
 
     def restore_users(self):
-        serialized_users = self._storage.load()
-        if serialized_users is not None:
-            for key, value in serialized_users.items():
-                self._register_new_user(value["user_id"],
-                                        value["chat_id"],
-                                        value["name"], "")
-                user = self._get_user(value["user_id"])
-                user.lang_code = value.get("lang_code", "")
-                self.controller.distributor.subscribe(user)
+        """
+        builds users from storage in one pass without writing them back
+        and links them to teams restored by quest controller
+        """
+
+        started_at = time.perf_counter()
+        serialized_users = self.storage.load() or {}
+
+        users = []
+        for value in serialized_users.values():
+            if value["user_id"] in self._users:
+                continue
+            user = User(value["user_id"], value["chat_id"], self.dispatcher)
+            user.name = value["name"]
+            user.lang_code = value.get("lang_code", "")
+            self._users[user.user_id] = user
+            users.append(user)
+
+        self.controller.distributor.subscribe_many(users)
+        self.controller.relink_users(self._users)
+        self._prune_memberships()
+        logger.info(f"Restored {len(users)} users in "
+                    f"{time.perf_counter() - started_at:.3f}s")
+
+    def _prune_memberships(self):
+        """
+        removes stored memberships of users who have not been linked
+        to the same teams again
+        """
+
+        stale = []
+        memberships = self.storage.load_memberships()
+        for user_id, (quest_name, team_name) in memberships.items():
+            user = self._users.get(user_id)
+            team_controller = user and user.get_team_controller()
+            if (team_controller is None
+                    or team_controller.team.name != team_name):
+                stale.append(user_id)
+        for user_id in stale:
+            self.storage.remove_membership(user_id)
+        if stale:
+            logger.info(f"Removed {len(stale)} stale memberships")
 
     @property
     def dispatcher(self):
@@ -77,30 +162,106 @@ class UserController():
                              "telegram.ext.Dispatcher")
         self._dispatcher = value
 
+    @property
+    def storage(self):
+        return self._storage
+
+    @storage.setter
+    def storage(self, value):
+        if not isinstance(value, StorageEngine):
+            raise ValueError("value must be an instance of StorageEngine")
+        self._storage = value
+
     @property
     def controller(self):
         return self._controller
 
     @controller.setter
     def controller(self, value):
-        if not isinstance(value, QuestController):
-            raise ValueError("value must be an instance of QuestController")
+        if not isinstance(value, (QuestController, ShardedQuestController)):
+            raise ValueError("value must be an instance of QuestController "
+                             "or ShardedQuestController")
         self._controller = value
 
     def _configure_routing(self):
         routes = [
-            CommandHandler("help", self.cmd_help),
-            CommandHandler("start", self.cmd_start),
-            CommandHandler("version", self.cmd_version),
-            CommandHandler("register", self.cmd_register),
-            CommandHandler("unregister", self.cmd_unregister),
-            CommandHandler("answer", self.cmd_give_answer),
-            CommandHandler("hint", self.cmd_get_hint),
-            CommandHandler("deleteme", self.cmd_delete_profile),
-            CommandHandler("help", self.cmd_help)
+            ("help", self.cmd_help),
+            ("start", self.cmd_start),
+            ("version", self.cmd_version),
+            ("register", self.cmd_register),
+            ("unregister", self.cmd_unregister),
+            ("answer", self.cmd_give_answer),
+            ("hint", self.cmd_get_hint),
+            ("leaderboard", self.cmd_leaderboard),
+            ("deleteme", self.cmd_delete_profile),
+            ("help", self.cmd_help)
         ]
-        for route in routes:
-            self.dispatcher.add_handler(route)
+        for command, callback in routes:
+            self.dispatcher.add_handler(
+                CommandHandler(command, self._queued(command, callback)))
+
+    def _queued(self, command, callback):
+        """
+        returns callback that queues the command for its chat and team
+        """
+
+        measured_callback = self._measured(command, callback)
+
+        def handled_callback(update, context):
+            try:
+                measured_callback(update, context)
+            except Exception as exc:
+                # the command doesn't run in dispatcher, so its errors
+                # are passed to dispatcher error handlers here
+                self.dispatcher.dispatch_error(update, exc)
+
+        def queued_callback(update, context):
+            self._handlers.submit(self._queue_key(update),
+                                  handled_callback, update, context)
+        return queued_callback
+
+    def _queue_key(self, update):
+        """
+        returns (chat_id, team_name) of the user sending the command,
+        team_name is None if the user plays in no team
+        """
+
+        user = self._users.get(update.effective_user.id)
+        team_controller = user and user.get_team_controller()
+        team_name = team_controller and team_controller.team.name
+        return (update.effective_chat.id, team_name)
+
+    def _measured(self, command, callback):
+        """
+        returns callback that records latency and errors of the command
+        """
+
+        timed_callback = COMMAND_LATENCY.timed(command=command)(callback)
+
+        @functools.wraps(callback)
+        def measured_callback(update, context):
+            try:
+                return timed_callback(update, context)
+            except Exception:
+                COMMAND_ERRORS.inc(command=command)
+                raise
+        return measured_callback
+
+    def _reply(self, update, answer):
+        """
+        queues a reply to the message of update, returns Broadcast handle,
+        the scheduler sends messages of a chat in order of queueing
+        """
+
+        return self.controller.scheduler.submit(
+            [(ChatReply(update.message), answer)])
+
+    def shutdown(self):
+        """
+        waits for queued commands to be handled
+        """
+
+        self._executor.shutdown(wait=True)
 
     def _register_new_user(self, user_id, chat_id, first_name, last_name):
         """
@@ -117,7 +278,7 @@ class UserController():
             user = User(user_id, chat_id, self.dispatcher)
             user.name = f"{first_name} {last_name}".strip()
             self._users[user_id] = user
-            self.save_users()
+            self.save_user(user)
             return True
 
     def _get_user(self, user_id):
@@ -137,17 +298,18 @@ class UserController():
         return re.fullmatch('[\\w]{1,25}', value)
 
     def _validate_qevent_id(self, qevent_id):
-        return re.fullmatch('[\\d]{4}', qevent_id)
+        return re.fullmatch(f'[\\d]{{{self.controller.event_id_length}}}',
+                            qevent_id)
 
     def cmd_help(self, update, context):
         lang_code = str(update.message.from_user.language_code)
         answer_tmpl = self._bot.get_answer_template("help", lang_code)
         answer = answer_tmpl.substitute()
-        update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+        self._reply(update, answer)
 
     def cmd_version(self, update, context):
         git_version = os.environ.get("GIT_VERSION") or "unknown-version"
-        update.message.reply_text(git_version, parse_mode=ParseMode.HTML)
+        self._reply(update, git_version)
 
     def cmd_start(self, update, context):
         lang_code = str(update.message.from_user.language_code)
@@ -159,11 +321,13 @@ class UserController():
         last_name = update.message.from_user["last_name"] or " "
 
         self._register_new_user(user_id, chat_id, first_name, last_name)
-        self._get_user(user_id).lang_code = lang_code
+        if self._get_user(user_id).lang_code != lang_code:
+            self._get_user(user_id).lang_code = lang_code
+            self.save_user(self._get_user(user_id))
         self.controller.distributor.subscribe(self._get_user(user_id))
 
         answer = answer_tmpl.substitute(name=self._get_user(user_id).name)
-        update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+        self._reply(update, answer)
 
     def cmd_register(self, update, context):
         lang_code = str(update.message.from_user.language_code)
@@ -183,7 +347,7 @@ class UserController():
 
         answer_tmpl = self._bot.get_answer_template(template_name, lang_code)
         answer = answer_tmpl.substitute(qevent_id=qevent_id)
-        update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+        self._reply(update, answer)
 
     def cmd_unregister(self, update, context):
         lang_code = str(update.message.from_user.language_code)
@@ -198,7 +362,7 @@ class UserController():
 
         answer_tmpl = self._bot.get_answer_template(template_name, lang_code)
         answer = answer_tmpl.substitute()
-        update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+        self._reply(update, answer)
 
     def cmd_about_team(self, update, context):
         pass
@@ -217,14 +381,37 @@ class UserController():
             template_name = "get_hint_fail"
             answer_tmpl = self._bot.get_answer_template(template_name, lang_code)
             answer = answer_tmpl.substitute()
-            update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+            self._reply(update, answer)
         else:
             team_controller = user.get_team_controller()
-            assert isinstance(team_controller, TeamController), \
+            assert isinstance(team_controller,
+                              (TeamController, RemoteTeamController)), \
                     (f"User user_id={user_id} has incorrect team_controller "
                      f"of class '{type(team_controller)}'")
             team_controller.give_hint(user)
 
+    def cmd_leaderboard(self, update, context):
+        lang_code = str(update.message.from_user.language_code)
+        user_id = update.message.from_user["id"]
+        user = self._get_user(user_id)
+        if user is None:
+            raise KeyError(f"No user is found for user_id={user_id}")
+
+        if user.state != UserState.PLAYING:
+            answer_tmpl = self._bot.get_answer_template("leaderboard_fail",
+                                                        lang_code)
+            answer = answer_tmpl.substitute()
+        else:
+            team_controller = user.get_team_controller()
+            table, team_rank = team_controller.get_leaderboard()
+            answer_tmpl = self._bot.get_answer_template("leaderboard",
+                                                        lang_code)
+            answer = answer_tmpl.substitute(
+                table=table,
+                team_name=team_controller.team.name,
+                team_rank=team_rank)
+        self._reply(update, answer)
+
     def cmd_give_answer(self, update, context):
         lang_code = str(update.message.from_user.language_code)
         user_id = update.message.from_user["id"]
@@ -239,7 +426,8 @@ class UserController():
             template_name = "give_answer_wrong_format"
         else:
             team_controller = user.get_team_controller()
-            assert isinstance(team_controller, TeamController), \
+            assert isinstance(team_controller,
+                              (TeamController, RemoteTeamController)), \
                     (f"User user_id={user_id} has incorrect team_controller "
                      f"of class '{type(team_controller)}'")
 
@@ -248,7 +436,7 @@ class UserController():
 
         answer_tmpl = self._bot.get_answer_template(template_name, lang_code)
         answer = answer_tmpl.substitute()
-        update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+        self._reply(update, answer)
 
     def cmd_change_nickname(self, update, context):
         lang_code = str(update.message.from_user.language_code)
@@ -264,14 +452,14 @@ class UserController():
             answer_tmpl = self._bot.get_answer_template("change_nickname_success",
                                                     lang_code)
             answer = answer_tmpl.substitute()
-            update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+            self._reply(update, answer)
         else:
             logger.warning(f"User user_id={user_id} has supplied "
                            "an invalid nickname")
             answer_tmpl = self._bot.get_answer_template("change_nickname_fail",
                                                     lang_code)
             answer = answer_tmpl.substitute()
-            update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+            self._reply(update, answer)
 
     def cmd_delete_profile(self, update, context):
         lang_code = str(update.message.from_user.language_code)
@@ -282,11 +470,11 @@ class UserController():
             raise KeyError(f"No user is found for user_id={user_id}")
             
         self.controller.distributor.unsubscribe(user)
-        user.remove_team_controller()
+        self.controller.leave_quest(user)
         user.state = UserState.DELETED
         self._users.pop(user.user_id)
-        self.save_users()
+        self.storage.delete(user.user_id)
         
         answer_tmpl = self._bot.get_answer_template("delete_profile", lang_code)
         answer = answer_tmpl.substitute()
-        update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+        self._reply(update, answer)
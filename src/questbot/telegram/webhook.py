@@ -0,0 +1,171 @@
+import json
+import signal
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+
+from questbot.metrics import WEBHOOK_UPDATES
+
+
+logger = logging.getLogger(__name__)
+
+
+class _PooledHTTPServer(HTTPServer):
+    """
+    HTTP server that handles requests on a fixed pool of worker threads
+    """
+    request_queue_size = 128
+
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="webhook")
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+
+class WebhookServer():
+    """
+    receives updates from Telegram with HTTP POST requests and puts them
+    to the dispatcher queue, updates are processed by the dispatcher
+    the same way as with polling
+
+    requests are handled by <workers> threads, so several deliveries of
+    Telegram (see max_connections of setWebhook) are accepted at a time;
+    if secret_token is set, requests without the same
+    X-Telegram-Bot-Api-Secret-Token header are rejected
+
+    recorded updates can be replayed locally, e.g.:
+        curl -X POST -H 'Content-Type: application/json' \\
+             -d @update.json http://127.0.0.1:8080/webhook
+    """
+    WORKERS = 4
+    MAX_BODY_SIZE = 1024 * 1024     # in bytes
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+    def __init__(self, dispatcher, port, listen="0.0.0.0", path="/webhook",
+                 secret_token=None, workers=None):
+        self._dispatcher = dispatcher
+        self._path = path
+        self._secret_token = secret_token
+        self._workers = workers or self.WORKERS
+        self._httpd = _PooledHTTPServer((listen, port), self._make_handler(),
+                                        self._workers)
+        self._threads = []
+        self._stopped = threading.Event()
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                status = server.handle_request(self.path, self.headers,
+                                               self.rfile)
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} - {format % args}")
+
+        return Handler
+
+    def handle_request(self, path, headers, rfile):
+        """
+        puts update from request body to the dispatcher queue
+        returns HTTP status code of the response
+        """
+
+        if path.split("?")[0] != self._path:
+            WEBHOOK_UPDATES.inc(status="not_found")
+            return 404
+        if (self._secret_token is not None
+                and headers.get(self.SECRET_HEADER) != self._secret_token):
+            logger.warning("Webhook request has no valid secret token")
+            WEBHOOK_UPDATES.inc(status="forbidden")
+            return 403
+
+        try:
+            length = int(headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if not 0 < length <= self.MAX_BODY_SIZE:
+            WEBHOOK_UPDATES.inc(status="bad_request")
+            return 400 if length <= 0 else 413
+
+        try:
+            data = json.loads(rfile.read(length))
+            update = Update.de_json(data, self._dispatcher.bot)
+        except Exception as exc:
+            logger.warning(f"Cannot parse update received by webhook: {exc}")
+            WEBHOOK_UPDATES.inc(status="bad_request")
+            return 400
+
+        if update is None:
+            WEBHOOK_UPDATES.inc(status="bad_request")
+            return 400
+        self._dispatcher.update_queue.put(update)
+        WEBHOOK_UPDATES.inc(status="accepted")
+        return 200
+
+    def start(self):
+        """
+        starts the dispatcher and HTTP server in separate threads
+        """
+
+        for target, name in ((self._dispatcher.start, "dispatcher"),
+                             (self._httpd.serve_forever, "webhook")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Receiving updates on port {self.port} "
+                    f"path '{self._path}' with {self._workers} workers")
+
+    def stop(self):
+        """
+        stops receiving updates and the dispatcher
+        """
+
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._dispatcher.stop()
+        self._stopped.set()
+
+    def idle(self, stop_signals=(signal.SIGINT, signal.SIGTERM,
+                                 signal.SIGABRT)):
+        """
+        blocks until one of stop_signals is received, then stops the server
+        """
+
+        def handler(signum, frame):
+            logger.info(f"Received signal {signum}, stopping...")
+            threading.Thread(target=self.stop).start()
+
+        for signum in stop_signals:
+            signal.signal(signum, handler)
+        while not self._stopped.wait(1):
+            pass
@@ -3,6 +3,8 @@ from enum import Enum
 
 from telegram import ParseMode
 
+from questbot.metrics import MESSAGES_SENT, MESSAGE_ERRORS
+
 logger = logging.getLogger(__name__)
 
 
@@ -10,6 +12,7 @@ class UserState(Enum):
     IDLE = 1
     PLAYING = 2
     DELETED = 3
+    REGISTERED = 4  # waits to be assigned to a team
 
 
 class User():
@@ -65,14 +68,19 @@ class User():
         self._state = value
 
     def send_message(self, message):
-        if self.state == UserState.DELETED:
+        if self._state == UserState.DELETED:
             logger.error(f"User user_id={self.user_id} and "
                          f"username={self.username} is already deleted, but "
                          "trying to send message to it")
         else:
-            self._dispatcher.bot.sendMessage(chat_id=self.chat_id,
-                                             text=message,
-                                             parse_mode=ParseMode.HTML)
+            try:
+                self._dispatcher.bot.sendMessage(chat_id=self.chat_id,
+                                                 text=message,
+                                                 parse_mode=ParseMode.HTML)
+            except Exception:
+                MESSAGE_ERRORS.inc()
+                raise
+            MESSAGES_SENT.inc()
 
     def set_team_controller(self, team_controller):
         """
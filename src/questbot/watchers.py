@@ -0,0 +1,175 @@
+import os
+import time
+import logging
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class QuestWatcher():
+    """
+    watches quests directory and keeps QuestController in sync with it
+
+    changed files are detected by mtime and size (inotify is used to wake
+    up early when inotify_simple is installed), only changed files are
+    parsed again; quest events that are scheduled or running are never
+    touched, their files are processed again after they're finished
+    """
+    INTERVAL = 5  # in seconds
+
+    def __init__(self, directory, parser, quest_controller,
+                 cache=None, interval=None):
+        self._directory = directory
+        self._parser = parser
+        self._controller = quest_controller
+        self._cache = cache
+        self._interval = interval or self.INTERVAL
+        self._files = {}    # filepath => (mtime_ns, size)
+        self._names = {}    # filepath => quest name
+        self._deferred = set()
+        self._is_active = False
+        self._thread = None
+
+    def _scan(self):
+        """
+        returns dict of quest files with their (mtime_ns, size)
+        """
+
+        files = {}
+        for filepath in self._parser.list(self._directory):
+            try:
+                stat = os.stat(filepath)
+                files[filepath] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                continue
+        return files
+
+    def reload(self):
+        """
+        parses changed quest files and registers, replaces or
+        retires their quest events
+        returns dict of counters for applied changes
+        """
+
+        started_at = time.perf_counter()
+        files = self._scan()
+        changed = [filepath for filepath, stat in files.items()
+                   if self._files.get(filepath) != stat]
+        removed = [filepath for filepath in self._names
+                   if filepath not in files]
+        self._files = files
+
+        counters = {"registered": 0, "replaced": 0,
+                    "retired": 0, "skipped": 0}
+        if not changed and not removed:
+            return counters
+
+        # deferred files are retried on every reload, don't flood the log
+        log = logger.debug if self._deferred.issuperset(changed + removed) \
+            else logger.info
+
+        quests = self._parser.process_many(changed, self._cache)
+        for filepath, quest in zip(changed, quests):
+            if quest is None:
+                logger.error(f"Quest file '{filepath}' is invalid, "
+                             "its quest event is left as is")
+                counters["skipped"] += 1
+                continue
+
+            old_name = self._names.get(filepath)
+            if old_name is not None and old_name != quest.name:
+                if not self._retire(filepath, counters):
+                    continue
+                old_name = None
+
+            if old_name is None:
+                if self._controller.register(quest):
+                    self._names[filepath] = quest.name
+                    counters["registered"] += 1
+                else:
+                    logger.warning(f"Quest '{quest.name}' from '{filepath}' "
+                                   "is a duplicate, it's not registered")
+                    counters["skipped"] += 1
+            elif self._controller.replace(quest):
+                self._deferred.discard(filepath)
+                counters["replaced"] += 1
+            else:
+                self._defer(filepath, counters)
+
+        for filepath in removed:
+            self._retire(filepath, counters)
+
+        log(f"Reloaded quests in "
+            f"{time.perf_counter() - started_at:.3f}s: "
+            + ", ".join(f"{count} {action}"
+                        for action, count in counters.items()))
+        return counters
+
+    def _defer(self, filepath, counters):
+        """
+        forgets file stat, so the file is processed again on next reload
+        """
+
+        if filepath not in self._deferred:
+            logger.warning(f"Quest '{self._names[filepath]}' from "
+                           f"'{filepath}' is active, it will be changed "
+                           "after it's finished")
+        self._deferred.add(filepath)
+        self._files.pop(filepath, None)
+        counters["skipped"] += 1
+
+    def _retire(self, filepath, counters):
+        """
+        returns True if quest event of filepath has been retired
+        """
+
+        name = self._names[filepath]
+        if (self._controller.retire(name)
+                or self._controller.get_state(name) is None):
+            self._names.pop(filepath)
+            self._deferred.discard(filepath)
+            counters["retired"] += 1
+            return True
+
+        self._defer(filepath, counters)
+        return False
+
+    def start(self):
+        """
+        starts watching quests directory in a separate thread
+        """
+
+        self._is_active = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._is_active = False
+
+    def _wait_for_changes(self, inotify):
+        if inotify is None:
+            time.sleep(self._interval)
+        else:
+            inotify.read(timeout=int(self._interval * 1000))
+
+    def _run(self):
+        inotify = None
+        if INotify is not None:
+            inotify = INotify()
+            inotify.add_watch(self._directory,
+                              flags.CLOSE_WRITE | flags.MOVED_TO
+                              | flags.MOVED_FROM | flags.DELETE)
+
+        while self._is_active:
+            self._wait_for_changes(inotify)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception(f"Cannot reload quests from "
+                                 f"'{self._directory}'")
@@ -0,0 +1,42 @@
+"""
+unit tests of the bot, run from repository root:
+    python -m pytest tests
+"""
+import os
+import sys
+import warnings
+from queue import Queue
+
+import pytest
+from telegram.ext import Dispatcher
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+
+class FakeBot():
+    """
+    bot that records sent messages instead of sending them
+    """
+
+    def __init__(self):
+        self.id = 1
+        self.username = "fakebot"
+        self.first_name = "Fake Bot"
+        self.defaults = None
+        self.sent = []
+
+    def sendMessage(self, chat_id, text, parse_mode=None, **kwargs):
+        self.sent.append((chat_id, text))
+        return True
+
+    send_message = sendMessage
+
+
+@pytest.fixture
+def dispatcher():
+    with warnings.catch_warnings():
+        # dispatcher warns that run_async handlers need worker threads
+        warnings.simplefilter("ignore")
+        return Dispatcher(FakeBot(), Queue(), workers=0)
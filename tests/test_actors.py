@@ -0,0 +1,49 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from questbot.actors import Mailbox, KeyedExecutor
+
+
+def test_mailbox_runs_commands_in_order():
+    with ThreadPoolExecutor(4) as executor:
+        mailbox = Mailbox(executor)
+        results = []
+        futures = [mailbox.submit(results.append, idx) for idx in range(100)]
+        for future in futures:
+            future.result(5)
+    assert results == list(range(100))
+
+
+def test_mailbox_without_executor_runs_in_caller():
+    mailbox = Mailbox()
+    assert mailbox.submit(threading.get_ident).result() == (
+        threading.get_ident())
+
+
+def test_keyed_executor_orders_commands_of_a_key():
+    results = {}
+    with ThreadPoolExecutor(4) as executor:
+        keyed = KeyedExecutor(executor)
+        futures = [keyed.submit(idx % 3,
+                                results.setdefault(idx % 3, []).append, idx)
+                   for idx in range(300)]
+        for future in futures:
+            future.result(5)
+    assert results == {key: list(range(key, 300, 3)) for key in range(3)}
+    # idle keys are forgotten
+    assert len(keyed) == 0
+
+
+def test_keyed_executor_rejects_commands_after_shutdown():
+    executor = ThreadPoolExecutor(1)
+    keyed = KeyedExecutor(executor)
+    keyed.submit("chat", int).result(5)
+    executor.shutdown(wait=True)
+
+    with pytest.raises(RuntimeError):
+        keyed.submit("chat", int)
+    assert len(keyed) == 0
+    with pytest.raises(RuntimeError):
+        keyed.submit("chat", int)
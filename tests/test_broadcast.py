@@ -0,0 +1,74 @@
+import threading
+
+from telegram.error import RetryAfter
+
+from questbot.broadcast import BroadcastScheduler
+
+
+class FakeUser():
+    def __init__(self, chat_id, retry_after=None):
+        self.chat_id = chat_id
+        self.sent = []
+        self._retry_after = retry_after
+        self.is_sending = threading.Event()
+        self.can_send = threading.Event()
+        self.can_send.set()
+
+    def send_message(self, message):
+        self.is_sending.set()
+        self.can_send.wait()
+        if self._retry_after is not None:
+            raise RetryAfter(self._retry_after)
+        self.sent.append(message)
+
+
+def test_messages_of_a_chat_are_sent_in_order():
+    scheduler = BroadcastScheduler(workers=4)
+    user = FakeUser(1)
+    broadcasts = [scheduler.submit([(user, idx)]) for idx in range(3)]
+    assert all(broadcast.wait(5) for broadcast in broadcasts)
+    assert user.sent == [0, 1, 2]
+    assert [broadcast.sent for broadcast in broadcasts] == [1, 1, 1]
+    scheduler.shutdown()
+
+
+def test_full_queue_drops_deliveries():
+    scheduler = BroadcastScheduler(workers=1, max_pending=2)
+    broadcast = scheduler.submit([(FakeUser(chat_id), "message")
+                                  for chat_id in range(1, 6)])
+    assert broadcast.wait(5)
+    assert (broadcast.sent, broadcast.failed) == (2, 3)
+    scheduler.shutdown()
+
+
+def test_shutdown_completes_queued_broadcasts():
+    scheduler = BroadcastScheduler(workers=1)
+    user = FakeUser(1)
+    user.can_send.clear()
+    broadcast = scheduler.submit([(user, idx) for idx in range(3)])
+    assert user.is_sending.wait(5)
+
+    scheduler.shutdown()
+    user.can_send.set()
+    assert broadcast.wait(5)
+    assert (broadcast.sent, broadcast.failed) == (1, 2)
+
+    late = scheduler.submit([(user, "late")])
+    assert late.wait(5)
+    assert late.failed == 1
+
+
+def test_retry_counts_against_max_pending():
+    scheduler = BroadcastScheduler(workers=1, max_pending=1)
+    retried = FakeUser(1, retry_after=0)
+    retried.can_send.clear()
+    broadcast = scheduler.submit([(retried, "retried")])
+    assert retried.is_sending.wait(5)
+    # the queue is full when the retry comes back
+    other = scheduler.submit([(FakeUser(2), "other")])
+    retried.can_send.set()
+
+    assert broadcast.wait(5)
+    assert broadcast.failed == 1
+    assert other.wait(5)
+    scheduler.shutdown()
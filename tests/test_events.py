@@ -0,0 +1,72 @@
+import pytest
+
+from questbot.events import EventIdMapper
+
+
+def issue_all(mapper):
+    return [mapper.register_event(object())
+            for _ in range(mapper._capacity)]
+
+
+@pytest.mark.parametrize("id_length", [1, 2, 3])
+def test_identifiers_are_a_permutation(id_length):
+    ids = issue_all(EventIdMapper(id_length))
+    assert sorted(ids) == [str(value).zfill(id_length)
+                           for value in range(10 ** id_length)]
+
+
+def test_identifiers_depend_on_key():
+    first = issue_all(EventIdMapper(3, key=b"first"))
+    assert first == issue_all(EventIdMapper(3, key=b"first"))
+    assert first != issue_all(EventIdMapper(3, key=b"second"))
+    assert first != sorted(first)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7])
+def test_partitions_split_identifiers(count):
+    issued = []
+    for index in range(count):
+        ids = issue_all(EventIdMapper(3, partition=(index, count)))
+        # every identifier of the partition range is issued once
+        assert all(int(qevent_id) % count == index for qevent_id in ids)
+        assert len(set(ids)) == len(ids)
+        issued.extend(ids)
+    assert sorted(issued) == [str(value).zfill(3) for value in range(1000)]
+
+
+def test_exhausted_mapper_reuses_released_identifiers():
+    mapper = EventIdMapper(1)
+    ids = issue_all(mapper)
+    with pytest.raises(RuntimeError):
+        mapper.register_event(object())
+    assert mapper.remove_event(ids[3])
+    assert mapper.register_event(object()) == ids[3]
+
+
+def test_restored_mapper_continues_sequence():
+    mapper = EventIdMapper(2, partition=(1, 3))
+    issued = [mapper.register_event(object()) for _ in range(10)]
+    state = mapper.snapshot()
+
+    restored = EventIdMapper(2, partition=(1, 3))
+    assert restored.restore(state)
+    qevent = object()
+    assert restored.restore_event(issued[0], qevent)
+    rest = [restored.register_event(object())
+            for _ in range(restored._capacity - 10)]
+    assert not set(rest) & set(issued)
+    assert restored.get_event(issued[0]) is qevent
+
+
+def test_restore_rejects_other_mapper_state():
+    state = EventIdMapper(2, partition=(0, 2)).snapshot()
+    assert not EventIdMapper(3, partition=(0, 2)).restore(state)
+    assert not EventIdMapper(2, partition=(1, 2)).restore(state)
+    assert not EventIdMapper(2).restore(dict(state, permutation=None))
+
+
+def test_invalid_partition():
+    with pytest.raises(ValueError):
+        EventIdMapper(2, partition=(2, 2))
+    with pytest.raises(ValueError):
+        EventIdMapper(1, partition=(10, 11))
@@ -0,0 +1,91 @@
+import os
+
+from questbot.gamelog import (
+    GameLog,
+    GameReplay,
+    GameEvent,
+    list_segments
+)
+
+
+START_DATE = 1767225600.0   # quest start date as it's logged
+
+
+def write_segment(path, players):
+    game_log = GameLog(path)
+    game_log.append(GameEvent.QUEST_STATE, "quest", 1, "0001",
+                    START_DATE, 3600.0)
+    for user_id in players:
+        game_log.append(GameEvent.JOINED, "quest", "team", user_id)
+    game_log.append(GameEvent.ANSWER_WRONG, "quest", "team", players[0],
+                    "wrong answer")
+    game_log.close()
+
+
+def restart(path):
+    replay = GameReplay()
+    count = replay.replay(path)
+    replay.checkpoint(path)
+    return count, replay
+
+
+def members(replay):
+    team, = replay.snapshot()["quests"]["quest"]["teams"]
+    return team["members"]
+
+
+def test_replay_of_segments(tmp_path):
+    write_segment(str(tmp_path), [1, 2])
+    write_segment(str(tmp_path), [3])
+
+    replay = GameReplay()
+    assert replay.replay(str(tmp_path)) == 7
+    assert members(replay) == [1, 2, 3]
+    assert replay.scores() == {"quest": {"team": 0}}
+
+
+def test_checkpoint_replaces_replayed_segments(tmp_path):
+    path = str(tmp_path)
+    write_segment(path, [1, 2])
+    assert restart(path)[0] == 4
+    assert list_segments(path) == []
+
+    write_segment(path, [3])
+    # segment numbers continue after checkpointed ones
+    assert [os.path.basename(filename) for filename in list_segments(path)
+            ] == ["gamelog-000002.bin"]
+    count, replay = restart(path)
+    assert count == 7
+    assert members(replay) == [1, 2, 3]
+
+    replay = GameReplay()
+    assert replay.replay(path) == 7
+    assert members(replay) == [1, 2, 3]
+
+
+def test_checkpointed_segments_are_not_replayed_again(tmp_path):
+    path = str(tmp_path)
+    write_segment(path, [1])
+    replay = GameReplay()
+    replay.replay(path)
+    # segments are written again as if removal has been interrupted
+    segments = {filename: open(filename, 'rb').read()
+                for filename in list_segments(path)}
+    replay.checkpoint(path)
+    for filename, data in segments.items():
+        with open(filename, 'wb') as file:
+            file.write(data)
+
+    assert restart(path)[0] == 3
+
+
+def test_torn_record_is_ignored(tmp_path):
+    path = str(tmp_path)
+    write_segment(path, [1, 2])
+    filename, = list_segments(path)
+    with open(filename, 'r+b') as file:
+        file.truncate(os.path.getsize(filename) - 2)
+
+    replay = GameReplay()
+    assert replay.replay(path) == 3
+    assert members(replay) == [1, 2]
@@ -0,0 +1,71 @@
+import random
+import itertools
+
+import pytest
+
+from questbot.matchers import normalize_answer, within_distance
+
+
+def osa_distance(source, target):
+    """
+    optimal string alignment distance by the full matrix
+    """
+
+    rows = [[0] * (len(target) + 1) for _ in range(len(source) + 1)]
+    for i in range(len(source) + 1):
+        rows[i][0] = i
+    for j in range(len(target) + 1):
+        rows[0][j] = j
+    for i in range(1, len(source) + 1):
+        for j in range(1, len(target) + 1):
+            cost = source[i - 1] != target[j - 1]
+            rows[i][j] = min(rows[i - 1][j] + 1, rows[i][j - 1] + 1,
+                             rows[i - 1][j - 1] + cost)
+            if (i > 1 and j > 1 and source[i - 1] == target[j - 2]
+                    and source[i - 2] == target[j - 1]):
+                rows[i][j] = min(rows[i][j], rows[i - 2][j - 2] + 1)
+    return rows[-1][-1]
+
+
+@pytest.mark.parametrize("source, target, distance", [
+    ("", "", 0),
+    ("", "abc", 3),
+    ("answer", "answer", 0),
+    ("answer", "answr", 1),         # deletion
+    ("answer", "answers", 1),       # insertion
+    ("answer", "anzwer", 1),        # substitution
+    ("answer", "nswear", 2),
+    ("answer", "asnwer", 1),        # transposition
+    ("ca", "abc", 3),               # OSA, not unrestricted Damerau
+    ("kitten", "sitting", 3),
+])
+def test_within_distance(source, target, distance):
+    assert osa_distance(source, target) == distance
+    for max_distance in range(5):
+        assert (within_distance(source, target, max_distance)
+                == (distance <= max_distance))
+
+
+def test_within_distance_matches_full_matrix():
+    rand = random.Random(1)
+    for _ in range(3000):
+        source = "".join(rand.choice("abc") for _ in range(rand.randrange(7)))
+        target = "".join(rand.choice("abc") for _ in range(rand.randrange(7)))
+        distance = osa_distance(source, target)
+        for max_distance in range(4):
+            assert (within_distance(source, target, max_distance)
+                    == (distance <= max_distance)), (source, target)
+
+
+def test_within_distance_is_symmetric():
+    for source, target in itertools.product(["abcd", "bacd", "abd", "xyz"],
+                                            repeat=2):
+        for max_distance in range(3):
+            assert (within_distance(source, target, max_distance)
+                    == within_distance(target, source, max_distance))
+
+
+def test_normalize_answer():
+    assert normalize_answer("  Ёлка \t ЗЕЛЁНАЯ ") == "елка зеленая"
+    assert normalize_answer("ＡＢＣ") == "abc"
+    assert normalize_answer("Straße") == "strasse"
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import pytest
+
+from questbot.schedules import CronSchedule
+
+
+def starts(expression, moment, count):
+    schedule = CronSchedule(expression)
+    result = []
+    for _ in range(count):
+        moment = schedule.next_after(moment)
+        result.append(moment)
+    return result
+
+
+def test_every_minute():
+    assert starts("* * * * *", datetime(2026, 1, 1, 12, 0, 30), 2) == [
+        datetime(2026, 1, 1, 12, 1), datetime(2026, 1, 1, 12, 2)]
+
+
+def test_next_start_is_strictly_after_moment():
+    schedule = CronSchedule("30 12 * * *")
+    assert (schedule.next_after(datetime(2026, 1, 1, 12, 30))
+            == datetime(2026, 1, 2, 12, 30))
+
+
+def test_lists_ranges_and_steps():
+    assert starts("0,30 9-10 * * *", datetime(2026, 1, 1), 5) == [
+        datetime(2026, 1, 1, 9, 0), datetime(2026, 1, 1, 9, 30),
+        datetime(2026, 1, 1, 10, 0), datetime(2026, 1, 1, 10, 30),
+        datetime(2026, 1, 2, 9, 0)]
+    assert starts("*/20 0 * * *", datetime(2025, 12, 31, 23), 4) == [
+        datetime(2026, 1, 1, 0, 0), datetime(2026, 1, 1, 0, 20),
+        datetime(2026, 1, 1, 0, 40), datetime(2026, 1, 2, 0, 0)]
+    # a single value with a step runs until the end of the range
+    assert starts("50/5 0 * * *", datetime(2026, 1, 1), 3) == [
+        datetime(2026, 1, 1, 0, 50), datetime(2026, 1, 1, 0, 55),
+        datetime(2026, 1, 2, 0, 50)]
+
+
+def test_day_of_week_sunday_is_zero():
+    # 2026-01-04 is Sunday
+    assert starts("0 12 * * 0", datetime(2026, 1, 1), 2) == [
+        datetime(2026, 1, 4, 12, 0), datetime(2026, 1, 11, 12, 0)]
+
+
+def test_restricted_day_fields_match_either():
+    # the 1st of a month or any Monday (2026-01-05 is Monday)
+    assert starts("0 12 1 * 1", datetime(2026, 1, 1, 13), 3) == [
+        datetime(2026, 1, 5, 12, 0), datetime(2026, 1, 12, 12, 0),
+        datetime(2026, 1, 19, 12, 0)]
+
+
+def test_day_field_with_star_step_is_not_restricted():
+    # odd days that are Mondays, not odd days or Mondays
+    assert starts("0 12 */2 * 1", datetime(2026, 1, 1), 3) == [
+        datetime(2026, 1, 5, 12, 0), datetime(2026, 1, 19, 12, 0),
+        datetime(2026, 2, 9, 12, 0)]
+    # the 5th that is Sunday, Tuesday, Thursday or Saturday
+    assert starts("0 12 5 * */2", datetime(2026, 1, 1), 2) == [
+        datetime(2026, 2, 5, 12, 0), datetime(2026, 3, 5, 12, 0)]
+
+
+def test_no_start_in_horizon():
+    assert CronSchedule("0 0 31 2 *").next_after(datetime(2026, 1, 1)) is None
+
+
+@pytest.mark.parametrize("expression", [
+    "* * * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * 13 *",
+    "* * * * 7", "5-1 * * * *", "*/0 * * * *", "a * * * *", "-1 * * * *",
+])
+def test_invalid_expression(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
@@ -0,0 +1,87 @@
+import time
+from datetime import datetime, timedelta
+
+from questbot.users import User, UserState
+from questbot.shards import ShardedQuestController
+from questbot.definitions import (
+    QuestDefinition,
+    TeamDefinition,
+    TaskDefinition
+)
+
+
+SHARDS = 2
+TIMEOUT = 30    # in seconds, shard processes are spawned
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition is not met in time")
+        time.sleep(0.05)
+
+
+def make_quest(name, start_date):
+    return QuestDefinition(name, "", start_date, timedelta(hours=1), [
+        TeamDefinition(f"team{idx}", "", "https://t.me/+team",
+                       [TaskDefinition("task", ("answer",), ("hint",))])
+        for idx in range(2)])
+
+
+def start_controller(tmp_path):
+    controller = ShardedQuestController(
+        SHARDS, snapshot_path=str(tmp_path / "snapshots"),
+        snapshot_interval=3600)
+    # qevent identifiers are announced to subscribed users only
+    qevent_ids = {}
+    notify_template = controller.distributor.notify_template
+
+    def recorded_notify_template(template_name, **kwargs):
+        if template_name == "quest_scheduled":
+            qevent_ids[kwargs["quest_name"]] = kwargs["qevent_id"]
+        return notify_template(template_name, **kwargs)
+    controller.distributor.notify_template = recorded_notify_template
+    return controller, qevent_ids
+
+
+def test_shards_relink_restored_players(tmp_path, dispatcher):
+    # quest events are announced a minute before the start
+    start_date = datetime.now() + timedelta(seconds=50)
+    names = [f"quest{idx}" for idx in range(4)]
+
+    controller, qevent_ids = start_controller(tmp_path)
+    try:
+        users = {user_id: User(user_id, user_id, dispatcher)
+                 for user_id in range(8)}
+        assert controller.relink_users(users) == 0
+        for name in names:
+            controller.register(make_quest(name, start_date))
+        wait_for(lambda: len(qevent_ids) == len(names))
+        for user_id, user in users.items():
+            assert controller.join_quest(
+                user, qevent_ids[names[user_id % len(names)]])
+        wait_for(lambda: all(user.state == UserState.PLAYING
+                             for user in users.values()))
+        teams = {user_id: user.get_team_controller().team.name
+                 for user_id, user in users.items()}
+    finally:
+        # shards save their last snapshots
+        controller.shutdown()
+
+    controller, _ = start_controller(tmp_path)
+    try:
+        for name in names:
+            controller.register(make_quest(name, start_date))
+        users = {user_id: User(user_id, user_id, dispatcher)
+                 for user_id in range(8)}
+        users[8] = User(8, 8, dispatcher)
+        assert controller.relink_users(users) == 8
+        wait_for(lambda: all(users[user_id].state == UserState.PLAYING
+                             for user_id in teams))
+        assert {user_id: users[user_id].get_team_controller().team.name
+                for user_id in teams} == teams
+        assert users[8].state == UserState.IDLE
+        assert controller.get_stats()["players"] == 8
+    finally:
+        controller.shutdown()
@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+from questbot.storage import JournalStorage
+
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / "users")
+
+
+def reopen(filename):
+    storage = JournalStorage(filename)
+    data = storage.load()
+    storage.close()
+    return data
+
+
+def test_journal_restores_records(filename):
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.put(1, {"name": "one"})
+    storage.put(2, {"name": "two"})
+    storage.delete(1)
+    storage.close()
+
+    assert reopen(filename) == {2: {"name": "two"}}
+
+
+def test_journal_drops_torn_tail(filename):
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.put(1, "one")
+    storage.put(2, "two")
+    storage.close()
+
+    # crash in the middle of the last record
+    size = os.path.getsize(storage.journal_filename)
+    with open(storage.journal_filename, 'r+b') as file:
+        file.truncate(size - 3)
+
+    assert reopen(filename) == {1: "one"}
+    # the torn tail is truncated, so new records follow valid ones
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.put(3, "three")
+    storage.close()
+    assert reopen(filename) == {1: "one", 3: "three"}
+
+
+def test_journal_ignores_corrupted_record(filename):
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.put(1, "one")
+    storage.put(2, "two")
+    storage.close()
+
+    with open(storage.journal_filename, 'r+b') as file:
+        file.seek(-1, os.SEEK_END)
+        last = file.read(1)
+        file.seek(-1, os.SEEK_END)
+        file.write(bytes([last[0] ^ 0xff]))
+
+    assert reopen(filename) == {1: "one"}
+
+
+def test_journal_replays_interrupted_compaction(filename):
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.save({1: "one", 2: "two"})
+    storage.close()
+
+    # compaction has rotated the journal and crashed before the snapshot
+    os.replace(storage.journal_filename, f"{filename}.journal.1")
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.put(3, "three")
+    storage.close()
+
+    assert reopen(filename) == {1: "one", 2: "two", 3: "three"}
+
+
+def test_journal_compacts_records(filename, monkeypatch):
+    monkeypatch.setattr(JournalStorage, "COMPACT_RECORDS", 0)
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.put(1, "one")
+    storage.put(2, "two")
+    storage.close()
+
+    assert os.path.exists(filename)
+    assert reopen(filename) == {1: "one", 2: "two"}
+
+
+def test_journal_rolls_back_failed_write(filename, monkeypatch):
+    storage = JournalStorage(filename)
+    storage.load()
+    storage.put(1, "one")
+
+    def fail(fd):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(JournalStorage, "RETRY_DELAY", 0)
+    monkeypatch.setattr(os, "fsync", fail)
+    with pytest.raises(OSError):
+        storage.put(1, "changed")
+    with pytest.raises(OSError):
+        storage.delete(1)
+    monkeypatch.undo()
+
+    storage.put(2, "two")
+    storage.close()
+    assert reopen(filename) == {1: "one", 2: "two"}